@@ -7218,3 +7218,24 @@ zoning
 zonked
 zoomed
 zygote"""
+
+
+def get_distro_probe_script():
+	"""Shell script that gathers the facts get_distro_info needs in one go.
+	Must run under plain sh (eg ash), as bash may not be installed yet.
+	lsb_release is preferred where installed; /etc/os-release and
+	/etc/redhat-release are read for when it is not.
+	Each fact is emitted as a line: SHUTIT_PROBE:KEY:value
+	The quotes in the marker stop the echoed command matching it.
+	"""
+	return r""" ( p() { printf 'SHUTIT_''PROBE:%s:%s\n' "$1" "$2"; }
+if command -v lsb_release >/dev/null 2>&1; then lsb_release -a 2>/dev/null | sed -n "s/^Distributor ID:[[:space:]]*/SHUTIT_""PROBE:LSB_ID:/p; s/^Release:[[:space:]]*/SHUTIT_""PROBE:LSB_RELEASE:/p"; fi
+if [ -f /etc/os-release ]; then p OS_RELEASE 1; for k in ID NAME VERSION_ID; do p OS_$k "$(sed -n "s/^$k=//p" /etc/os-release | tr -d '"')"; done; fi
+if [ -f /etc/redhat-release ]; then p REDHAT_RELEASE "$(head -n 1 /etc/redhat-release)"; fi
+if [ -f /etc/issue ]; then p ISSUE "$(tr '\n' ' ' < /etc/issue)"; fi
+if [ -e /cygdrive ]; then p CYGDRIVE 1; fi
+if command -v brew >/dev/null 2>&1; then p BREW 1; fi
+p UNAME "$(uname -s 2>/dev/null)"
+f=$(sed -n 's|.*/containers/\([0-9a-f]\{64\}\)/.*|\1|p' /proc/self/mountinfo 2>/dev/null | head -n 1)
+if [ -n "$f" ]; then f=container_$f; elif [ -s /etc/machine-id ]; then f=machine_$(cat /etc/machine-id); fi
+p FINGERPRINT "$f" )"""
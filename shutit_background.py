@@ -8,19 +8,36 @@ r"""Represents a ShutIt background command.
 
 from __future__ import print_function
 import sys
+import re
 import time
+import base64
 import logging
 import traceback
 import shutit_global
 import shutit_util
 
 
+# File descriptor, open in the shell on a FIFO, that background commands
+# write their id to when they finish. See ShutItLoginStackItem.
+NOTIFY_FD = 19
+
+# Most bytes of a background command's output got from the target by one
+# tail_output.
+TAIL_MAX_BYTES = 65536
+
+BASE64_LINE = re.compile('^[A-Za-z0-9+/]+=*$')
+
+
 class ShutItBackgroundCommand(object):
 	"""Background command in ShutIt
 	"""
 	def __init__(self,
 	             sendspec,
-	             shutit_obj):
+	             shutit_obj,
+	             notify=False):
+		"""
+		@param notify: Whether to write the id to NOTIFY_FD on finishing.
+		"""
 		# Stub this with a simple command for now
 		self.sendspec               = sendspec
 		self.block_other_commands   = sendspec.block_other_commands
@@ -32,12 +49,24 @@ class ShutItBackgroundCommand(object):
 		self.run_state              = 'N' # State as per ps man page, but 'C' == Complete, 'N' == not started, 'F' == failed, 'S' == sleeping/running, 'T' == timed out by ShutIt
 		self.cwd                    = self.sendspec.shutit_pexpect_child.send_and_get_output(' command pwd', ignore_background=True)
 		self.id                     = shutit_util.random_id()
+		# Name for other commands to depend on this by.
+		self.name                   = sendspec.background_id or self.id
 		self.output_file            = '/tmp/shutit_background_' + self.id + '_output.log'
 		self.exit_code_file         = '/tmp/shutit_background_' + self.id + '_exit_code_file.log'
 		self.command_file           = '/tmp/shutit_background_' + self.id + '_command.log'
+		# How far into the output file has been read by tail_output, and the
+		# last line read if incomplete.
+		self.output_offset          = 0
+		self.output_partial         = b''
+		# Whether tail_output has read all of the output of a finished command.
+		self.output_complete        = False
 		if self.sendspec.run_in_background:
 			# TODO: consider separating out into a simple send for the part that creates the command file, the cd and the output file. Perhaps send file first and run that in the background?
-			self.sendspec.send          = ' set +m && { : $(echo "' + self.sendspec.original_send + '" >' + self.command_file + ' && command cd "' + self.cwd + '">' + self.output_file + ' && ' + self.sendspec.send + ' >>' + self.output_file + ' 2>&1; echo $? >' + self.exit_code_file + ') & } 2>/dev/null'
+			notify_send                 = '; echo ' + self.id + ' >&' + str(NOTIFY_FD) if notify else ''
+			# The exit code file is removed first, as it is taken to mean the
+			# command is finishing (see ShutItLoginStackItem), and a retry
+			# runs the same command again.
+			self.sendspec.send          = ' command rm -f ' + self.exit_code_file + '; set +m && { : $(echo "' + self.sendspec.original_send + '" >' + self.command_file + ' && command cd "' + self.cwd + '">' + self.output_file + ' && ' + self.sendspec.send + ' >>' + self.output_file + ' 2>&1; echo $? >' + self.exit_code_file + notify_send + ') & } 2>/dev/null'
 		self.shutit_obj             = shutit_obj
 
 
@@ -45,6 +74,7 @@ class ShutItBackgroundCommand(object):
 		string = str(self.sendspec)
 		string += '\n---- Background object BEGIN ----'
 		string += '\n block_other_commands: ' + str(self.block_other_commands)
+		string += '| name: ' + str(self.name)
 		string += '| cwd: ' + str(self.cwd)
 		string += '| pid: ' + str(self.pid)
 		string += '| retry: ' + str(self.retry)
@@ -63,6 +93,11 @@ class ShutItBackgroundCommand(object):
 		self.run_state        = 'N'
 		self.start_time = time.time() # record start time
 
+		# The output file is truncated by the command.
+		self.output_offset    = 0
+		self.output_partial   = b''
+		self.output_complete  = False
+
 		# run command
 		self.tries            += 1
 		if self.sendspec.run_in_background:
@@ -74,8 +109,9 @@ class ShutItBackgroundCommand(object):
 			self.run_state        = 'S'
 			# Required to reset terminal after a background send. (TODO: why?)
 			self.sendspec.shutit_pexpect_child.reset_terminal()
-			# record pid
-			self.pid = self.sendspec.shutit_pexpect_child.send_and_get_output(" echo ${!}",ignore_background=True)
+			# record pid, which is the last line of the output, as the echoed
+			# command is not always stripped after a terminal reset.
+			self.pid = self.sendspec.shutit_pexpect_child.send_and_get_output(" echo ${!}",ignore_background=True).strip().split('\n')[-1].strip()
 		else:
 			# Run synchronously and mark complete
 			# We need to set this to ignore background before we run it, so that
@@ -90,13 +126,109 @@ class ShutItBackgroundCommand(object):
 		return True
 
 
-	def check_background_command_state(self):
+	def tail_output(self, max_bytes=TAIL_MAX_BYTES, latest=False, loglevel=logging.INFO):
+		"""Gets the lines the command has written to its output file since
+		this was last called, logs them, and adds them to the session's
+		output lines. The last line is held back until it is complete, unless
+		the command has finished.
+
+		@param max_bytes: Most bytes to get. Any more are left for the next
+		                  call, or skipped if latest is set.
+		@param latest:    If True, skip to the last max_bytes of the output.
+		@param loglevel:  Level to log the lines at, or None not to log them.
+
+		@return: List of new lines.
+		"""
+		if not self.sendspec.started:
+			return []
+		shutit_pexpect_session = self.sendspec.shutit_pexpect_child
+		start, data = self._read_output(self.output_offset, max_bytes, latest=latest)
+		if start is None:
+			return []
+		if start > self.output_offset:
+			self.shutit_obj.log('Skipped ' + str(start - self.output_offset) + ' bytes of output of background command: ' + self.sendspec.original_send, level=logging.DEBUG)
+			self.output_partial = b''
+		self.output_offset = start + len(data)
+		lines = (self.output_partial + data).split(b'\n')
+		self.output_partial = lines.pop()
+		if self.run_state != 'S' and len(data) < max_bytes:
+			self.output_complete = True
+			if self.output_partial:
+				lines.append(self.output_partial)
+				self.output_partial = b''
+		lines = [line.rstrip(b'\r').decode('utf-8', 'replace') for line in lines]
+		time_seen = time.time()
+		for line in lines:
+			if loglevel is not None:
+				self.shutit_obj.log('background task ' + self.name + ': ' + line, level=loglevel)
+			if shutit_global.shutit_global_object.pane_manager:
+				shutit_pexpect_session.session_output_lines.append(shutit_global.SessionPaneLine(line_str=line, time_seen=time_seen, line_type='output'))
+		return lines
+
+
+	def get_last_output(self, max_bytes=TAIL_MAX_BYTES):
+		"""Gets the last lines of the command's output file, without moving
+		on what tail_output gets next.
+
+		@param max_bytes: Most bytes to get, from the end of the file.
+
+		@return: List of lines.
+		"""
+		if not self.sendspec.started:
+			return []
+		_, data = self._read_output(0, max_bytes, latest=True)
+		if not data:
+			return []
+		return [line.rstrip(b'\r').decode('utf-8', 'replace') for line in data.rstrip(b'\n').split(b'\n')]
+
+
+	def _read_output(self, offset, max_bytes, latest=False):
+		"""Reads up to max_bytes of the command's output file.
+
+		@param offset:    Byte offset in the file to read from.
+		@param max_bytes: Most bytes to read.
+		@param latest:    If True, read from the last max_bytes of the file
+		                  instead, if that is further on than offset.
+
+		@return: Tuple of (offset read from, bytes read), or (None, None) if
+		         the file could not be read.
+		"""
+		shutit_pexpect_session = self.sendspec.shutit_pexpect_child
+		offset = str(offset)
+		# The output is base64-encoded so that the bytes got are exactly
+		# those in the file.
+		if latest:
+			start = 'SHUTIT_TAIL_START=$(( SHUTIT_TAIL_SIZE - ' + str(max_bytes) + ' )); [ $SHUTIT_TAIL_START -lt ' + offset + ' ] && SHUTIT_TAIL_START=' + offset + '; '
+		else:
+			start = 'SHUTIT_TAIL_START=' + offset + '; '
+		output = shutit_pexpect_session.send_and_get_output(' SHUTIT_TAIL_SIZE=$(command wc -c < ' + self.output_file + ' 2>/dev/null || echo 0); ' + start + 'echo "SHUTIT_TAIL""_OFFSET:${SHUTIT_TAIL_START}"; [ $SHUTIT_TAIL_SIZE -gt $SHUTIT_TAIL_START ] && command tail -c +$(( SHUTIT_TAIL_START + 1 )) ' + self.output_file + ' 2>/dev/null | command head -c ' + str(max_bytes) + ' | command base64; unset SHUTIT_TAIL_SIZE SHUTIT_TAIL_START',
+		                                                    echo=False,
+		                                                    record_command=False,
+		                                                    ignore_background=True,
+		                                                    loglevel=logging.DEBUG)
+		match = re.search('SHUTIT_TAIL_OFFSET:([0-9]+)\\s*(.*)$', output, re.DOTALL)
+		if match is None:
+			self.shutit_obj.log('Could not tail output of background command: ' + self.sendspec.original_send + ', got: ' + output, level=logging.DEBUG)
+			return None, None
+		# Anything else the shell printed, eg a job notice, is not base64.
+		return int(match.group(1)), base64.b64decode(''.join(line.strip() for line in match.group(2).splitlines() if BASE64_LINE.match(line.strip())))
+
+
+	def check_background_command_state(self, status=None):
+		"""Updates and returns the run state of the command, completing it
+		(or retrying it) if it has finished.
+
+		@param status: Tuple of (ps state, exit code) of the command, as got
+		               for all background commands at once by
+		               ShutItLoginStackItem.get_background_command_states.
+		               If None, they are got for this command alone.
+		"""
 		self.shutit_obj.log('CHECKING background task: ' + self.sendspec.send + ', id: ' + self.id,level=logging.DEBUG)
-		assert self.start_time is not None, shutit_util.print_debug()
 		# Check the command has been started
 		if not self.sendspec.started:
 			assert self.run_state == 'N', shutit_util.print_debug()
 			return self.run_state
+		assert self.start_time is not None, shutit_util.print_debug()
 		if self.run_state in ('C','F'):
 			assert self.sendspec.started, shutit_util.print_debug()
 			return self.run_state
@@ -109,7 +241,10 @@ class ShutItBackgroundCommand(object):
 			_, line, _, text = tb_info[-1]
 			shutit_global.shutit_global_object.shutit_print('An error occurred on line {} in statement {}'.format(line, text))
 		# Update the run state.
-		updated_run_state = self.sendspec.shutit_pexpect_child.send_and_get_output(""" command ps -o stat """ + self.pid + """ | command sed '1d' """, ignore_background=True)
+		if status is None:
+			updated_run_state = self.sendspec.shutit_pexpect_child.send_and_get_output(""" command ps -o stat """ + self.pid + """ | command sed '1d' """, ignore_background=True)
+		else:
+			updated_run_state = status[0]
 		# Ensure we get the first character only, if one exists.
 		if len(updated_run_state) > 0:
 			# Task is unfinished.
@@ -150,13 +285,17 @@ class ShutItBackgroundCommand(object):
 			self.shutit_obj.log('background task: ' + self.sendspec.send + ', id: ' + self.id + ' complete',level=logging.DEBUG)
 			# Stop this from blocking other commands from here.
 			assert self.return_value is None, shutit_util.print_debug(msg='check_background_command_state called with self.return_value already set?' + str(self))
-			self.sendspec.shutit_pexpect_child.quick_send(' wait ' + self.pid,loglevel=logging.DEBUG)
-			# Get the exit code.
-			self.return_value = self.sendspec.shutit_pexpect_child.send_and_get_output(' cat ' + self.exit_code_file, ignore_background=True)
+			if status is None:
+				self.sendspec.shutit_pexpect_child.quick_send(' wait ' + self.pid,loglevel=logging.DEBUG)
+				# Get the exit code.
+				self.return_value = self.sendspec.shutit_pexpect_child.send_and_get_output(' cat ' + self.exit_code_file, ignore_background=True)
+			else:
+				# Already waited for, and the exit code got, with the state.
+				self.return_value = status[1]
 			# If the return value is deemed a failure:
 			if self.return_value not in self.sendspec.exit_values:
 				self.shutit_obj.log('background task: ' + self.sendspec.send + ' failed with exit code: ' + self.return_value, level=logging.DEBUG)
-				self.shutit_obj.log('background task: ' + self.sendspec.send + ' failed with output: ' + self.sendspec.shutit_pexpect_child.send_and_get_output(' cat ' + self.output_file, ignore_background=True), level=logging.DEBUG)
+				self.shutit_obj.log('background task: ' + self.sendspec.send + ' failed with output: ' + '\n'.join(self.get_last_output()), level=logging.DEBUG)
 				if self.retry > 0:
 					self.shutit_obj.log('background task: ' + self.sendspec.send + ' retrying',level=logging.DEBUG)
 					self.retry -= 1
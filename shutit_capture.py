@@ -0,0 +1,167 @@
+r"""Represents the captured output of a ShutIt command.
+
+When a send is made with capture_tail set (see ShutItSendSpec), the output
+is written to a file as it arrives and only the tail is kept in memory.
+This object is the handle on that output.
+"""
+
+from __future__ import print_function
+import os
+import re
+import shutit_global
+
+
+# Terminal control codes, eg colours and bracketed paste mode switches.
+ANSI_ESCAPE = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]')
+
+# Most of an unfinished line held back before it is written anyway, less the
+# last few characters, which may be the start of a control code.
+PARTIAL_MAX  = 65536
+PARTIAL_KEEP = 64
+
+
+class ShutItCapture(object):
+	"""Captured output of a command, spilled to a file in shutit_state_dir.
+	As with send_and_get_output, the echoed command and terminal control
+	codes are dropped, so the file holds only the command's output lines.
+	"""
+	def __init__(self,
+	             path,
+	             tail_size,
+	             command=None):
+		"""
+		@param path:      File to write the output to.
+		@param tail_size: Number of characters of output to keep in memory.
+		@param command:   The command sent, which is dropped from the start
+		                  of the output if echoed there.
+		"""
+		self.path                   = path
+		self.tail_size              = tail_size
+		self.command                = command.strip() if command else None
+		self.size                   = 0
+		self.tail_str               = ''
+		# The last line written, until it is complete.
+		self.partial                = ''
+		self.encoding               = shutit_global.shutit_global_object.default_encoding
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		self.capture_file           = open(path, 'wb')
+
+
+	def __str__(self):
+		string = '\n---- Capture object BEGIN ----'
+		string += '| path: ' + str(self.path)
+		string += '| size: ' + str(self.size)
+		string += '| tail_size: ' + str(self.tail_size)
+		string += '|---- Capture object END ----'
+		return string
+
+
+	def write(self, data):
+		"""Appends output to the capture file, keeping the tail in memory.
+		Output is cleaned up and written up to the last complete line, so
+		that no control code is split.
+		"""
+		if not data:
+			return
+		if isinstance(data, bytes):
+			data = data.decode(self.encoding, 'replace')
+		data = self.partial + data
+		end = data.rfind('\n') + 1
+		if len(data) - end > PARTIAL_MAX:
+			end = len(data) - PARTIAL_KEEP
+		self.partial = data[end:]
+		self._write_lines(data[:end])
+
+
+	def close(self):
+		"""Finishes writing to the capture file.
+		"""
+		if not self.capture_file.closed:
+			# What follows the last newline is usually only the control codes
+			# before the prompt, which are dropped, but may be a final line.
+			if ANSI_ESCAPE.sub('', self.partial).replace('\r','').strip():
+				self._write_lines(self.partial + '\n')
+			self.partial = ''
+			self.capture_file.close()
+
+
+	def _write_lines(self, data):
+		"""Cleans up whole lines of terminal output and writes them to the
+		file, dropping the echoed command.
+		"""
+		data = ANSI_ESCAPE.sub('', data)
+		while self.command is not None and data:
+			line, _, rest = data.partition('\n')
+			# Long commands are wrapped by the terminal with ' \r'.
+			echoed = line.replace(' \r','').replace('\r','').strip()
+			if echoed == '':
+				data = rest
+				continue
+			if echoed == self.command:
+				data = rest
+			self.command = None
+		data = data.replace('\r','')
+		if not data:
+			return
+		self.tail_str = (self.tail_str + data)[-self.tail_size:]
+		data = data.encode(self.encoding)
+		self.size += len(data)
+		self.capture_file.write(data)
+
+
+	def _lines(self):
+		"""Yields the captured lines one at a time, without line endings.
+		"""
+		if not self.capture_file.closed:
+			self.capture_file.flush()
+		with open(self.path, 'rb') as capture_file:
+			for line in capture_file:
+				yield line.decode(self.encoding, 'replace').rstrip('\r\n')
+
+
+	def head(self, n=10):
+		"""Returns the first n lines of output.
+
+		@rtype: list of strings
+		"""
+		lines = []
+		for line in self._lines():
+			if len(lines) == n:
+				break
+			lines.append(line)
+		return lines
+
+
+	def tail(self, n=10):
+		"""Returns the last n lines of output, reading backwards from the end
+		of the capture file.
+
+		@rtype: list of strings
+		"""
+		if not self.capture_file.closed:
+			self.capture_file.flush()
+		block_size = 4096
+		data = b''
+		with open(self.path, 'rb') as capture_file:
+			capture_file.seek(0, os.SEEK_END)
+			pos = capture_file.tell()
+			# Read one more line than needed, as the first may be partial.
+			while pos > 0 and data.count(b'\n') <= n:
+				read_size = min(block_size, pos)
+				pos -= read_size
+				capture_file.seek(pos)
+				data = capture_file.read(read_size) + data
+		lines = [line.rstrip('\r') for line in data.decode(self.encoding, 'replace').split('\n')]
+		if lines and lines[-1] == '':
+			lines = lines[:-1]
+		return lines[-n:] if n > 0 else []
+
+
+	def grep(self, regexp):
+		"""Returns the lines of output that match the regexp.
+
+		@rtype: list of strings
+		"""
+		compiled = re.compile(regexp)
+		return [line for line in self._lines() if compiled.search(line)]
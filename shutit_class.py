@@ -11,7 +11,6 @@ except ImportError: # pragma: no cover
 	from io import StringIO
 import argparse
 import base64
-import codecs
 import getpass
 import glob
 import hashlib
@@ -20,7 +19,6 @@ import json
 import logging
 import operator
 import os
-import tarfile
 import re
 import readline
 import string
@@ -34,7 +32,9 @@ import shutit
 import shutit_util
 import shutit_global
 import shutit_skeleton
+import shutit_transfer
 import shutit_exam
+import shutit_matcher
 try:
 	import ConfigParser
 except ImportError: # pragma: no cover
@@ -42,6 +42,7 @@ except ImportError: # pragma: no cover
 from shutit_sendspec import ShutItSendSpec
 from shutit_module import ShutItFailException, ShutItModule
 from shutit_pexpect_session import ShutItPexpectSession
+from shutit_docker_transfer import ShutItDockerTransfer
 
 
 # https://stackoverflow.com/questions/2183233/how-to-add-a-custom-loglevel-to-pythons-logging-facility/35804945
@@ -838,6 +839,8 @@ class ShutIt(object):
 	         background=False,
 	         wait=True,
 	         block_other_commands=True,
+	         background_id=None,
+	         depends_on=None,
 	         loglevel=logging.INFO):
 		"""Send string as a shell command, and wait until the expected output
 		is seen (either a string or any from a list of strings) before
@@ -862,6 +865,8 @@ class ShutIt(object):
 		@param assume_gnu: See shutit.ShutItSendSpec
 		@param wait: See shutit.ShutItSendSpec
 		@param block_other_commands: See shutit.ShutItSendSpec.block_other_commands
+		@param background_id: See shutit.ShutItSendSpec
+		@param depends_on: See shutit.ShutItSendSpec
 		@return: The pexpect return value (ie which expected string in the list matched)
 		@rtype: string
 		"""
@@ -891,7 +896,129 @@ class ShutIt(object):
 		                                                  nonewline=nonewline,
 		                                                  run_in_background=background,
 		                                                  ignore_background=ignore_background,
-		                                                  block_other_commands=block_other_commands))
+		                                                  block_other_commands=block_other_commands,
+		                                                  background_id=background_id,
+		                                                  depends_on=depends_on))
+
+
+	def send_and_capture(self,
+	                     send,
+	                     capture_tail=100000,
+	                     expect=None,
+	                     shutit_pexpect_child=None,
+	                     timeout=None,
+	                     check_exit=None,
+	                     record_command=True,
+	                     exit_values=None,
+	                     echo=None,
+	                     retry=3,
+	                     note=None,
+	                     loglevel=logging.INFO):
+		"""Sends a command, writing its output to a file in shutit_state_dir
+		as it arrives and keeping only the tail in memory. Use this for
+		commands with very large output.
+
+		@param capture_tail: Number of characters of output to keep in memory.
+		                     See shutit.ShutItSendSpec
+		@param send:         See send()
+		@param expect:       See send()
+		@param shutit_pexpect_child: See send()
+		@param timeout:      See send()
+		@param check_exit:   See send()
+		@param record_command: See send()
+		@param exit_values:  See send()
+		@param echo:         See send()
+		@param retry:        See send()
+		@param note:         See send()
+		@return: Handle on the captured output, supporting head, tail and grep.
+		@rtype: shutit_capture.ShutItCapture
+		"""
+		shutit_global.shutit_global_object.yield_to_draw()
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		sendspec = ShutItSendSpec(shutit_pexpect_session,
+		                          send=send,
+		                          expect=expect,
+		                          timeout=timeout,
+		                          check_exit=check_exit,
+		                          record_command=record_command,
+		                          exit_values=exit_values,
+		                          echo=echo,
+		                          retry=retry,
+		                          note=note,
+		                          capture_tail=capture_tail,
+		                          loglevel=loglevel)
+		shutit_pexpect_session.send(sendspec)
+		return sendspec.capture
+
+
+	def send_and_stream(self,
+	                    send,
+	                    shutit_pexpect_child=None,
+	                    timeout=None,
+	                    strip=True,
+	                    note=None,
+	                    record_command=True,
+	                    echo=None,
+	                    loglevel=logging.INFO):
+		"""Sends a command and returns an iterator of its output lines, yielded
+		as they arrive. Any output not read is dropped when the iterator is
+		closed or the next command is sent.
+		See ShutItPexpectSession.send_and_stream
+
+		@param send:                 See send()
+		@param shutit_pexpect_child: See send()
+		@param timeout:              Timeout waiting for each line. See send()
+		@param strip:                Whether to strip each line of whitespace and ansi terminal codes
+		@param note:                 See send()
+		@param record_command:       See send()
+		@param echo:                 See send()
+		@rtype: iterator of strings
+		"""
+		shutit_global.shutit_global_object.yield_to_draw()
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.send_and_stream(send,
+		                                              timeout=timeout,
+		                                              strip=strip,
+		                                              note=note,
+		                                              record_command=record_command,
+		                                              echo=echo,
+		                                              loglevel=loglevel)
+
+
+	def send_batch(self,
+	               sends,
+	               shutit_pexpect_child=None,
+	               check_exit=None,
+	               timeout=None,
+	               echo=None,
+	               note=None,
+	               retbool=False,
+	               loglevel=logging.INFO):
+		"""Sends a list of commands in one go, waiting for only one prompt.
+		See ShutItPexpectSession.send_batch
+
+		@param sends:                List of commands (strings or ShutItSendSpec objects)
+		@param shutit_pexpect_child: See send()
+		@param check_exit:           See send()
+		@param timeout:              Timeout for the whole batch. See send()
+		@param echo:                 See send()
+		@param note:                 See send()
+		@param retbool:              If True, return on failure rather than pausing or failing.
+		@return: (exit code, output) for each command run, in order.
+		@rtype: list of tuples
+		"""
+		shutit_global.shutit_global_object.yield_to_draw()
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.send_batch(sends,
+		                                         check_exit=check_exit,
+		                                         timeout=timeout,
+		                                         echo=echo,
+		                                         note=note,
+		                                         retbool=retbool,
+		                                         loglevel=loglevel)
 
 
 	def send_and_return_status(self,
@@ -1038,7 +1165,8 @@ class ShutIt(object):
 	               in_shell=True,
 	               echo=None,
 	               note=None,
-	               loglevel=logging.DEBUG):
+	               loglevel=logging.DEBUG,
+	               store=False):
 		"""Run the passed-in string as a script on the target's command line.
 
 		@param script:   String representing the script. It will be de-indented
@@ -1046,6 +1174,7 @@ class ShutIt(object):
 		@param shutit_pexpect_child:    See send()
 		@param in_shell: Indicate whether we are in a shell or not. (Default: True)
 		@param note:     See send()
+		@param store:    See send_file()
 
 		@type script:    string
 		@type in_shell:  boolean
@@ -1057,6 +1186,7 @@ class ShutIt(object):
 		                                         in_shell=in_shell,
 		                                         echo=echo,
 		                                         note=note,
+		                                         store=store,
 		                                         loglevel=loglevel)
 
 
@@ -1070,16 +1200,31 @@ class ShutIt(object):
 	              echo=False,
 	              group=None,
 	              loglevel=logging.INFO,
-	              encoding=None):
+	              encoding=None,
+	              compression=None,
+	              sync=False,
+	              store=False):
 		"""Sends the passed-in string as a file to the passed-in path on the
 		target.
 
 		@param path:        Target location of file on target.
-		@param contents:    Contents of file as a string.
+		@param contents:    Contents of file as a string, or a file object
+		                    opened for reading bytes.
 		@param shutit_pexpect_child:       See send()
 		@param note:        See send()
 		@param user:        Set ownership to this user (defaults to whoami)
 		@param group:       Set group to this user (defaults to first group in groups)
+		@param compression: Compression to use for the transfer: 'gzip', 'xz'
+		                    or 'zstd', False for none, or None (default) to
+		                    use the best available at both ends if the
+		                    contents compress well.
+		@param sync:        If True, send nothing if the file on the target
+		                    already has these contents. For large files,
+		                    send only the blocks that differ.
+		@param store:       If True, keep the file in a store on the target,
+		                    keyed by its contents, and copy it from there
+		                    rather than send it again, in this build or later
+		                    ones. For files sent repeatedly.
 
 		@type path:         string
 		@type contents:     string
@@ -1095,7 +1240,10 @@ class ShutIt(object):
 		                                        user=user,
 		                                        group=group,
 		                                        loglevel=loglevel,
-		                                        encoding=encoding)
+		                                        encoding=encoding,
+		                                        compression=compression,
+		                                        sync=sync,
+		                                        store=store)
 
 
 	def chdir(self,
@@ -1125,7 +1273,10 @@ class ShutIt(object):
 	                   note=None,
 	                   user=None,
 	                   group=None,
-	                   loglevel=logging.INFO):
+	                   loglevel=logging.INFO,
+	                   compression=None,
+	                   sync=False,
+	                   store=False):
 		"""Send file from host machine to given path
 
 		@param path:          Path to send file to.
@@ -1135,6 +1286,9 @@ class ShutIt(object):
 		@param note:          See send()
 		@param user:          Set ownership to this user (defaults to whoami)
 		@param group:         Set group to this user (defaults to first group in groups)
+		@param compression:   See send_file()
+		@param sync:          See send_file()
+		@param store:         See send_file()
 
 		@type path:           string
 		@type hostfilepath:   string
@@ -1149,14 +1303,17 @@ class ShutIt(object):
 			user = shutit_pexpect_session.whoami()
 		if group is None:
 			group = self.whoarewe()
-		# TODO: use gz for both
 		if os.path.isfile(hostfilepath):
-			shutit_pexpect_session.send_file(path,
-			                                 codecs.open(hostfilepath,mode='rb',encoding='iso-8859-1').read(),
-			                                 user=user,
-			                                 group=group,
-			                                 loglevel=loglevel,
-			                                 encoding='iso-8859-1')
+			# Streamed from the file, rather than read into memory.
+			with open(hostfilepath, 'rb') as hostfile:
+				shutit_pexpect_session.send_file(path,
+				                                 hostfile,
+				                                 user=user,
+				                                 group=group,
+				                                 loglevel=loglevel,
+				                                 compression=compression,
+				                                 sync=sync,
+				                                 store=store)
 		elif os.path.isdir(hostfilepath):
 			# Need a binary type encoding for gzip(?)
 			self.send_host_dir(path,
@@ -1178,17 +1335,29 @@ class ShutIt(object):
 	                  note=None,
 	                  user=None,
 	                  group=None,
-	                  loglevel=logging.DEBUG):
+	                  loglevel=logging.DEBUG,
+	                  include=None,
+	                  exclude=None,
+	                  compression=None):
 		"""Send directory and all contents recursively from host machine to
 		given path.  It will automatically make directories on the target.
 
+		The directory is streamed as a tar as it is read, so it is never all
+		held in memory or written out on the host.
+
 		@param path:          Path to send directory to (places hostfilepath inside path as a subfolder)
 		@param hostfilepath:  Path to file from host to send to target
 		@param expect:        See send()
 		@param shutit_pexpect_child:         See send()
 		@param note:          See send()
-		@param user:          Set ownership to this user (defaults to whoami)
-		@param group:         Set group to this user (defaults to first group in groups)
+		@param user:          Set ownership to this user (defaults to the user extracting)
+		@param group:         Set group to this group (defaults to the user's group)
+		@param include:       List of glob patterns. If given, only files whose
+		                      path (relative to hostfilepath) or name matches
+		                      one of them are sent.
+		@param exclude:       List of glob patterns. Files and directories whose
+		                      path or name matches one of them are not sent.
+		@param compression:   See send_file()
 
 		@type path:          string
 		@type hostfilepath:  string
@@ -1199,55 +1368,64 @@ class ShutIt(object):
 		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
 		self.handle_note(note, 'Sending host directory: ' + hostfilepath + ' to target path: ' + path)
 		self.log('Sending host directory: ' + hostfilepath + ' to: ' + path, level=logging.INFO)
-		shutit_pexpect_session.send(ShutItSendSpec(shutit_pexpect_session,
-		                                           send=' command mkdir -p ' + path,
-		                                           echo=False,
-		                                           loglevel=loglevel))
-		if user is None:
-			user = shutit_pexpect_session.whoami()
-		if group is None:
-			group = self.whoarewe()
-		# Create gzip of folder
-		#import pdb
-		#pdb.set_trace()
-		if shutit_pexpect_session.command_available('tar'):
-			gzipfname = '/tmp/shutit_tar_tmp.tar.gz'
-			with tarfile.open(gzipfname, 'w:gz') as tar:
-				tar.add(hostfilepath, arcname=os.path.basename(hostfilepath))
-			shutit_pexpect_session.send_file(gzipfname,
-			                                 codecs.open(gzipfname,mode='rb',encoding='iso-8859-1').read(),
-			                                 user=user,
-			                                 group=group,
-			                                 loglevel=loglevel,
-			                                 encoding='iso-8859-1')
+		dirname = os.path.basename(os.path.normpath(hostfilepath))
+		chown = ''
+		if user is not None or group is not None:
+			chown = ' && command chown -R ' + (user or shutit_pexpect_session.whoami()) + ':' + (group or shutit_pexpect_session.whoarewe()) + ' ' + path + '/' + dirname
+		if self.build['delivery'] == 'docker' and shutit_pexpect_session.pexpect_session_id == 'target_child':
+			# All in one go into the container, with docker on the host.
+			docker_transfer = ShutItDockerTransfer(shutit_pexpect_session, loglevel=loglevel)
+			docker_transfer.add_host_path(path + '/' + dirname, hostfilepath, user=user, group=group)
+			for relpath, _ in shutit_transfer.walk_host_dir(hostfilepath, include=include, exclude=exclude):
+				docker_transfer.add_host_path(path + '/' + dirname + '/' + relpath, os.path.join(hostfilepath, relpath), user=user, group=group)
+			docker_transfer.send()
+		elif shutit_pexpect_session.command_available('tar'):
+			# Unique, so concurrent builds do not collide.
+			tmp_path = shutit_global.shutit_global_object.shutit_state_dir + '/send_host_dir_' + shutit_util.random_id() + '.tar'
+			shutit_pexpect_session.send(ShutItSendSpec(shutit_pexpect_session,
+			                                           send=' command mkdir -p ' + path + ' ' + shutit_global.shutit_global_object.shutit_state_dir,
+			                                           echo=False,
+			                                           loglevel=loglevel))
+			tar_stream, errors = shutit_transfer.open_tar_stream(hostfilepath, include=include, exclude=exclude)
+			try:
+				shutit_pexpect_session.send_file(tmp_path,
+				                                 tar_stream,
+				                                 loglevel=loglevel,
+				                                 compression=compression)
+			finally:
+				tar_stream.close()
+			if errors:
+				self.fail('Failed to read ' + hostfilepath + ' to send it: ' + str(errors[0])) # pragma: no cover
 			shutit_pexpect_session.send(ShutItSendSpec(shutit_pexpect_session,
-			                                           send=' command mkdir -p ' + path + ' && command tar -C ' + path + ' -zxf ' + gzipfname))
+			                                           send=' command tar -C ' + path + ' -xf ' + tmp_path + chown + ' && command rm -f ' + tmp_path,
+			                                           echo=False,
+			                                           loglevel=loglevel))
 		else:
-			# If no gunzip, fall back to old slow method.
-			for root, subfolders, files in os.walk(hostfilepath):
-				subfolders.sort()
-				files.sort()
-				for subfolder in subfolders:
-					shutit_pexpect_session.send(ShutItSendSpec(shutit_pexpect_session,
-					                                           send=' command mkdir -p ' + path + '/' + subfolder,
-					                                           echo=False,
-					                                           loglevel=loglevel))
-					self.log('send_host_dir recursing to: ' + hostfilepath + '/' + subfolder, level=logging.DEBUG)
-					self.send_host_dir(path + '/' + subfolder,
-					                   hostfilepath + '/' + subfolder,
-					                   expect=expect,
-					                   shutit_pexpect_child=shutit_pexpect_child,
-					                   loglevel=loglevel)
-				for fname in files:
-					hostfullfname = os.path.join(root, fname)
-					targetfname = os.path.join(path, fname)
-					self.log('send_host_dir sending file ' + hostfullfname + ' to ' + 'target file: ' + targetfname, level=logging.DEBUG)
-					shutit_pexpect_session.send_file(targetfname,
-					                                 codecs.open(hostfullfname,mode='rb',encoding='iso-8859-1').read(),
-					                                 user=user,
-					                                 group=group,
+			# No tar on the target, so make the directories in one go, then
+			# send the files one by one.
+			dirs  = [path + '/' + dirname]
+			files = []
+			for relpath, directory in shutit_transfer.walk_host_dir(hostfilepath, include=include, exclude=exclude):
+				if directory:
+					dirs.append(path + '/' + dirname + '/' + relpath)
+				else:
+					files.append(relpath)
+			shutit_pexpect_session.send(ShutItSendSpec(shutit_pexpect_session,
+			                                           send=' command mkdir -p ' + ' '.join(dirs),
+			                                           echo=False,
+			                                           loglevel=loglevel))
+			for relpath in files:
+				self.log('send_host_dir sending file ' + hostfilepath + '/' + relpath + ' to ' + 'target file: ' + path + '/' + dirname + '/' + relpath, level=logging.DEBUG)
+				with open(os.path.join(hostfilepath, relpath), 'rb') as host_file:
+					shutit_pexpect_session.send_file(path + '/' + dirname + '/' + relpath,
+					                                 host_file,
 					                                 loglevel=loglevel,
-					                                 encoding='iso-8859-1')
+					                                 compression=compression)
+			if chown:
+				shutit_pexpect_session.send(ShutItSendSpec(shutit_pexpect_session,
+				                                           send=' true' + chown,
+				                                           echo=False,
+				                                           loglevel=loglevel))
 		self.handle_note_after(note=note)
 		return True
 
@@ -1676,37 +1854,45 @@ class ShutIt(object):
 	             target_path,
 	             host_path,
 	             note=None,
-	             loglevel=logging.DEBUG):
-		"""Copy a file from the target machine to the host machine in docker. DEPRECATED
+	             loglevel=logging.DEBUG,
+	             shutit_pexpect_child=None,
+	             compression=None):
+		"""Copy a file from the target machine to the host machine.
+
+		The file is streamed to the host and checked, so it is never all held
+		in memory.
 
 		@param target_path: path to file in the target
-		@param host_path:   path to file on the host machine (e.g. copy test)
+		@param host_path:   path to file on the host machine (e.g. copy test).
+		                    If a directory, the file is copied into it.
+		@param shutit_pexpect_child:       Session to get the file from. By
+		                    default, the container for delivery=docker
+		                    (whichever session is current), else the current
+		                    session.
 		@param note:        See send()
+		@param compression: Compression to use on the target for the
+		                    transfer: 'gzip', 'xz' or 'zstd', False for none,
+		                    or None (default) to use the best available at
+		                    both ends.
 
 		@type target_path: string
 		@type host_path:   string
 
-		@return:           boolean
+		@return:           the path of the file on the host, or False if it
+		                   could not be got.
 		@rtype:            string
 		"""
 		shutit_global.shutit_global_object.yield_to_draw()
-		self.handle_note(note)
-		# Only handle for docker initially, return false in case we care
-		if self.build['delivery'] != 'docker':
-			return False
-		# on the host, run:
-		#Usage:  docker cp [OPTIONS] CONTAINER:PATH LOCALPATH|-
-		# Need: host env, container id, path from and path to
-		shutit_pexpect_child     = self.get_shutit_pexpect_session_from_id('host_child').pexpect_child
-		expect    = self.expect_prompts['ORIGIN_ENV']
-		self.send('docker cp ' + self.target['container_id'] + ':' + target_path + ' ' + host_path,
-		          shutit_pexpect_child=shutit_pexpect_child,
-		          expect=expect,
-		          check_exit=False,
-		          echo=False,
-		          loglevel=loglevel)
-		self.handle_note_after(note=note)
-		return True
+		if shutit_pexpect_child is None and self.build['delivery'] == 'docker':
+			shutit_pexpect_session = self.get_shutit_pexpect_session_from_id('target_child')
+		else:
+			shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+			shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.get_file(target_path,
+		                                       host_path,
+		                                       note=note,
+		                                       loglevel=loglevel,
+		                                       compression=compression)
 
 
 	def prompt_cfg(self, msg, sec, name, ispass=False):
@@ -2195,10 +2381,57 @@ class ShutIt(object):
 	exit_shell = logout
 
 
-	def wait(self, cadence=2):
+	def wait(self, cadence=2, tail_output=False):
 		shutit_global.shutit_global_object.yield_to_draw()
 		shutit_pexpect_session = self.get_current_shutit_pexpect_session()
-		return shutit_pexpect_session.wait(cadence=cadence)
+		return shutit_pexpect_session.wait(cadence=cadence, tail_output=tail_output)
+
+
+	def set_background_workers(self, max_workers, shutit_pexpect_child=None):
+		"""Limits how many background commands run at once in the current
+		login. Others are queued, and started in order as running ones finish.
+		Send them with block_other_commands=False, or they run one at a time
+		anyway.
+
+		@param max_workers:          Most to run at once, or None for no limit.
+		@param shutit_pexpect_child: See send()
+		"""
+		shutit_global.shutit_global_object.yield_to_draw()
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.set_background_workers(max_workers)
+
+
+	def get_background_progress(self, shutit_pexpect_child=None):
+		"""Returns the number of background commands in the current login in
+		each state.
+
+		@param shutit_pexpect_child: See send()
+		@return: dict with keys queued, running, complete, failed, timed_out
+		         and total.
+		"""
+		shutit_global.shutit_global_object.yield_to_draw()
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.get_background_progress()
+
+
+	def tail_background_output(self, shutit_pexpect_child=None, loglevel=logging.INFO):
+		"""Logs the output background commands in the current login have
+		written since this was last called, and adds it to the session's
+		output lines. Only new output is got from the target, and long output
+		in chunks, so this can be called often while long commands run. Lines
+		are held back until complete.
+
+		@param shutit_pexpect_child: See send()
+		@param loglevel:             Level to log the lines at.
+		@return: dict of lists of new lines by background command name (see
+		         background_id in send()).
+		"""
+		shutit_global.shutit_global_object.yield_to_draw()
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.tail_background_output(loglevel=loglevel)
 
 
 
@@ -2720,6 +2953,21 @@ class ShutIt(object):
 		return shutit_pexpect_session.check_sudo()
 
 
+	def invalidate_facts(self, shutit_pexpect_child=None, all_sessions=False):
+		"""Forgets the cached results of whoami, whoarewe, command_available,
+		check_sudo and file_exists for the current environment. Call this after
+		changing the environment in a way ShutIt cannot see (eg editing PATH).
+
+		@param shutit_pexpect_child: See send()
+		@param all_sessions:         Forget the results cached by other sessions
+		                             in the same environment also.
+		"""
+		shutit_global.shutit_global_object.yield_to_draw()
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		shutit_pexpect_session.invalidate_facts(all_sessions=all_sessions)
+
+
 	def get_sudo_pass_if_needed(self, shutit, ignore_brew=False):
 		shutit_global.shutit_global_object.yield_to_draw()
 		shutit_pexpect_session = self.get_current_shutit_pexpect_session()
@@ -2760,6 +3008,9 @@ class ShutIt(object):
 			s += '# Nothing to report\n'
 		if 'container_id' in self.target:
 			s += '# CONTAINER_ID: ' + self.target['container_id'] + '\n'
+		for environment in shutit_global.shutit_global_object.shutit_pexpect_session_environments:
+			if environment.facts_hits or environment.facts_misses:
+				s += '# FACT CACHE: environment ' + environment.environment_id + ': ' + str(environment.facts_hits) + ' hits, ' + str(environment.facts_misses) + ' misses\n'
 		s += '# BUILD REPORT FOR BUILD END ' + shutit_global.shutit_global_object.build_id + '\n'
 		s += '###############################################################################\n'
 		s += '# INVOKING COMMAND WAS: ' + sys.executable
@@ -2789,24 +3040,20 @@ class ShutIt(object):
 		shutit_global.shutit_global_object.yield_to_draw()
 		if not isinstance(string_to_match, str):
 			return None
-		lines = string_to_match.split('\r\n')
-		# sometimes they're separated by just a carriage return...
-		new_lines = []
-		for line in lines:
-			new_lines = new_lines + line.split('\r')
-		# and sometimes they're separated by just a newline...
-		for line in lines:
-			new_lines = new_lines + line.split('\n')
-		lines = new_lines
-		if not shutit_util.check_regexp(regexp):
-			self.fail('Illegal regexp found in match_string call: ' + regexp) # pragma: no cover
-		for line in lines:
-			match = re.match(regexp, line)
-			if match is not None:
-				if match.groups():
-					return match.group(1)
-				return True
-		return None
+		return self.get_line_matcher(regexp, 'match_string').match(string_to_match)
+
+
+	def get_line_matcher(self, regexps, caller='get_line_matcher'):
+		"""Returns a (cached) ShutItLineMatcher for the regexps, failing if any
+		of them is illegal. See shutit_matcher.
+
+		@param regexps: Regexp string, or list of them.
+		@param caller:  Name of the calling function, for the failure message.
+		"""
+		try:
+			return shutit_matcher.get_line_matcher(regexps)
+		except re.error:
+			self.fail('Illegal regexp found in ' + caller + ' call: ' + str(regexps)) # pragma: no cover
 
 
 	def module_ids(self, rev=False):
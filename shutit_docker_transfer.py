@@ -0,0 +1,331 @@
+r"""Represents a ShutIt transfer of files into a docker container.
+
+For delivery=docker, files are sent (and got) with docker on the host rather
+than through the terminal of the target. Any number of files go as one tar,
+streamed to a single 'docker exec' that extracts them and sets their
+ownership. If the container has no tar, 'docker cp' extracts the tar, and a
+second 'docker exec' does the rest.
+
+Files sent as contents (see add()) are extracted to a staging directory, and
+written over their paths with cat, as the terminal transfer does. So they
+are written through symlinks and hard links, and existing files keep their
+permissions and ownership.
+"""
+
+from __future__ import print_function
+import io
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import time
+try:
+	from shlex import quote
+except ImportError: # pragma: no cover
+	from pipes import quote
+import shutit_global
+import shutit_util
+
+
+class ShutItDockerTransfer(object):
+	"""Sends files into the target container of a ShutItPexpectSession.
+	Add files with add() and add_host_path(), then send them all with send().
+	"""
+	def __init__(self,
+	             shutit_pexpect_session,
+	             loglevel=logging.DEBUG):
+		"""
+		@param shutit_pexpect_session: Session on the container, used to
+		                               resolve relative paths and check for tar.
+		"""
+		self.shutit_pexpect_session = shutit_pexpect_session
+		self.shutit                 = shutit_pexpect_session.shutit
+		self.docker                 = self.shutit.host['docker_executable'].split(' ')
+		self.container_id           = self.shutit.target['container_id']
+		self.loglevel               = loglevel
+		# Tuples of (tarinfo, source, hostfilepath), in the order they go in the tar.
+		self.members                = []
+		# Paths by (user, group) to chown.
+		self.owners                 = {}
+		# Where files added as contents are extracted to, and the tuples of
+		# (staged path, path, mode, owner) to write them over their paths
+		# with. The mode and owner are only set if the file is new.
+		self.staging_dir            = '/tmp/shutit_docker_transfer_' + shutit_util.random_id()
+		self.staged                 = []
+		self.size                   = 0
+		self.elapsed                = None
+
+
+	def __str__(self):
+		string = '\n---- Docker transfer object BEGIN ----'
+		string += '| container_id: ' + str(self.container_id)
+		string += '| members: ' + str([member[0].name for member in self.members])
+		string += '| size: ' + str(self.size)
+		string += '| elapsed: ' + str(self.elapsed)
+		string += '|---- Docker transfer object END ----'
+		return string
+
+
+	def add(self,
+	        path,
+	        source,
+	        user=None,
+	        group=None,
+	        mode=None,
+	        keep_owner=False):
+		"""Adds contents to send to a file in the container.
+
+		@param path:   Path in the container. Relative paths are relative to
+		               the home directory of the container's user.
+		@param source: Contents as bytes, or a file object opened for reading
+		               bytes. Unseekable file objects are spooled to disk
+		               first, to find their size.
+		@param user:   Set ownership to this user.
+		@param group:  Set group to this group.
+		@param mode:   Permissions of the file if it is new. If None, it is
+		               made as the terminal transfer makes it (see the
+		               container's umask). Existing files keep theirs.
+		@param keep_owner: If True, an existing file keeps its ownership, and
+		               user and group only apply to a new one.
+		"""
+		if isinstance(source, bytes):
+			source = io.BytesIO(source)
+		try:
+			position = source.tell()
+			source.seek(0, os.SEEK_END)
+			size = source.tell() - position
+			source.seek(position)
+		except (AttributeError, IOError, OSError, ValueError):
+			spool = tempfile.TemporaryFile()
+			while True:
+				data = source.read(65536)
+				if not data:
+					break
+				spool.write(data)
+			size = spool.tell()
+			spool.seek(0)
+			source = spool
+		if path[0] != '/':
+			path = self._get_home() + '/' + path
+		if not self.staged:
+			self.members.append((self._get_tarinfo(self.staging_dir, tarfile.DIRTYPE, 0o700), None, None))
+		staged_path  = self.staging_dir + '/' + str(len(self.staged))
+		tarinfo      = self._get_tarinfo(staged_path, tarfile.REGTYPE, 0o600)
+		tarinfo.size = size
+		self.members.append((tarinfo, source, None))
+		if keep_owner:
+			owner = self._get_owner(user, group)
+		else:
+			owner = None
+			self._add_owner(path, user, group)
+		self.staged.append((staged_path, path, mode, owner))
+
+
+	def add_host_path(self,
+	                  path,
+	                  hostfilepath,
+	                  user=None,
+	                  group=None):
+		"""Adds a file or directory on the host to send to the container. Files
+		are not opened until they are sent. Directories are added without
+		their contents.
+
+		@param path:         Path in the container. See add()
+		@param hostfilepath: Path on the host.
+		@param user:         See add()
+		@param group:        See add()
+		"""
+		host_stat = os.stat(hostfilepath)
+		if stat.S_ISDIR(host_stat.st_mode):
+			tarinfo = self._get_tarinfo(path, tarfile.DIRTYPE, stat.S_IMODE(host_stat.st_mode))
+		else:
+			tarinfo      = self._get_tarinfo(path, tarfile.REGTYPE, stat.S_IMODE(host_stat.st_mode))
+			tarinfo.size = host_stat.st_size
+		self.members.append((tarinfo, None, hostfilepath))
+		self._add_owner(path, user, group)
+
+
+	def _get_tarinfo(self, path, member_type, mode):
+		"""Returns a TarInfo for a path in the container, owned by root, as
+		ownership is set after extraction.
+		"""
+		if path[0] != '/':
+			path = self._get_home() + '/' + path
+		tarinfo       = tarfile.TarInfo(os.path.normpath(path).lstrip('/'))
+		tarinfo.type  = member_type
+		tarinfo.mode  = mode
+		tarinfo.mtime = time.time()
+		return tarinfo
+
+
+	def _add_owner(self, path, user, group):
+		if user is None and group is None:
+			return
+		if path[0] != '/':
+			path = self._get_home() + '/' + path
+		self.owners.setdefault((user or '', group or ''), []).append(path)
+
+
+	def _get_home(self):
+		"""Returns the home directory of the container's user, which the
+		terminal-based transfer resolves relative paths against. Cached per
+		environment.
+		"""
+		shutit_pexpect_session = self.shutit_pexpect_session
+		found, home = shutit_pexpect_session._get_fact(('docker_home',))
+		if not found:
+			home = self._run(['sh', '-c', 'echo $HOME']).strip().rstrip('/')
+			shutit_pexpect_session._set_fact(('docker_home',), home)
+		return home
+
+
+	def _get_staged_command(self):
+		"""Returns a command to write the staged files over their paths, then
+		remove them, or ''.
+		"""
+		if not self.staged:
+			return ''
+		commands = []
+		for staged_path, path, mode, owner in self.staged:
+			command = 'cat ' + quote(staged_path) + ' > ' + quote(path)
+			if_new  = []
+			if mode is not None:
+				if_new.append('chmod ' + '%o' % mode + ' ' + quote(path))
+			if owner:
+				if_new.append('chown ' + quote(owner) + ' ' + quote(path))
+			if if_new:
+				command = 'if [ -e ' + quote(path) + ' ]; then ' + command + '; else ' + ' && '.join([command] + if_new) + '; fi'
+			commands.append(command)
+		return '{ ' + ' && '.join(commands) + '; }; r=$?; rm -rf ' + quote(self.staging_dir) + '; [ $r -eq 0 ]'
+
+
+	def _get_chown_command(self):
+		"""Returns a command to set the ownership of the files sent, or ''.
+		"""
+		commands = []
+		for (user, group), paths in sorted(self.owners.items()):
+			commands.append('chown ' + quote(self._get_owner(user, group)) + ' ' + ' '.join(quote(path) for path in paths))
+		return ' && '.join(commands)
+
+
+	def _get_owner(self, user, group):
+		"""Returns the argument to chown for the user and group, or None.
+		"""
+		if not user and not group:
+			return None
+		return (user or '') + (':' + group if group else '')
+
+
+	def send(self):
+		"""Streams all the files added to the container as one tar, and sets
+		their ownership.
+		"""
+		shutit     = self.shutit
+		start_time = time.time()
+		if not self.members:
+			return True
+		after = ' && '.join(command for command in (self._get_staged_command(), self._get_chown_command()) if command)
+		if self.shutit_pexpect_session.command_available('tar'):
+			self._run(['sh', '-c', 'tar -xf - -C /' + (' && ' + after if after else '')], tar=True)
+		else:
+			self._run(['-'], cp=True, tar=True)
+			if after:
+				self._run(['sh', '-c', after])
+		self.elapsed = time.time() - start_time
+		shutit.log('Sent ' + str(len(self.members)) + ' files (' + str(self.size) + ' bytes) to container ' + self.container_id + ' in ' + '%.2f' % self.elapsed + 's (' + '%.2f' % (self.size / 1048576.0 / max(self.elapsed, 0.001)) + ' MB/s)', level=self.loglevel)
+		return True
+
+
+	def get(self, path, host_path):
+		"""Copies a file from the container to host_path, reading it from the
+		tar 'docker cp' writes as it arrives.
+
+		@param path:      Path in the container. See add()
+		@param host_path: Path on the host to write the file to.
+
+		@return: False if the file is not in the container, else True.
+		"""
+		shutit     = self.shutit
+		start_time = time.time()
+		if path[0] != '/':
+			path = self._get_home() + '/' + path
+		command = self.docker + ['cp', '-L', self.container_id + ':' + path, '-']
+		shutit.log('Running on host: ' + ' '.join(command), level=logging.DEBUG)
+		proc = subprocess.Popen(command,
+		                        stdout=subprocess.PIPE,
+		                        stderr=subprocess.PIPE)
+		tmp_host_path = host_path + '.' + shutit_util.random_id()
+		tarinfo       = None
+		try:
+			with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+				tarinfo = tar.next()
+				if tarinfo is not None and tarinfo.isfile():
+					with open(tmp_host_path, 'wb') as host_file:
+						shutil.copyfileobj(tar.extractfile(tarinfo), host_file)
+		except tarfile.TarError:
+			# No tar, as docker cp failed. Its output says why.
+			pass
+		# Let docker finish writing, so it can exit.
+		while proc.stdout.read(65536):
+			pass
+		output = proc.stderr.read().decode(shutit_global.shutit_global_object.default_encoding, 'replace')
+		if proc.wait() != 0 or tarinfo is None:
+			shutit.log('Could not get ' + path + ' from container ' + self.container_id + ': ' + output, level=self.loglevel)
+			return False
+		if not tarinfo.isfile():
+			shutit.fail(path + ' in container ' + self.container_id + ' is not a file') # pragma: no cover
+		os.rename(tmp_host_path, host_path)
+		self.size    = tarinfo.size
+		self.elapsed = time.time() - start_time
+		shutit.log('Got ' + str(self.size) + ' bytes from ' + path + ' in container ' + self.container_id + ' in ' + '%.2f' % self.elapsed + 's (' + '%.2f' % (self.size / 1048576.0 / max(self.elapsed, 0.001)) + ' MB/s)', level=self.loglevel)
+		return True
+
+
+	def _run(self, args, cp=False, tar=False):
+		"""Runs docker exec (or docker cp) against the container, optionally
+		writing the tar to its standard input.
+
+		@return: output of the command.
+		"""
+		shutit = self.shutit
+		if cp:
+			command = self.docker + ['cp'] + args + [self.container_id + ':/']
+		else:
+			command = self.docker + ['exec'] + (['-i'] if tar else []) + [self.container_id] + args
+		shutit.log('Running on host: ' + ' '.join(command), level=logging.DEBUG)
+		proc = subprocess.Popen(command,
+		                        stdin=subprocess.PIPE if tar else None,
+		                        stdout=subprocess.PIPE,
+		                        stderr=subprocess.STDOUT)
+		if tar:
+			try:
+				self._write_tar(proc.stdin)
+			except (IOError, OSError) as e:
+				# docker exited early. Its output says why.
+				shutit.log('Error writing to docker: ' + str(e), level=logging.DEBUG)
+			finally:
+				try:
+					proc.stdin.close()
+				except (IOError, OSError):
+					pass
+		output = proc.stdout.read().decode(shutit_global.shutit_global_object.default_encoding, 'replace')
+		if proc.wait() != 0:
+			shutit.fail('Failed to send files to container ' + self.container_id + ' with: ' + ' '.join(command) + '\nOutput was:\n' + output) # pragma: no cover
+		return output
+
+
+	def _write_tar(self, fileobj):
+		"""Writes the members to fileobj as a tar, reading each source as it goes.
+		"""
+		with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+			for tarinfo, source, hostfilepath in self.members:
+				if hostfilepath is not None and tarinfo.isfile():
+					with open(hostfilepath, 'rb') as host_file:
+						tar.addfile(tarinfo, host_file)
+				else:
+					tar.addfile(tarinfo, source)
+				self.size += tarinfo.size
+
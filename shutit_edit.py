@@ -0,0 +1,168 @@
+r"""Text edits for ShutIt's change_text (and so insert_text, replace_text
+and delete_text).
+
+This module is also the edit program shipped to the target: it is sent
+once per environment and run there by any python (2 or 3) found, so edits
+are made in place and only the edit spec crosses the wire. So it must only
+use the standard library.
+
+Run as:
+
+	python shutit_edit.py FILENAME SPEC
+
+where SPEC is base64-encoded JSON of the change_text arguments (plus
+'create' and 'encoding'), or @ and the path of a file holding it, which is
+then removed. It prints one of the RESULT_ tokens.
+"""
+
+from __future__ import print_function
+import base64
+import json
+import os
+import re
+import sys
+
+
+# The result of an edit on the target, as printed.
+RESULT_OK       = 'SHUTIT_EDIT_OK'
+RESULT_NOMATCH  = 'SHUTIT_EDIT_NOMATCH'
+RESULT_MISSING  = 'SHUTIT_EDIT_MISSING'
+
+
+def change_text(ftext,
+                text,
+                pattern=None,
+                before=False,
+                force=False,
+                delete=False,
+                replace=False,
+                line_oriented=True):
+	"""Returns the file's text changed as ShutIt's change_text describes, or
+	None if there was no match (or the text is already there).
+
+	@param ftext:   The file's text, as bytes.
+	@param text:    Text to insert or delete, as bytes.
+	@param pattern: Regexp, as bytes, or None.
+
+	See ShutItPexpectSession.change_text for the rest.
+	"""
+	if delete:
+		loc = ftext.find(text)
+		if loc == -1:
+			# No output - no match
+			return None
+		return ftext[:loc] + ftext[loc+len(text)+1:]
+	if pattern is not None:
+		if not line_oriented:
+			# cf: http://stackoverflow.com/questions/9411041/matching-ranges-of-lines-in-python-like-sed-ranges
+			sre_match = re.search(pattern, ftext, re.DOTALL|re.MULTILINE)
+			if replace:
+				if sre_match is None:
+					newtext1 = ftext
+					newtext2 = b''
+				else:
+					newtext1 = ftext[:sre_match.start()]
+					newtext2 = ftext[sre_match.end():]
+			else:
+				if sre_match is None:
+					# No output - no match
+					return None
+				elif before:
+					cut_point = sre_match.start()
+					# If the text is already there and we're not forcing it, return None.
+					if not force and ftext[cut_point-len(text):].find(text) > 0:
+						return None
+				else:
+					cut_point = sre_match.end()
+					# If the text is already there and we're not forcing it, return None.
+					if not force and ftext[cut_point:].find(text) > 0:
+						return None
+				newtext1 = ftext[:cut_point]
+				newtext2 = ftext[cut_point:]
+		else:
+			cut_point   = 0
+			line_length = 0
+			matched     = False
+			# Help the user out to make this properly line-oriented
+			pattern_before = b''
+			pattern_after  = b''
+			if not pattern or pattern[:1] != b'^':
+				pattern_before = b'^.*'
+			if not pattern or pattern[-1:] != b'$':
+				pattern_after = b'.*$'
+			line_re = re.compile(pattern_before + pattern + pattern_after)
+			for line in ftext.split(b'\n'):
+				line_length = len(line)
+				if line_re.search(line) is not None:
+					matched = True
+					break
+				# Update cut point to next line, including newline in original text
+				cut_point += line_length + 1
+			if not replace and not matched:
+				# No match, return none
+				return None
+			if replace and not matched:
+				cut_point = len(ftext)
+			elif not replace and not before:
+				cut_point += line_length
+			# newtext1 is everything up to the cutpoint
+			newtext1 = ftext[:cut_point]
+			# newtext2 is everything after the cutpoint
+			newtext2 = ftext[cut_point:]
+			# if replacing and we matched the output in a line, then set newtext2 to be everything from cutpoint's line end
+			if replace and matched:
+				newtext2 = ftext[cut_point+line_length:]
+			elif not force:
+				# If the text is already there and we're not forcing it, return None.
+				if before and ftext[cut_point-len(text):].find(text) > 0:
+					return None
+				if not before and ftext[cut_point:].find(text) > 0:
+					return None
+			# Add a newline to newtext1 and newtext2 if they are not already there
+			if newtext1 and newtext1[-1:] != b'\n':
+				newtext1 += b'\n'
+			if newtext2 and newtext2[:1] != b'\n':
+				newtext2 = b'\n' + newtext2
+	else:
+		# Append to file absent a pattern.
+		newtext1 = ftext
+		newtext2 = b''
+	# If adding or replacing at the end of the file, then ensure we have a newline at the end
+	if newtext2 == b'' and text and text[-1:] != b'\n':
+		newtext2 = b'\n'
+	return newtext1 + text + newtext2
+
+
+def main(fname, spec):
+	"""Applies the edit in the spec to the file in place, and prints the result.
+	"""
+	if spec[:1] == '@':
+		with open(spec[1:]) as f:
+			spec_path, spec = spec[1:], f.read()
+		os.remove(spec_path)
+	spec     = json.loads(base64.b64decode(spec).decode('utf-8'))
+	encoding = spec.pop('encoding')
+	create   = spec.pop('create')
+	for key in ('text', 'pattern'):
+		if spec[key] is not None:
+			spec[key] = spec[key].encode(encoding)
+	if not os.path.exists(fname):
+		if not create:
+			print(RESULT_MISSING)
+			return
+		open(fname, 'ab').close()
+	with open(fname, 'rb') as f:
+		ftext = f.read()
+	new_text = change_text(ftext, **spec)
+	if new_text is None:
+		print(RESULT_NOMATCH)
+		return
+	if new_text != ftext:
+		# Rewriting the file in place keeps its ownership and permissions.
+		with open(fname, 'wb') as f:
+			f.write(new_text)
+	print(RESULT_OK)
+
+
+if __name__ == '__main__':
+	main(sys.argv[1], sys.argv[2])
@@ -72,6 +72,10 @@ class ShutItGlobal(object):
 		self.global_thread_lock      = threading.Lock()
 		# Acquire the lock by default.
 		self.global_thread_lock.acquire()
+		# Set by the pane thread when it wants the lock to redraw the screen,
+		# and cleared once it has drawn (see yield_to_draw).
+		self.draw_pending            = False
+		self.draw_done               = threading.Event()
 
 		# Secret words.
 		self.secret_words_set        = set()
@@ -98,9 +102,14 @@ class ShutItGlobal(object):
 
 		# Prompts and shell.
 		self.bash_startup_command    = "bash --noprofile --rcfile <(sleep .05||sleep 1)"
+		# Used instead of the above by sessions in 'sentinel' prompt_sync mode.
+		self.bash_startup_command_nosleep = "bash --noprofile --norc"
 		# Quotes here are intentional. Some versions of sleep don't support fractional seconds.
 		# True is called to take up the time require
 		self.prompt_command          = "'sleep .05||sleep 1'"
+		# Marker prefixed to the prompt in sessions that report the exit code
+		# of the previous command in their prompt (see setup_prompt).
+		self.prompt_exit_code_marker = 'SHUTIT_PROMPT_EC'
 		# It's important that this has '.*' at the start, so the matched data is reliably 'after' in the
 		# child object. Use these where possible to make things more consistent.
 		# Attempt to capture any starting prompt (when starting) with this regexp.
@@ -109,6 +118,11 @@ class ShutItGlobal(object):
 		self.base_prompt      = '\n.*[@#$] '
 		# There is a problem with lines roughly around this length + the length of the prompt (?3k?)
 		self.line_limit          = 3000
+		# Least extra characters searched beyond the prompt length when matching
+		# prompts (see ShutItPexpectSession._get_searchwindowsize), in case
+		# anything arrives after the prompt in the same read. It is raised to
+		# pexpect's maxread, as a whole read can follow the prompt.
+		self.searchwindow_slack  = 1000
 		# Terminal size
 		def terminal_size():
 			h, w, _, _ = struct.unpack('HHHH', fcntl.ioctl(0, termios.TIOCGWINSZ, struct.pack('HHHH', 0, 0, 0, 0)))
@@ -150,6 +164,18 @@ class ShutItGlobal(object):
 			mkpath(self.shutit_state_dir,mode=0o777)
 		os.chmod(self.shutit_state_dir,0o777)
 		self.shutit_state_dir_build_db_dir = self.shutit_state_dir + '/build_db'
+		# Distro information, keyed by container/machine id, kept across builds (see get_distro_info).
+		self.distro_info_dir        = shutit_state_dir_base + '/distro_info'
+		self.distro_info_cache      = {}
+		# Compression to use for file transfers, in order of preference, where
+		# available at both ends. See shutit_transfer.
+		self.transfer_compression   = ['zstd','gzip','xz']
+		# Content-addressed store of sent files on the target, kept across
+		# builds. Least recently used files are evicted beyond the maximum
+		# total size, or if not used in the last file_store_max_builds builds.
+		self.file_store_dir         = shutit_state_dir_base + '/file_store'
+		self.file_store_max_size    = 104857600
+		self.file_store_max_builds  = 10
 
 		# Allowed delivery methods.
 		self.allowed_delivery_methods = ['ssh','dockerfile','bash','docker','vagrant']
@@ -290,11 +316,13 @@ class ShutItGlobal(object):
 
 	def yield_to_draw(self):
 		# Release the lock to allow the screen to be drawn, then acquire again.
-		# Only ever yield if there are any sessions to draw.
-		if len(get_shutit_pexpect_sessions()) > 0:
+		# Only ever yield if the pane thread has asked to draw, so this costs
+		# nothing if there are no managed panes.
+		if self.draw_pending:
+			self.draw_done.clear()
 			self.global_thread_lock.release()
-			# Allow a _little_ time for others to get a look in
-			time.sleep(0.001)
+			# Wait (briefly) for the pane thread to draw before carrying on.
+			self.draw_done.wait(0.1)
 			self.global_thread_lock.acquire()
 
 
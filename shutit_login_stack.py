@@ -10,8 +10,14 @@ belonging to this login.
 
 from __future__ import print_function
 import logging
+import re
 import shutit_global
-from shutit_background import ShutItBackgroundCommand
+import shutit_util
+from shutit_background import ShutItBackgroundCommand, NOTIFY_FD
+
+# Longest time to wait for a background command to finish before checking
+# them all anyway, in seconds.
+NOTIFY_TIMEOUT = 30
 
 class ShutItLoginStack(object):
 
@@ -74,14 +80,65 @@ class ShutItLoginStackItem(object):
 		self.background_objects           = []
 		self.background_objects_completed = []
 		self.shutit_obj                   = shutit_obj
+		# Most background commands to run at once, or None for no limit.
+		self.max_background_workers       = None
+		# Whether the shell of this login has NOTIFY_FD open on a FIFO, or
+		# None if not yet known.
+		self.notify                       = None
 
 
 	def append_background_send(self,sendspec):
-		shutit_background_command_object = ShutItBackgroundCommand(sendspec, self.shutit_obj)
+		for name in sendspec.depends_on:
+			if self.find_background_object(name) is None:
+				self.shutit_obj.fail('Background command: ' + str(sendspec.original_send) + ' depends on unknown background_id: ' + str(name)) # pragma: no cover
+		shutit_background_command_object = ShutItBackgroundCommand(sendspec, self.shutit_obj, notify=self.setup_notify(sendspec.shutit_pexpect_child))
 		self.background_objects.append(shutit_background_command_object)
 		return shutit_background_command_object
 
 
+	def find_background_object(self, name):
+		"""Returns the latest background command with the given background_id
+		(or id), or None.
+		"""
+		for background_object in reversed(self.background_objects_completed + self.background_objects):
+			if background_object.name == name:
+				return background_object
+		return None
+
+
+	def get_start_state(self, background_object):
+		"""Returns whether a queued background command can be started as far
+		as its dependencies and the worker limit go: 'S' if so, 'N' if it must
+		wait, or 'F' if it never can, as a command it depends on failed or
+		timed out.
+		"""
+		for name in background_object.sendspec.depends_on:
+			dependency = self.find_background_object(name)
+			if dependency.run_state in ('F','T'):
+				self.shutit_obj.log('Background command: ' + background_object.sendspec.original_send + ' cannot run, as ' + name + ' did not succeed', level=logging.INFO)
+				return 'F'
+			elif dependency.run_state != 'C':
+				return 'N'
+		if self.max_background_workers is not None:
+			running = [b for b in self.background_objects if b.run_state == 'S']
+			if len(running) >= self.max_background_workers:
+				return 'N'
+		return 'S'
+
+
+	def get_background_progress(self):
+		"""Returns the number of background commands of this login in each
+		state, as a dict with keys queued, running, complete, failed,
+		timed_out and total.
+		"""
+		progress = dict((key, 0) for key in ('queued', 'running', 'complete', 'failed', 'timed_out'))
+		keys = {'N':'queued', 'S':'running', 'C':'complete', 'F':'failed', 'T':'timed_out'}
+		for background_object in self.background_objects + self.background_objects_completed:
+			progress[keys[background_object.run_state]] += 1
+		progress['total'] = len(self.background_objects) + len(self.background_objects_completed)
+		return progress
+
+
 	def has_blocking_background_send(self):
 		"""Check whether any blocking background commands are waiting to run.
         If any are, return True. If none are, return False.
@@ -112,18 +169,20 @@ class ShutItLoginStackItem(object):
 		def remove_background_objects(a_background_objects_to_remove):
 			for background_object in a_background_objects_to_remove:
 				self.background_objects.remove(background_object)
+		# Get the state of all the running commands in one go.
+		statuses = self.get_background_command_states()
+		running_object = None
 		for background_object in self.background_objects:
 			self.shutit_obj.log('Checking background object: ' + str(background_object),level=logging.DEBUG)
-			state = background_object.check_background_command_state()
+			state = background_object.check_background_command_state(statuses.get(background_object.pid))
 			self.shutit_obj.log('State is: ' + state,level=logging.DEBUG)
 			if state in ('C','F','T'):
 				background_objects_to_remove.append(background_object)
 				self.background_objects_completed.append(background_object)
 			elif state == 'S':
 				# Running command exists
-				self.shutit_obj.log('check_background_command_state returning False (S) for ' + str(background_object),level=logging.DEBUG)
-				remove_background_objects(background_objects_to_remove)
-				return False, 'S', background_object
+				self.shutit_obj.log('check_background_command_state found running (S): ' + str(background_object),level=logging.DEBUG)
+				running_object = running_object or background_object
 			elif state == 'N':
 				self.shutit_obj.log('UNSTARTED COMMAND! ' + str(background_object.sendspec.send),level=logging.DEBUG)
 				unstarted_command_exists = True
@@ -136,19 +195,123 @@ class ShutItLoginStackItem(object):
 				return False, 'F', background_object
 		remove_background_objects(background_objects_to_remove)
 		self.shutit_obj.log('Checking background objects done.',level=logging.DEBUG)
+		started_object = None
 		if unstarted_command_exists:
-			# Start up an unstarted one (in order), and return False
-			for background_object in self.background_objects:
-				state = background_object.check_background_command_state()
-				if state == 'N':
+			# Start up the unstarted ones that can be, in order.
+			for background_object in list(self.background_objects):
+				if background_object.run_state != 'N':
+					continue
+				running = [b for b in self.background_objects if b.run_state == 'S']
+				if running and (background_object.block_other_commands or [b for b in running if b.block_other_commands]):
+					# Blocked until the running commands finish, as is
+					# everything queued after it.
+					break
+				state = self.get_start_state(background_object)
+				if state == 'S':
 					background_object.run_background_command()
-					self.shutit_obj.log('check_background_command_state returning False (N) for ' + str(background_object),level=logging.DEBUG)
-					return False, 'N', background_object
+					self.shutit_obj.log('check_background_command_state started (N): ' + str(background_object),level=logging.DEBUG)
+					started_object = started_object or background_object
+				elif state == 'F':
+					background_object.run_state = 'F'
+					self.background_objects.remove(background_object)
+					self.background_objects_completed.append(background_object)
+					self.shutit_obj.log('check_background_command_state returning False (F) for ' + str(background_object),level=logging.DEBUG)
+					return False, 'F', background_object
+		if running_object is not None:
+			self.shutit_obj.log('check_background_command_state returning False (S) for ' + str(running_object),level=logging.DEBUG)
+			return False, 'S', running_object
+		if started_object is not None:
+			self.shutit_obj.log('check_background_command_state returning False (N) for ' + str(started_object),level=logging.DEBUG)
+			return False, 'N', started_object
 		# Nothing left to do - return True.
 		self.shutit_obj.log('check_background_command_state returning True (OK)',level=logging.DEBUG)
 		return True, 'OK', None
 
 
+	def setup_notify(self, shutit_pexpect_session):
+		"""Opens NOTIFY_FD in the shell on a FIFO, once per login, for
+		background commands to say when they are finished. The FIFO is
+		removed at once, as it is only used through the open descriptor.
+		Needs bash, for read's timeout.
+
+		@return: True if background commands can notify.
+		"""
+		if self.notify is None:
+			fifo = shutit_global.shutit_global_object.shutit_state_dir + '/background_' + shutit_util.random_id() + '.fifo'
+			output = shutit_pexpect_session.send_and_get_output(' [ -n "$BASH_VERSION" ] && command mkfifo ' + fifo + ' && exec ' + str(NOTIFY_FD) + '<>' + fifo + ' && command rm -f ' + fifo + ' && echo SHUTIT_NOTIFY""_OK',
+			                                                    echo=False,
+			                                                    record_command=False,
+			                                                    ignore_background=True,
+			                                                    loglevel=logging.DEBUG)
+			self.notify = 'SHUTIT_NOTIFY_OK' in output
+			self.shutit_obj.log('Background commands notify on finishing: ' + str(self.notify), level=logging.DEBUG)
+		return self.notify
+
+
+	def wait_for_background_notification(self, shutit_pexpect_session, timeout=NOTIFY_TIMEOUT):
+		"""Blocks until a background command has finished, or timeout seconds
+		have passed, then takes any other notifications waiting.
+
+		@return: False if background commands cannot notify, so the caller
+		         should poll instead.
+		"""
+		if not self.notify:
+			return False
+		if not [background_object for background_object in self.background_objects if background_object.run_state == 'S']:
+			# Nothing running to wait for.
+			return True
+		fd = str(NOTIFY_FD)
+		shutit_pexpect_session.send_and_get_output(' read -t ' + str(timeout) + ' -u ' + fd + ' SHUTIT_BG_DONE; while read -t 0.01 -u ' + fd + ' SHUTIT_BG_DONE 2>/dev/null; do :; done; unset SHUTIT_BG_DONE',
+		                                           timeout=timeout + 30,
+		                                           echo=False,
+		                                           record_command=False,
+		                                           ignore_background=True,
+		                                           loglevel=logging.DEBUG)
+		return True
+
+
+	def tail_background_output(self, loglevel=logging.INFO):
+		"""Gets, logs and returns the new output of the background commands,
+		including the rest of that of any which have finished since last
+		called. See ShutItBackgroundCommand.tail_output
+
+		@return: dict of lists of new lines by background command name.
+		"""
+		output = {}
+		for background_object in self.background_objects_completed + self.background_objects:
+			if background_object.sendspec.started and not background_object.output_complete:
+				lines = background_object.tail_output(loglevel=loglevel)
+				if lines:
+					output.setdefault(background_object.name, []).extend(lines)
+		return output
+
+
+	def get_background_command_states(self):
+		"""Gets the ps state and exit code of all the running background
+		commands in one round trip. Any that have finished, or written their
+		exit code and are about to, are waited for.
+
+		@return: dict of (ps state, exit code) tuples by pid. The ps state is
+		         empty if the command has finished.
+		"""
+		running = [background_object for background_object in self.background_objects if background_object.run_state == 'S' and background_object.pid]
+		if not running:
+			return {}
+		shutit_pexpect_session = running[0].sendspec.shutit_pexpect_child
+		pids = ' '.join(background_object.pid + ':' + background_object.exit_code_file for background_object in running)
+		output = shutit_pexpect_session.send_and_get_output(' for SHUTIT_BG in ' + pids + '; do [ -s ${SHUTIT_BG#*:} ] && wait ${SHUTIT_BG%%:*} 2>/dev/null; SHUTIT_BG_STATE=$(command ps -o stat ${SHUTIT_BG%%:*} | command sed 1d); [ -z "$SHUTIT_BG_STATE" ] && wait ${SHUTIT_BG%%:*} 2>/dev/null; echo "SHUTIT_BG""_STATUS:${SHUTIT_BG%%:*}:${SHUTIT_BG_STATE}:$(command cat ${SHUTIT_BG#*:} 2>/dev/null)"; done; unset SHUTIT_BG SHUTIT_BG_STATE',
+		                                                    echo=False,
+		                                                    record_command=False,
+		                                                    ignore_background=True,
+		                                                    loglevel=logging.DEBUG)
+		statuses = {}
+		for line in output.splitlines():
+			match = re.match('^SHUTIT_BG_STATUS:([0-9]+):([^:]*):(.*)$', line.strip())
+			if match:
+				statuses[match.group(1)] = (match.group(2).strip(), match.group(3).strip())
+		return statuses
+
+
 	def find_sendspec(self,sendspec):
 		for background_object in self.background_objects:
 			if background_object == sendspec:
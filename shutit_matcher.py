@@ -0,0 +1,148 @@
+r"""Represents a set of regexps matched against the lines of command output.
+
+Used by match_string, send_until, send_and_match_output and regexp checks of
+output. Each regexp is matched from the start of each line, as re.match
+does. Lines may be separated by any of \r\n, \r or \n.
+
+Matchers are compiled once and kept in a small LRU cache (see
+get_line_matcher), so a regexp polled for repeatedly, eg by send_until, is
+not compiled again on each poll.
+"""
+
+from __future__ import print_function
+import re
+import threading
+from collections import OrderedDict
+try:
+	from re import _parser as sre_parse
+except ImportError: # pragma: no cover
+	import sre_parse
+
+
+# Splits output into lines, however they are separated.
+LINE_SEPARATOR = re.compile(r'\r\n|\r|\n')
+
+# Number of matchers kept in the cache.
+CACHE_SIZE = 256
+
+_cache      = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class ShutItLineMatcher(object):
+	"""Matches a list of regexps against the lines of a string. Lines are
+	scanned with one alternation of all the regexps, and the regexp which
+	matched is only worked out for the line that matched.
+	"""
+	def __init__(self, regexps):
+		"""
+		@param regexps: Tuple of regexp strings.
+
+		@raise re.error: If any of the regexps is illegal.
+		"""
+		self.regexps  = regexps
+		self.compiled = [re.compile(regexp) for regexp in regexps]
+		if len(self.compiled) == 1:
+			self.combined = self.compiled[0]
+		elif any(_has_group_reference(regexp) for regexp in regexps):
+			# Combined, a backreference would count the groups of the regexps
+			# before it, and so refer to the wrong group. Match each regexp
+			# in turn instead.
+			self.combined = None
+		else:
+			try:
+				self.combined = re.compile('|'.join('(?:' + regexp + ')' for regexp in regexps))
+			except re.error:
+				# eg inline flags, or a group name used in more than one
+				# regexp. Match each regexp in turn instead.
+				self.combined = None
+
+
+	def __str__(self):
+		return 'ShutItLineMatcher: ' + str(self.regexps)
+
+
+	def match(self, string_to_match):
+		"""Returns as match_string does, for the first line that any of the
+		regexps match: the first group of the first regexp that matches
+		that line, or True if it has no groups. Returns None if no line
+		matches.
+		"""
+		for line in LINE_SEPARATOR.split(string_to_match):
+			if self.combined is not None and self.combined.match(line) is None:
+				continue
+			for compiled in self.compiled:
+				match = compiled.match(line)
+				if match is not None:
+					if match.groups():
+						return match.group(1)
+					return True
+		return None
+
+
+	def missing(self, string_to_match):
+		"""Returns True if any of the regexps matches none of the lines.
+		"""
+		lines = LINE_SEPARATOR.split(string_to_match)
+		for compiled in self.compiled:
+			if not any(compiled.match(line) is not None for line in lines):
+				return True
+		return False
+
+
+def _has_group_reference(regexp):
+	"""Returns True if the regexp refers back to one of its groups, by a
+	backreference or a conditional, or if that cannot be worked out.
+
+	@param regexp: Regexp string.
+	"""
+	try:
+		parsed = sre_parse.parse(regexp)
+	except Exception:
+		return True
+	def refers(items):
+		for item in items:
+			if isinstance(item, (sre_parse.SubPattern, list, tuple)):
+				if refers(item):
+					return True
+			elif str(item).upper().startswith('GROUPREF'):
+				return True
+		return False
+	return refers(parsed)
+
+
+def get_max_match_width(regexp):
+	"""Returns the most characters the regexp can match, or None if there
+	is no limit (or it cannot be worked out).
+
+	@param regexp: Regexp string.
+	"""
+	try:
+		width = sre_parse.parse(regexp).getwidth()[1]
+	except Exception:
+		return None
+	if width >= sre_parse.MAXREPEAT:
+		return None
+	return width
+
+
+def get_line_matcher(regexps):
+	"""Returns a ShutItLineMatcher for the regexps, from the cache if it has
+	been made before.
+
+	@param regexps: Regexp string, or list of them.
+
+	@raise re.error: If any of the regexps is illegal.
+	"""
+	if isinstance(regexps, str):
+		regexps = (regexps,)
+	else:
+		regexps = tuple(regexps)
+	with _cache_lock:
+		matcher = _cache.pop(regexps, None)
+		if matcher is None:
+			matcher = ShutItLineMatcher(regexps)
+		_cache[regexps] = matcher
+		while len(_cache) > CACHE_SIZE:
+			_cache.popitem(last=False)
+	return matcher
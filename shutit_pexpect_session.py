@@ -47,16 +47,21 @@ try:
 	from md5 import md5
 except ImportError: # pragma: no cover
 	from hashlib import md5
+import inspect
+import json
 import logging
-import string
 import time
 import os
 import re
 import base64
 import sys
 import textwrap
+import io
 import pexpect
 import shutit_util
+import shutit_assets
+import shutit_edit
+import shutit_matcher
 import shutit_global
 from shutit_global import SessionPaneLine
 import package_map
@@ -66,6 +71,9 @@ from shutit_sendspec import ShutItSendSpec
 from shutit_module import ShutItFailException
 from shutit_pexpect_session_environment import ShutItPexpectSessionEnvironment
 from shutit_background import ShutItBackgroundCommand
+from shutit_capture import ShutItCapture
+from shutit_transfer import ShutItFileTransfer
+from shutit_docker_transfer import ShutItDockerTransfer
 
 if sys.version_info[0] >= 3:
 	unicode = str
@@ -104,10 +112,26 @@ class ShutItPexpectSession(object):
 		self.shell_expect              = self.default_expect
 		# A flag indicating whether we are in a shell.
 		self.in_shell                  = True
+		# Whether the prompt reports the exit code of the previous command (see setup_prompt).
+		self.exit_code_in_prompt       = False
+		# Exit code read from the last prompt matched, or None if it carried none.
+		self.last_prompt_exit_code     = None
+		# How the prompt is synchronised with the shell: 'sleep' or 'sentinel' (see setup_prompt).
+		self.prompt_sync               = 'sleep'
+		# Sentinel printed before the prompt in 'sentinel' mode, and the prompts that carry it.
+		self.prompt_sentinel           = None
+		self.sentinel_prompts          = set()
 		self.pexpect_session_id        = pexpect_session_id
 		self.pexpect_session_number    = len(shutit_global.get_shutit_pexpect_sessions()) + 1
 		self.login_stack               = ShutItLoginStack(shutit_obj=shutit)
 		self.current_environment       = None
+		# Incremented whenever a command is sent, other than fact probes (see _get_fact).
+		self.facts_generation          = 0
+		self.probing_facts             = False
+		# Output of a send_and_stream command not yet read to its prompt, and
+		# whether it is echoed.
+		self.active_stream             = None
+		self.active_stream_echo        = False
 		args = args or []
 		if not delaybeforesend:
 			delaybeforesend=shutit_global.shutit_global_object.delaybeforesend
@@ -135,6 +159,8 @@ class ShutItPexpectSession(object):
 		str_repr += '\nSHUTIT_PEXPECT_SESSION default_expect='       + str(self.default_expect)
 		str_repr += '\nSHUTIT_PEXPECT_SESSION shell_expect='         + str(self.shell_expect)
 		str_repr += '\nSHUTIT_PEXPECT_SESSION in_shell='             + str(self.in_shell)
+		str_repr += '\nSHUTIT_PEXPECT_SESSION exit_code_in_prompt='  + str(self.exit_code_in_prompt)
+		str_repr += '\nSHUTIT_PEXPECT_SESSION prompt_sync='          + str(self.prompt_sync)
 		str_repr += '\nSHUTIT_PEXPECT_SESSION pexpect_session_id='   + str(self.pexpect_session_id)
 		str_repr += '\nSHUTIT_PEXPECT_SESSION login_stack='          + str(self.login_stack)
 		str_repr += '\nSHUTIT_PEXPECT_SESSION current_environment='  + str(self.current_environment)
@@ -194,6 +220,8 @@ class ShutItPexpectSession(object):
 		"""
 		assert not sendspec.started, shutit_util.print_debug()
 		shutit = self.shutit
+		if self.active_stream is not None:
+			self._finish_stream()
 		shutit.log('Sending in pexpect session (' + str(id(self)) + '): ' + str(sendspec.send), level=logging.DEBUG)
 		if sendspec.expect:
 			shutit.log('Expecting: ' + str(sendspec.expect), level=logging.DEBUG)
@@ -216,8 +244,13 @@ class ShutItPexpectSession(object):
 				sendspec.send += '\n'
 				# sendspec has newline added now, so no need to keep marker
 				sendspec.nonewline = True
+			if not self.probing_facts:
+				self.facts_generation += 1
 			if sendspec.run_in_background:
-				shutit_background_command_object.run_background_command()
+				# If it waits on other commands or a worker, it is started when
+				# they are done. See check_background_commands_complete.
+				if self.login_stack.get_current_login_item().get_start_state(shutit_background_command_object) == 'S':
+					shutit_background_command_object.run_background_command()
 				return True
 			#shutit.log('sendline: actually sending: ' + sendspec.send, level=logging.DEBUG)
 			self.pexpect_child.send(sendspec.send)
@@ -268,18 +301,24 @@ class ShutItPexpectSession(object):
 		return False
 
 
-	def wait(self, cadence=2, sendspec=None):
+	def wait(self, cadence=2, sendspec=None, tail_output=False):
 		"""Does not return until all background commands are completed.
+
+		@param tail_output: If True, log the output of the background commands
+		                    as it is written, at least every cadence seconds.
 		"""
 		shutit = self.shutit
 		shutit.log('In wait.', level=logging.DEBUG)
 		if sendspec:
 			cadence = sendspec.wait_cadence
 		shutit.log('Login stack is:\n' + str(self.login_stack), level=logging.DEBUG)
+		last_progress = None
 		while True:
 			# go through each background child checking whether they've finished
 			res, res_str, background_object = self.login_stack.get_current_login_item().check_background_commands_complete()
 			shutit.log('Checking: ' + str(background_object) + '\nres: ' + str(res) + '\nres_str' + str(res_str), level=logging.DEBUG)
+			if tail_output:
+				self.login_stack.get_current_login_item().tail_background_output()
 			if res:
 				# When all have completed, break return the background command objects.
 				break
@@ -294,11 +333,44 @@ class ShutItPexpectSession(object):
 				return False
 			else:
 				self.shutit.fail('Un-handled exit code: ' + res_str) # pragma: no cover
-			time.sleep(cadence)
+			progress = self.login_stack.get_current_login_item().get_background_progress()
+			if progress != last_progress:
+				shutit.log('Background commands: ' + ', '.join(str(progress[key]) + ' ' + key for key in ('running', 'queued', 'complete', 'failed', 'timed_out')) + ' (of ' + str(progress['total']) + ')', level=logging.INFO)
+				last_progress = progress
+			# Wait for a background command to say it has finished, or poll
+			# if they cannot.
+			if tail_output:
+				notified = self.login_stack.get_current_login_item().wait_for_background_notification(self, timeout=cadence)
+			else:
+				notified = self.login_stack.get_current_login_item().wait_for_background_notification(self)
+			if not notified:
+				time.sleep(cadence)
 		shutit.log('Wait complete.', level=logging.DEBUG)
 		return True
 
 
+	def set_background_workers(self, max_workers):
+		"""Limits how many background commands run at once in the current
+		login. See ShutIt.set_background_workers
+		"""
+		self.login_stack.get_current_login_item().max_background_workers = max_workers
+		return True
+
+
+	def get_background_progress(self):
+		"""Returns the number of background commands in the current login in
+		each state. See ShutItLoginStackItem.get_background_progress
+		"""
+		return self.login_stack.get_current_login_item().get_background_progress()
+
+
+	def tail_background_output(self, loglevel=logging.INFO):
+		"""Gets, logs and returns the new output of the background commands in
+		the current login. See ShutItLoginStackItem.tail_background_output
+		"""
+		return self.login_stack.get_current_login_item().tail_background_output(loglevel=loglevel)
+
+
 	def login(self, sendspec):
 		"""Logs the user in with the passed-in password and command.
 		Tracks the login. If used, used logout to log out again.
@@ -329,6 +401,9 @@ class ShutItPexpectSession(object):
 		if self.shutit.build['delivery'] == 'bash' and command == 'su -':
 			# We want to retain the current working directory
 			command = 'su'
+		if self.prompt_sync == 'sentinel' and command == shutit_global.shutit_global_object.bash_startup_command:
+			# No need to wait for the shell to start up, as the prompt is synchronised by sentinel.
+			command = shutit_global.shutit_global_object.bash_startup_command_nosleep
 		# If this is a su-type command, add the user, else assume user is in the command.
 		if command == 'su -' or command == 'su' or command == 'login':
 			send = command + ' ' + user
@@ -448,6 +523,8 @@ class ShutItPexpectSession(object):
 		                                  echo=echo,
 		                                  loglevel=sendspec.loglevel,
 			                              nonewline=sendspec.nonewline)
+		# We are back in the previous login, as a different user.
+		self.invalidate_facts()
 		shutit.handle_note_after(note=sendspec.note)
 		return output
 
@@ -456,6 +533,8 @@ class ShutItPexpectSession(object):
 	                 prompt_name,
 	                 prefix='default',
 	                 capture_exit_code=False,
+	                 exit_code_in_prompt=None,
+	                 prompt_sync=None,
 	                 loglevel=logging.DEBUG):
 		"""Use this when you've opened a new shell to set the PS1 to something
 		sane. By default, it sets up the default expect so you don't have to
@@ -482,12 +561,38 @@ class ShutItPexpectSession(object):
 		                            command into a SHUTIT_EC variable. Useful
 		                            for when we want to work out whether the
 		                            login worked.
+		@param exit_code_in_prompt: If True, the prompt is prefixed with the
+		                            exit code of the previous command, so
+		                            check_exit does not need an extra round
+		                            trip. Default (None) keeps the session's
+		                            current setting.
+		@param prompt_sync:         How to avoid the pexpect/bash prompt race.
+		                            'sleep' pauses in PROMPT_COMMAND before
+		                            each prompt. 'sentinel' instead prefixes
+		                            the prompt with a session-unique sentinel
+		                            and only accepts prompts that carry it, so
+		                            no time is spent sleeping. Default (None)
+		                            keeps the session's current setting.
 		@type prompt_name:          string
 		@type prefix:               string
+		@type exit_code_in_prompt:  boolean
+		@type prompt_sync:          string
 		"""
 		shutit = self.shutit
+		if exit_code_in_prompt is not None:
+			self.exit_code_in_prompt = exit_code_in_prompt
+		if prompt_sync is not None:
+			if prompt_sync not in ('sleep','sentinel'):
+				shutit.fail('prompt_sync must be one of: sleep, sentinel. Got: ' + str(prompt_sync)) # pragma: no cover
+			self.prompt_sync = prompt_sync
+		if self.prompt_sync == 'sentinel' and self.prompt_sentinel is None:
+			self.prompt_sentinel = 'SHUTIT_SYNC_' + shutit_util.random_id()
+		# We are in a new shell (eg after a login), so what we knew may no longer hold.
+		self.invalidate_facts()
 		local_prompt = prefix + ':' + shutit_util.random_id() + '# '
 		shutit.expect_prompts[prompt_name] = local_prompt
+		if self.prompt_sync == 'sentinel':
+			self.sentinel_prompts.add(local_prompt)
 		# Set up the PS1 value.
 		# Override the PROMPT_COMMAND as this can cause nasty surprises in the
 		# output, and we need a short pause before returning the prompt to
@@ -505,7 +610,7 @@ class ShutItPexpectSession(object):
 		send_str = ''
 		if capture_exit_code:
 			send_str = r' SHUTIT_EC=$? && '
-		send_str += """ export PS1_""" + str(prompt_name) + """=$PS1 && PS1='""" + str(local_prompt[:2]) + "''" + str(local_prompt[2:]) + """' && PROMPT_COMMAND=""" + shutit_global.shutit_global_object.prompt_command
+		send_str += """ export PS1_""" + str(prompt_name) + """=$PS1 && PS1=""" + self._get_ps1(local_prompt) + """ && PROMPT_COMMAND=""" + self._get_prompt_command()
 		self.send(ShutItSendSpec(self,
 		                         send=send_str,
 		                         expect=[shutit.expect_prompts[prompt_name]],
@@ -528,13 +633,15 @@ class ShutItPexpectSession(object):
 		hostname = shutit.send_and_get_output(""" if [ $(echo $SHELL) == '/bin/bash' ]; then echo $HOSTNAME; elif [ $(command hostname 2>/dev/null) != '' ]; then hostname -s 2>/dev/null; fi""", echo=False, loglevel=logging.DEBUG)
 		local_prompt_with_hostname = hostname + ':' + local_prompt
 		shutit.expect_prompts[prompt_name] = local_prompt_with_hostname
+		if self.prompt_sync == 'sentinel':
+			self.sentinel_prompts.add(local_prompt_with_hostname)
 		self.default_expect = shutit.expect_prompts[prompt_name]
 		# Set up a shell expect to check whether we're still in a shell later.
 		self.shell_expect = self.default_expect
 
 		# Split the local prompt into two parts and separate with quotes to protect against the expect matching the command rather than the output.
 		self.send(ShutItSendSpec(self,
-		                         send=""" PS1='""" + shutit.expect_prompts[prompt_name][:2] + "''" + shutit.expect_prompts[prompt_name][2:] + """'""",
+		                         send=""" PS1=""" + self._get_ps1(shutit.expect_prompts[prompt_name]),
 		                         echo=False,
 		                         loglevel=loglevel,
 		                         ignore_background=True))
@@ -551,6 +658,38 @@ class ShutItPexpectSession(object):
 		return True
 
 
+	def _get_ps1(self, prompt):
+		"""Returns the quoted PS1 value to send for the given prompt.
+
+		The prompt is split into two parts and separated with quotes to protect
+		against the expect matching the command rather than the output.
+		If the session reports exit codes in the prompt, the exit code marker
+		is prepended. In 'sentinel' prompt_sync mode the sentinel goes directly
+		before the prompt, split in the same way.
+		"""
+		ps1 = "'" + prompt[:2] + "''" + prompt[2:] + "'"
+		if self.prompt_sync == 'sentinel':
+			ps1 = "'" + self.prompt_sentinel[:2] + "''" + self.prompt_sentinel[2:] + ":'" + ps1
+		if self.exit_code_in_prompt:
+			ps1 = "'" + shutit_global.shutit_global_object.prompt_exit_code_marker + r":${SHUTIT_PROMPT_EC}:'" + ps1
+		return ps1
+
+
+	def _get_prompt_command(self):
+		"""Returns the PROMPT_COMMAND value to send. If the session reports exit
+		codes in the prompt, the exit code is stashed before anything else runs.
+		In 'sentinel' prompt_sync mode there is no need to pause, so nothing
+		else is run.
+		"""
+		if self.prompt_sync == 'sentinel':
+			prompt_command = "''"
+		else:
+			prompt_command = shutit_global.shutit_global_object.prompt_command
+		if self.exit_code_in_prompt:
+			prompt_command = "'SHUTIT_PROMPT_EC=$?;'" + prompt_command
+		return prompt_command
+
+
 	def revert_prompt(self,
 	                  old_prompt_name,
 	                  new_expect=None):
@@ -596,6 +735,8 @@ class ShutItPexpectSession(object):
 		"""
 		if isinstance(expect, str):
 			expect = [expect]
+		if searchwindowsize is None:
+			searchwindowsize = self._get_searchwindowsize(expect, maxread or self.pexpect_child.maxread)
 		if searchwindowsize != None:
 			old_searchwindowsize = self.pexpect_child.searchwindowsize
 			self.pexpect_child.searchwindowsize = searchwindowsize
@@ -603,10 +744,16 @@ class ShutItPexpectSession(object):
 			old_maxread = self.pexpect_child.maxread
 			self.pexpect_child.maxread = maxread
 		res = self.pexpect_child.expect(expect + [pexpect.TIMEOUT] + [pexpect.EOF], timeout=timeout)
+		# In sentinel mode, a prompt only counts if the shell printed the sentinel with it.
+		while self.prompt_sync == 'sentinel' and res < len(expect) and expect[res] in self.sentinel_prompts and not self._strip_prompt_sentinel():
+			self.shutit.log('Prompt matched without sentinel, ignoring: ' + str(expect[res]), level=logging.DEBUG)
+			res = self.pexpect_child.expect(expect + [pexpect.TIMEOUT] + [pexpect.EOF], timeout=timeout)
 		if searchwindowsize != None:
 			self.pexpect_child.searchwindowsize = old_searchwindowsize
 		if maxread != None:
 			self.pexpect_child.maxread = old_maxread
+		if self.exit_code_in_prompt:
+			self._strip_prompt_exit_code()
 		# Add to session lines only if pane manager exists.
 		if shutit_global.shutit_global_object.pane_manager and iteration_n == 1:
 			time_seen = time.time()
@@ -627,6 +774,125 @@ class ShutItPexpectSession(object):
 		return res
 
 
+	def _expect_with_capture(self, sendspec):
+		"""Expects as expect() does, but writes the output to a ShutItCapture
+		file as it arrives, keeping only sendspec.capture_tail characters of it
+		in memory. The capture object is put in sendspec.capture.
+		"""
+		shutit = self.shutit
+		expect = sendspec.expect
+		if isinstance(expect, str):
+			expect = [expect]
+		# Regexps are compiled as pexpect does.
+		compiled_expects = [re.compile(item, re.DOTALL) for item in expect]
+		capture = ShutItCapture(shutit_global.shutit_global_object.shutit_state_dir + '/captures/' + shutit_util.random_id() + '.log', sendspec.capture_tail, command=sendspec.send)
+		sendspec.capture = capture
+		shutit.log('Capturing output to: ' + capture.path, level=logging.DEBUG)
+		# Only new output, and as much before it as an expect can match, is
+		# searched on each read. If an expect has no limit, all of the output
+		# kept is.
+		widths  = [shutit_matcher.get_max_match_width(item) for item in expect]
+		overlap = None if None in widths else max(widths)
+		# Keep enough unwritten output to match an expect that spans reads.
+		window = sendspec.capture_tail + (overlap or 0)
+		data = self.pexpect_child.buffer
+		self.pexpect_child.buffer = self.pexpect_child.string_type()
+		deadline = time.time() + sendspec.timeout
+		search_from = 0
+		while True:
+			match = None
+			res = None
+			for i, compiled_expect in enumerate(compiled_expects):
+				this_match = compiled_expect.search(data, search_from)
+				if this_match and (match is None or this_match.start() < match.start()):
+					match = this_match
+					res = i
+			if match:
+				self.pexpect_child.before = data[:match.start()]
+				self.pexpect_child.after  = match.group(0)
+				self.pexpect_child.match  = match
+				self.pexpect_child.buffer = data[match.end():]
+				if self.prompt_sync == 'sentinel' and expect[res] in self.sentinel_prompts and not self._strip_prompt_sentinel():
+					# Not a real prompt, so carry on past it.
+					capture.write(data[:match.end()])
+					data = data[match.end():]
+					search_from = 0
+					self.pexpect_child.buffer = self.pexpect_child.string_type()
+					continue
+				if self.exit_code_in_prompt:
+					self._strip_prompt_exit_code()
+				capture.write(self.pexpect_child.before)
+				self.pexpect_child.before = self.pexpect_child.before[-sendspec.capture_tail:]
+				break
+			if len(data) > window:
+				capture.write(data[:-window])
+				data = data[-window:]
+			search_from = 0 if overlap is None else max(0, len(data) - overlap)
+			remaining = deadline - time.time()
+			try:
+				if remaining <= 0:
+					raise pexpect.TIMEOUT('Timed out')
+				data += self.pexpect_child.read_nonblocking(size=self.pexpect_child.maxread, timeout=remaining)
+			except pexpect.TIMEOUT:
+				capture.write(data)
+				capture.close()
+				shutit.fail('Timed out waiting for: ' + str(expect) + ' while capturing output to: ' + capture.path) # pragma: no cover
+				return len(expect)
+			except pexpect.EOF:
+				capture.write(data)
+				self.pexpect_child.before = data[-sendspec.capture_tail:]
+				self.pexpect_child.after  = pexpect.EOF
+				res = len(expect) + 1
+				break
+		capture.close()
+		return res
+
+
+	def _get_searchwindowsize(self, expect, maxread):
+		"""Returns a search window size for pexpect that is safe for the given
+		expects, so that only the end of the output is scanned for them on each
+		read rather than the whole of it.
+
+		This is only possible if all the expects are prompts set up by ShutIt,
+		as their length is known. Otherwise returns None (search everything).
+
+		@param maxread: Most bytes pexpect reads at a time. A whole read can
+		                follow a prompt, so the window is at least this.
+		"""
+		prompts = self.shutit.expect_prompts.values()
+		for item in expect:
+			if item not in prompts:
+				return None
+		return 2 * max([len(item) for item in expect]) + max(maxread, shutit_global.shutit_global_object.searchwindow_slack)
+
+
+	def _strip_prompt_sentinel(self):
+		"""Returns True if the output before the last match ends with the
+		session's prompt sentinel, removing the sentinel from the output.
+		"""
+		before = self.pexpect_child.before
+		sentinel = self.prompt_sentinel + ':'
+		if not isinstance(before, (str,unicode)) or not before.endswith(sentinel):
+			return False
+		self.pexpect_child.before = before[:-len(sentinel)]
+		return True
+
+
+	def _strip_prompt_exit_code(self):
+		"""If the output before the last match ends with the exit code marker
+		set up by setup_prompt, record the exit code and remove the marker from
+		the output. Otherwise the recorded exit code is None.
+		"""
+		self.last_prompt_exit_code = None
+		before = self.pexpect_child.before
+		if not isinstance(before, (str,unicode)):
+			return
+		match = re.search(shutit_global.shutit_global_object.prompt_exit_code_marker + ':([0-9]+):$', before)
+		if match:
+			self.last_prompt_exit_code = match.group(1)
+			self.pexpect_child.before = before[:match.start()]
+
+
 	def replace_container(self, new_target_image_name, go_home=None):
 		"""Replaces a container. Assumes we are in Docker context.
 		"""
@@ -680,17 +946,61 @@ class ShutItPexpectSession(object):
 		"""
 		shutit = self.shutit
 		shutit.handle_note(note)
-		res = self.send_and_get_output(' command whoami',
-		                               echo=False,
-		                               loglevel=loglevel).strip()
-		if res == '':
-			res = self.send_and_get_output(' command id -u -n',
+		found, res = self._get_fact(('whoami',))
+		if not found:
+			res = self.send_and_get_output(' command whoami',
 			                               echo=False,
 			                               loglevel=loglevel).strip()
+			if res == '':
+				res = self.send_and_get_output(' command id -u -n',
+				                               echo=False,
+				                               loglevel=loglevel).strip()
+			self._set_fact(('whoami',), res)
 		shutit.handle_note_after(note=note)
 		return res
 
 
+	def _get_fact(self, key):
+		"""Looks up a cached probe result for this session in the current
+		environment. See ShutItPexpectSessionEnvironment.get_fact.
+
+		@return: tuple of (found, value)
+		"""
+		if self.current_environment is None:
+			return False, None
+		return self.current_environment.get_fact((self.pexpect_session_id,) + key, self.facts_generation)
+
+
+	def _set_fact(self, key, value, volatile=False):
+		"""Caches a probe result for this session in the current environment.
+
+		@param volatile: If True, the fact is forgotten as soon as any other
+		                 command is sent (eg whether a file exists).
+		"""
+		if self.current_environment is None:
+			return
+		generation = None
+		if volatile:
+			generation = self.facts_generation
+		self.current_environment.set_fact((self.pexpect_session_id,) + key, value, generation)
+
+
+	def invalidate_facts(self, all_sessions=False):
+		"""Forgets cached probe results (whoami, command_available,
+		file_exists etc) for the current environment. Call this if you have
+		changed the environment in a way ShutIt cannot see.
+
+		@param all_sessions: Forget the facts cached by other sessions in this
+		                     environment also.
+		"""
+		if self.current_environment is None:
+			return
+		if all_sessions:
+			self.current_environment.invalidate_facts()
+		else:
+			self.current_environment.invalidate_facts(self.pexpect_session_id)
+
+
 
 	def check_last_exit_values(self,
 	                           send,
@@ -710,32 +1020,50 @@ class ShutItPexpectSession(object):
 			exit_values = ['0']
 		if isinstance(exit_values, int):
 			exit_values = [str(exit_values)]
-		# Don't use send here (will mess up last_output)!
-		# Space before "echo" here is sic - we don't need this to show up in bash history
-		send_exit_code = ' echo EXIT_CODE:$?'
-		shutit.log('Sending with sendline: ' + str(send_exit_code), level=logging.DEBUG)
-		assert not self.sendline(ShutItSendSpec(self,
-		                                        send=send_exit_code,
-		                                        ignore_background=True)), shutit_util.print_debug()
-		shutit.log('Expecting: ' + str(expect), level=logging.DEBUG)
-		self.expect(expect,timeout=10)
-		shutit.log('before: ' + str(self.pexpect_child.before), level=logging.DEBUG)
-		res = shutit.match_string(str(self.pexpect_child.before), '^EXIT_CODE:([0-9][0-9]?[0-9]?)$')
+		if self.exit_code_in_prompt and self.last_prompt_exit_code is not None:
+			# The prompt just matched told us the exit code, so no need to ask.
+			res = self.last_prompt_exit_code
+			shutit.log('Exit code from prompt: ' + res, level=logging.DEBUG)
+		else:
+			# Don't use send here (will mess up last_output)!
+			# Space before "echo" here is sic - we don't need this to show up in bash history
+			send_exit_code = ' echo EXIT_CODE:$?'
+			shutit.log('Sending with sendline: ' + str(send_exit_code), level=logging.DEBUG)
+			assert not self.sendline(ShutItSendSpec(self,
+			                                        send=send_exit_code,
+			                                        ignore_background=True)), shutit_util.print_debug()
+			shutit.log('Expecting: ' + str(expect), level=logging.DEBUG)
+			self.expect(expect,timeout=10)
+			shutit.log('before: ' + str(self.pexpect_child.before), level=logging.DEBUG)
+			res = shutit.match_string(str(self.pexpect_child.before), '^EXIT_CODE:([0-9][0-9]?[0-9]?)$')
 		if res not in exit_values or res is None: # pragma: no cover
-			res_str = res or str(res)
 			shutit.log('shutit_pexpect_child.after: ' + str(self.pexpect_child.after), level=logging.DEBUG)
-			shutit.log('Exit value from command: ' + str(send) + ' was:' + res_str, level=logging.DEBUG)
-			msg = ('\nWARNING: command:\n' + send + '\nreturned unaccepted exit code: ' + res_str + '\nIf this is expected, pass in check_exit=False or an exit_values array into the send function call.')
-			shutit.build['report'] += msg
-			if retbool:
-				return False
-			elif retry == 1 and shutit_global.shutit_global_object.interactive >= 1:
-				# This is a failure, so we pass in level=0
-				shutit.pause_point(msg + '\n\nInteractive, so not retrying.\nPause point on exit_code != 0 (' + res_str + '). CTRL-C to quit', shutit_pexpect_child=self.pexpect_child, level=0)
-			elif retry == 1:
-				shutit.fail('Exit value from command\n' + send + '\nwas:\n' + res_str, throw_exception=False) # pragma: no cover
-			else:
-				return False
+			return self._handle_exit_value_failure(send, res, retry=retry, retbool=retbool)
+		return True
+
+
+	def _handle_exit_value_failure(self,
+	                               send,
+	                               res,
+	                               retry=0,
+	                               retbool=False):
+		"""Internal function to report an unaccepted exit value. Returns False
+		if the caller should retry or handle the failure itself.
+		"""
+		shutit = self.shutit
+		res_str = res or str(res)
+		shutit.log('Exit value from command: ' + str(send) + ' was:' + res_str, level=logging.DEBUG)
+		msg = ('\nWARNING: command:\n' + send + '\nreturned unaccepted exit code: ' + res_str + '\nIf this is expected, pass in check_exit=False or an exit_values array into the send function call.')
+		shutit.build['report'] += msg
+		if retbool:
+			return False
+		elif retry == 1 and shutit_global.shutit_global_object.interactive >= 1:
+			# This is a failure, so we pass in level=0
+			shutit.pause_point(msg + '\n\nInteractive, so not retrying.\nPause point on exit_code != 0 (' + res_str + '). CTRL-C to quit', shutit_pexpect_child=self.pexpect_child, level=0)
+		elif retry == 1:
+			shutit.fail('Exit value from command\n' + send + '\nwas:\n' + res_str, throw_exception=False) # pragma: no cover
+		else:
+			return False
 		return True
 
 
@@ -905,12 +1233,20 @@ class ShutItPexpectSession(object):
 		shutit = self.shutit
 		shutit.handle_note(note, 'Looking for filename in current environment: ' + filename)
 		test_type = '-d' if directory is True else '-e' if directory is None else '-a'
+		found, ret = self._get_fact(('file_exists', test_type, filename))
+		if found:
+			shutit.handle_note_after(note=note)
+			return ret
 		#       v the space is intentional, to avoid polluting bash history.
 		test = ' test %s %s' % (test_type, filename)
-		output = self.send_and_get_output(test + ' && echo FILEXIST-""FILFIN || echo FILNEXIST-""FILFIN',
-		                                  record_command=False,
-		                                  echo=False,
-		                                  loglevel=loglevel)
+		self.probing_facts = True
+		try:
+			output = self.send_and_get_output(test + ' && echo FILEXIST-""FILFIN || echo FILNEXIST-""FILFIN',
+			                                  record_command=False,
+			                                  echo=False,
+			                                  loglevel=loglevel)
+		finally:
+			self.probing_facts = False
 		res = shutit.match_string(output, '^(FILEXIST|FILNEXIST)-FILFIN$')
 		ret = False
 		if res == 'FILEXIST':
@@ -921,6 +1257,8 @@ class ShutItPexpectSession(object):
 			# Change to log?
 			shutit.log(repr('before>>>>:%s<<<< after:>>>>%s<<<<' % (self.pexpect_child.before, self.pexpect_child.after)),transient=True, level=logging.INFO)
 			shutit.fail('Did not see FIL(N)?EXIST in output:\n' + output)
+		# Any command sent from here on could create or remove the file.
+		self._set_fact(('file_exists', test_type, filename), ret, volatile=True)
 		shutit.handle_note_after(note=note)
 		return ret
 
@@ -1296,11 +1634,21 @@ class ShutItPexpectSession(object):
 	                      loglevel=logging.DEBUG):
 		shutit = self.shutit
 		shutit.handle_note(note)
-		output = self.send_and_get_output(' command -V ' + command + ' >/dev/null',
-		                                  echo=False,
-		                                  loglevel=loglevel,
-		                                  check_sudo=False).strip()
-		return output == ''
+		found, ret = self._get_fact(('command_available', command))
+		if found:
+			return ret
+		self.probing_facts = True
+		try:
+			output = self.send_and_get_output(' command -V ' + command + ' >/dev/null',
+			                                  echo=False,
+			                                  loglevel=loglevel,
+			                                  check_sudo=False).strip()
+		finally:
+			self.probing_facts = False
+		ret = output == ''
+		# Commands rarely go away, but any command sent could install one.
+		self._set_fact(('command_available', command), ret, volatile=not ret)
+		return ret
 
 
 	def is_shutit_installed(self,
@@ -1554,6 +1902,8 @@ class ShutItPexpectSession(object):
 			shutit.log('Package not required.', level=logging.DEBUG)
 
 		shutit.log('Package is installed.', level=logging.DEBUG)
+		# Installing packages can add commands, files and users.
+		self.invalidate_facts(all_sessions=True)
 		# Sometimes we see installs (eg yum) reset the terminal to a state
 		# ShutIt does not like.
 		self.reset_terminal()
@@ -1561,64 +1911,30 @@ class ShutItPexpectSession(object):
 		return True
 
 
-	def reset_terminal(self):
+	def reset_terminal(self, timeout=30):
 		"""Resets the terminal to as good a state as we can try.
-		Tries to ensure that we have 'expect'ed the last prompt seen.
-		TODO: see how https://github.com/noahspurrier/pexpect/blob/master/pxssh.py handles this
+		Ensures that we have 'expect'ed the last prompt seen, by sending a
+		marker for the shell to print, taking everything up to it, then
+		expecting the prompt after it.
+
+		@param timeout: Seconds to wait for each of the marker and the prompt.
+		@return: True if the terminal is back at a prompt, else False.
 		"""
 		shutit = self.shutit
 		shutit.log('Resetting terminal begin.', level=logging.DEBUG)
-		########################################################################
-		# Cribbed from https://github.com/noahspurrier/pexpect/blob/master/pxssh.py#L145
-		# All of these timing pace values are magic.
-		# I came up with these based on what seemed reliable for
-		# connecting to a heavily loaded machine I have.
-		self.pexpect_child.sendline()
-		time.sleep(0.1)
-		# If latency is worse than these values then this will fail.
-		try:
-			# Clear the buffer before getting the prompt.
-			self.pexpect_child.read_nonblocking(size=10000,timeout=1)
-		except pexpect.TIMEOUT:
-			pass
-		time.sleep(0.1)
-		self.pexpect_child.sendline()
-		time.sleep(0.5)
-		self.pexpect_child.read_nonblocking(size=1000,timeout=1)
-		time.sleep(0.1)
-		self.pexpect_child.sendline()
-		time.sleep(0.5)
-		a = self.pexpect_child.read_nonblocking(size=1000,timeout=1)
-		time.sleep(0.1)
-		self.pexpect_child.sendline()
-		time.sleep(0.5)
-		b = self.pexpect_child.read_nonblocking(size=1000,timeout=1)
-		ld = self.levenshtein_distance(a,b)
-		if len(a) == 0:
+		marker = 'SHUTIT_RESYNC_' + shutit_util.random_id()
+		# The marker is split in the command so that the echoed command does not match.
+		self.pexpect_child.sendline(' echo ' + marker[:2] + '""' + marker[2:])
+		# Anything still to come from before, eg prompts, is output before the marker.
+		if self.pexpect_child.expect([marker + '\r?\n', pexpect.TIMEOUT, pexpect.EOF], timeout=timeout) != 0:
+			shutit.log('Resetting terminal: marker not seen', level=logging.DEBUG)
 			return False
-		if float(ld)/len(a) < 0.4:
-			return True
-		return False
-		########################################################################
-
-
-	def levenshtein_distance(self, a,b):
-		'''This calculates the Levenshtein distance between a and b.
-		'''
-		n, m = len(a), len(b)
-		if n > m:
-			a,b = b,a
-			n,m = m,n
-		current = range(n+1)
-		for i in range(1,m+1):
-			previous, current = current, [i]+[0]*n
-			for j in range(1,n+1):
-				add, delete = previous[j]+1, current[j-1]+1
-				change = previous[j-1]
-				if a[j-1] != b[i-1]:
-					change = change + 1
-				current[j] = min(add, delete, change)
-		return current[n]
+		expect = self.default_expect
+		if isinstance(expect, str):
+			expect = [expect]
+		res = self.expect(expect, timeout=timeout)
+		shutit.log('Resetting terminal end, result: ' + str(res), level=logging.DEBUG)
+		return res < len(expect)
 
 
 	def get_memory(self, note=None):
@@ -1730,6 +2046,7 @@ class ShutItPexpectSession(object):
 			                         ignore_background=False,
 			                         run_in_background=False,
 			                         block_other_commands=True))
+		self.invalidate_facts(all_sessions=True)
 		shutit.handle_note_after(note=note)
 		return True
 
@@ -1767,13 +2084,10 @@ class ShutItPexpectSession(object):
 		                                  strip=strip,
 		                                  echo=echo,
 		                                  loglevel=loglevel)
-		if isinstance(matches, str):
-			matches = [matches]
 		shutit.handle_note_after(note=note)
-		for match in matches:
-			if shutit.match_string(output, match) != None:
-				shutit.log('Matched output, return True', level=logging.DEBUG)
-				return True
+		if shutit.get_line_matcher(matches, 'send_and_match_output').match(output) is not None:
+			shutit.log('Matched output, return True', level=logging.DEBUG)
+			return True
 		shutit.log('Failed to match output, return False', level=logging.DEBUG)
 		return False
 
@@ -1860,6 +2174,11 @@ class ShutItPexpectSession(object):
 			before = before[len(send):]
 			# Strip whitespace again
 			before = before.strip()
+		elif len(send) > shutit_global.shutit_global_object.line_limit and before.startswith('command source '):
+			# Long commands are sourced from a file (see send), so it is that
+			# which was echoed.
+			before = before.split('\n', 1)[-1] if '\n' in before else ''
+			before = before.strip()
 		shutit.log('send_and_get_output "before" after startswith check: ' + before, level=logging.DEBUG)
 		# Too chatty, but kept here in case useful for debugging
 		shutit.log('send_and_get_output got: ' + before, level=logging.DEBUG)
@@ -1881,6 +2200,125 @@ class ShutItPexpectSession(object):
 		return before
 
 
+	def send_and_stream(self,
+	                    send,
+	                    timeout=None,
+	                    strip=True,
+	                    note=None,
+	                    record_command=True,
+	                    echo=None,
+	                    filter_backspaces=True,
+	                    loglevel=logging.INFO):
+		"""Sends a command, and returns an iterator that yields its output a
+		line at a time as it arrives, rather than waiting for the command to
+		finish. Only the current line is held in memory. Exit is not checked.
+
+		The command is sent before this returns. If the iterator is not run
+		to the end, the rest of the output is read and dropped when it is
+		closed, or when anything else is sent to this session.
+
+		@param send:              See send()
+		@param timeout:           Timeout waiting for each line. See send()
+		@param strip:             Whether to strip whitespace and ansi
+		                          terminal codes from each line (default True)
+		@param note:              See send()
+		@param record_command:    See send()
+		@param echo:              See send()
+		@param filter_backspaces: Whether to drop lines with backspaces in (see
+		                          send_and_get_output)
+
+		@type strip:              boolean
+		@rtype:                   iterator of strings
+		"""
+		shutit = self.shutit
+		shutit.handle_note(note, command=str(send))
+		shutit.log('Streaming output from command: ' + send, level=loglevel)
+		send = shutit.get_send_command(send)
+		if timeout is None:
+			timeout = 3600
+		if record_command:
+			shutit.build['shutit_command_history'].append(send)
+		echo = shutit.get_echo_override(echo)
+		if echo:
+			shutit.divert_output(sys.stdout)
+		if self.sendline(ShutItSendSpec(self,
+		                                send=send,
+		                                echo=echo,
+		                                loglevel=loglevel)):
+			# Backgrounded or blocked, so nothing to stream.
+			if echo:
+				shutit.divert_output(None)
+			return iter([])
+		self.active_stream      = self._stream_output(send, timeout, strip, note, echo, filter_backspaces)
+		self.active_stream_echo = echo
+		return self.active_stream
+
+
+	def _stream_output(self, send, timeout, strip, note, echo, filter_backspaces):
+		"""Yields the output of the command send_and_stream has sent, a line
+		at a time, until the prompt is seen. If closed before then, the rest
+		of the output is read to the prompt.
+		"""
+		shutit = self.shutit
+		expect = self.default_expect
+		if isinstance(expect, str):
+			expect = [expect]
+		ansi_escape = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]')
+		seen_send = False
+		at_prompt = False
+		try:
+			while True:
+				res = self.expect(expect + ['\r\n'], timeout=timeout)
+				if res > len(expect):
+					at_prompt = True
+					shutit.fail('Timeout or EOF while streaming output from: ' + send, throw_exception=False) # pragma: no cover
+					return
+				at_prompt = res < len(expect)
+				line = self.pexpect_child.before
+				if filter_backspaces and line.find('\x08') != -1:
+					if at_prompt:
+						break
+					continue
+				if strip:
+					line = ansi_escape.sub('', line).strip()
+				line = line.replace('\r','').replace('\x07','')
+				# The first line is the command we sent.
+				if not seen_send and line.strip() == send.strip():
+					seen_send = True
+					continue
+				seen_send = True
+				# The prompt ends the output, and may follow a final unterminated line.
+				if at_prompt:
+					if line != '':
+						yield line
+					break
+				yield line
+			shutit.handle_note_after(note=note)
+		finally:
+			if not at_prompt:
+				shutit.log('Dropping the rest of the output of: ' + send, level=logging.DEBUG)
+				self.expect(expect, timeout=timeout)
+			self.active_stream = None
+			if echo:
+				shutit.divert_output(None)
+
+
+	def _finish_stream(self):
+		"""Reads and drops the rest of the output of the command
+		send_and_stream last sent, if any, so the session is back at a prompt.
+		"""
+		stream = self.active_stream
+		for _ in stream:
+			pass
+		if self.active_stream is stream:
+			# It was closed before it was started, so nothing has read the
+			# output.
+			self.expect(self.default_expect)
+			self.active_stream = None
+			if self.active_stream_echo:
+				self.shutit.divert_output(None)
+
+
 	def get_env_pass(self,user=None,msg=None,note=None):
 		"""Gets a password from the user if one is not already recorded for this environment.
 
@@ -1916,9 +2354,12 @@ class ShutItPexpectSession(object):
 		"""
 		shutit = self.shutit
 		shutit.handle_note(note)
-		res = self.send_and_get_output(' command id -n -g',
-		                               echo=False,
-		                               loglevel=loglevel).strip()
+		found, res = self._get_fact(('whoarewe',))
+		if not found:
+			res = self.send_and_get_output(' command id -n -g',
+			                               echo=False,
+			                               loglevel=loglevel).strip()
+			self._set_fact(('whoarewe',), res)
 		shutit.handle_note_after(note=note)
 		return res
 
@@ -1930,7 +2371,13 @@ class ShutItPexpectSession(object):
 		Should be called with the container is started up, and uses as core info
 		as possible.
 
-		Note: if the install type is apt, it issues the following:
+		The facts are gathered by a single probe script (see
+		shutit_assets.get_distro_probe_script), and the result is stored by
+		container/machine id so the docker target need not be probed again,
+		and a machine already set up (eg apk's bash) is not set up again.
+
+		Note: if distro_override is set and the install type is apt, it issues
+		the following:
 		    - apt-get -qq update
 		    - apt-get -qq install -y lsb-release
 
@@ -2009,144 +2456,48 @@ class ShutItPexpectSession(object):
 			elif install_type == 'docker' and shutit.build['delivery'] in ('docker','dockerfile'):
 				distro = 'coreos'
 				distro_version = '1.0'
-		elif self.command_available('lsb_release'):
-			d = self.lsb_release()
-			install_type   = d['install_type']
-			distro         = d['distro']
-			distro_version = d['distro_version']
 		else:
-			issue_output = self.send_and_get_output(' command cat /etc/issue',
-			                                        echo=False,
-			                                        ignore_background=True,
-			                                        loglevel=loglevel).lower()
-			if not re.match('.*No such file.*',issue_output):
-				for key in package_map.INSTALL_TYPE_MAP:
-					if issue_output.find(key) != -1:
-						distro       = key
-						install_type = package_map.INSTALL_TYPE_MAP[key]
-						break
-			elif self.file_exists('/cygdrive'):
-				distro       = 'cygwin'
-				install_type = 'apt-cyg'
-			if install_type == '' or distro == '':
-				if self.file_exists('/etc/os-release'):
-					os_name = self.send_and_get_output(' command cat /etc/os-release | grep ^NAME',
-					                                   echo=False,
-					                                   ignore_background=True,
-					                                   loglevel=loglevel).lower()
-					if os_name.find('centos') != -1:
-						distro       = 'centos'
-						install_type = 'yum'
-					elif os_name.find('red hat') != -1:
-						distro       = 'red hat'
-						install_type = 'yum'
-					elif os_name.find('fedora') != -1:
-						# TODO: distinguish with dnf - fedora 23+? search for dnf in here
-						distro       = 'fedora'
-						install_type = 'yum'
-					elif os_name.find('gentoo') != -1:
-						distro       = 'gentoo'
-						install_type = 'emerge'
-					elif os_name.find('coreos') != -1:
-						distro       = 'coreos'
-						install_type = 'docker'
-				else:
-					uname_output = self.send_and_get_output(" command uname -a | awk '{print $1}'",
-					                                        echo=False,
-					                                        ignore_background=True,
-					                                        loglevel=loglevel)
-					if uname_output == 'Darwin':
-						distro = 'osx'
-						install_type = 'brew'
-						if not self.command_available('brew'):
-							shutit.fail('ShutiIt requires brew be installed. See http://brew.sh for details on installation.') # pragma: no cover
-						if not self.file_exists('/tmp/shutit_brew_list'):
-							if self.whoami() != 'root':
-								self.send(ShutItSendSpec(self,
-								                         send=' brew list > .shutit_brew_list',
-								                         echo=False,
-								                         ignore_background=True,
-								                         loglevel=loglevel))
-							else:
-								pass
-						for package in ('coreutils','findutils','gnu-tar','gnu-sed','gawk','gnutls','gnu-indent','gnu-getopt'):
-							if self.send_and_get_output(' command cat .shutit_brew_list | grep -w ' + package,
-							                            echo=False,
-							                            loglevel=loglevel) == '':
-								self.send(ShutItSendSpec(self,
-								                         send='brew install ' + package,
-								                         ignore_background=True,
-								                         loglevel=loglevel))
-						self.send(ShutItSendSpec(self,
-						                         send='rm -f .shutit_brew_list',
-						                         echo=False,
-						                         ignore_background=True,
-						                         loglevel=loglevel))
-					if uname_output[:6] == 'CYGWIN':
-						distro       = 'cygwin'
-						install_type = 'apt-cyg'
+			# Re-entering an environment we have already identified (perhaps in
+			# a previous build) costs no round trips.
+			distro_info_key = self._get_distro_info_key()
+			distro_info = self._load_distro_info(distro_info_key)
+			if distro_info is None:
+				facts = self._probe_environment(loglevel=loglevel)
+				distro_info = self._load_distro_info(facts.get('FINGERPRINT'))
+			if distro_info is None:
+				install_type, distro, distro_version = self._parse_distro_facts(facts)
 				if install_type == '' or distro == '':
 					shutit.fail('Could not determine Linux distro information. ' + 'Please inform ShutIt maintainers at https://github.com/ianmiell/shutit', shutit_pexpect_child=self.pexpect_child) # pragma: no cover
-			# The call to self.package_installed with lsb-release above
-			# may fail if it doesn't know the install type, so
-			# if we've determined that now
-			if install_type == 'apt' and shutit.build['delivery'] in ('docker','dockerfile'):
-				if not self.command_available('lsb_release'):
-					if not shutit.get_current_shutit_pexpect_session_environment().build['apt_update_done'] and self.whoami() == 'root':
-						shutit.get_current_shutit_pexpect_session_environment().build['apt_update_done'] = True
+				if install_type == 'apk' and shutit.build['delivery'] in ('docker','dockerfile'):
+					if not shutit.get_current_shutit_pexpect_session_environment().build['apk_update_done'] and self.whoami() == 'root':
 						self.send(ShutItSendSpec(self,
-						                         send='DEBIAN_FRONTEND=noninteractive apt-get -qq update && apt-get -qq install -y lsb-release',
-						                         loglevel=loglevel,
-						                         ignore_background=True))
-					self.send(ShutItSendSpec(self,
-					                         send='DEBIAN_FRONTEND=noninteractive apt-get -qq install -y lsb-release',
-					                         loglevel=loglevel,
-					                         ignore_background=True))
-				d = self.lsb_release()
-				install_type   = d['install_type']
-				distro         = d['distro']
-				distro_version = d['distro_version']
-			elif install_type == 'yum' and shutit.build['delivery'] in ('docker','dockerfile'):
-				if self.file_exists('/etc/redhat-release'):
-					output = self.send_and_get_output(' command cat /etc/redhat-release',
-					                                  echo=False,
-					                                  loglevel=loglevel)
-					if re.match('^centos.*$', output.lower()) or re.match('^red hat.*$', output.lower()) or re.match('^fedora.*$', output.lower()) or True:
-						self.send_and_match_output('yum install -y -t redhat-lsb',
-						                           'Complete!',
-						                           loglevel=loglevel)
-				else:
-					if not self.command_available('lsb_release'):
-						self.send(ShutItSendSpec(self,
-						                         send='yum install -y lsb-release',
+						                         send='apk -q update',
 						                         ignore_background=True,
-						                         loglevel=loglevel))
-				d = self.lsb_release()
-				install_type   = d['install_type']
-				distro         = d['distro']
-				distro_version = d['distro_version']
-			elif install_type == 'apk' and shutit.build['delivery'] in ('docker','dockerfile'):
-				if not shutit.get_current_shutit_pexpect_session_environment().build['apk_update_done'] and self.whoami() == 'root':
+						                         loglevel=logging.INFO))
+						shutit.get_current_shutit_pexpect_session_environment().build['apk_update_done'] = True
 					self.send(ShutItSendSpec(self,
-					                         send='apk -q update',
+					                         send='apk -q add bash',
 					                         ignore_background=True,
-					                         loglevel=logging.INFO))
-					shutit.get_current_shutit_pexpect_session_environment().build['apk_update_done'] = True
-				self.send(ShutItSendSpec(self,
-				                         send='apk -q add bash',
-				                         ignore_background=True,
-				                         loglevel=loglevel))
-				install_type   = 'apk'
-				distro         = 'alpine'
-				distro_version = '1.0'
-			elif install_type == 'emerge' and shutit.build['delivery'] in ('docker','dockerfile'):
-				if not shutit.get_current_shutit_pexpect_session_environment().build['emerge_update_done'] and self.whoami() == 'root':
-					# Takes bloody ages!
-					#self.send(ShutItSendSpec(self,send='emerge --sync', loglevel=logging.INFO,ignore_background=True))
-					pass
-				install_type = 'emerge'
-				distro = 'gentoo'
-				distro_version = '1.0'
+					                         loglevel=loglevel))
+					distro_version = '1.0'
+				elif install_type == 'emerge' and shutit.build['delivery'] in ('docker','dockerfile'):
+					distro_version = '1.0'
+				elif distro == 'osx':
+					if facts.get('BREW') != '1':
+						shutit.fail('ShutiIt requires brew be installed. See http://brew.sh for details on installation.') # pragma: no cover
+					brew_list = self.send_and_get_output(' command brew list',
+					                                     echo=False,
+					                                     ignore_background=True,
+					                                     loglevel=loglevel).split()
+					for package in ('coreutils','findutils','gnu-tar','gnu-sed','gawk','gnutls','gnu-indent','gnu-getopt'):
+						if package not in brew_list:
+							self.send(ShutItSendSpec(self,
+							                         send='brew install ' + package,
+							                         ignore_background=True,
+							                         loglevel=loglevel))
+				self._save_distro_info(facts.get('FINGERPRINT'), install_type, distro, distro_version)
+			else:
+				install_type, distro, distro_version = distro_info
 		# We should have the distro info now, let's assign to target config
 		# if this is not a one-off.
 		self.current_environment.install_type   = install_type
@@ -2155,6 +2506,134 @@ class ShutItPexpectSession(object):
 		return True
 
 
+	def _probe_environment(self, loglevel=logging.DEBUG):
+		"""Runs the distro probe script (see shutit_assets) in one round trip.
+
+		@return: dict of the facts found, eg {'OS_ID':'ubuntu', 'UNAME':'Linux'}
+		"""
+		output = self.send_and_get_output(shutit_assets.get_distro_probe_script(),
+		                                  echo=False,
+		                                  record_command=False,
+		                                  ignore_background=True,
+		                                  loglevel=loglevel)
+		facts = {}
+		for line in output.splitlines():
+			match = re.match('^SHUTIT_PROBE:([A-Z_]+):(.*)$', line.strip())
+			if match:
+				facts[match.group(1)] = match.group(2).strip()
+		self.shutit.log('Environment probe found: ' + str(facts), level=logging.DEBUG)
+		return facts
+
+
+	def _parse_distro_facts(self, facts):
+		"""Works out the install type, distro and version from probed facts.
+
+		@return: tuple of (install_type, distro, distro_version)
+		"""
+		install_type   = ''
+		distro         = ''
+		distro_version = ''
+		if facts.get('LSB_ID'):
+			distro = facts['LSB_ID'].lower()
+			if distro not in package_map.INSTALL_TYPE_MAP:
+				raise Exception("Distribution '%s' is not supported." % facts['LSB_ID'])
+			install_type   = package_map.INSTALL_TYPE_MAP[distro]
+			distro_version = facts.get('LSB_RELEASE','')
+		elif facts.get('OS_RELEASE') == '1':
+			os_id   = facts.get('OS_ID','').lower()
+			os_name = facts.get('OS_NAME','').lower()
+			if os_id in package_map.INSTALL_TYPE_MAP:
+				distro = os_id
+			elif os_name.replace(' ','') in package_map.INSTALL_TYPE_MAP:
+				distro = os_name.replace(' ','')
+			else:
+				for key in ('centos','red hat','fedora','gentoo','coreos','amazon'):
+					if os_name.find(key) != -1:
+						distro = key
+						break
+			if distro != '':
+				install_type = package_map.INSTALL_TYPE_MAP[distro]
+		if install_type == '' or distro == '':
+			if 'ISSUE' in facts:
+				issue = facts['ISSUE'].lower()
+				for key in package_map.INSTALL_TYPE_MAP:
+					if issue.find(key) != -1:
+						distro       = key
+						install_type = package_map.INSTALL_TYPE_MAP[key]
+						break
+			elif facts.get('CYGDRIVE') == '1':
+				distro       = 'cygwin'
+				install_type = 'apt-cyg'
+			elif facts.get('UNAME') == 'Darwin':
+				distro       = 'osx'
+				install_type = 'brew'
+			elif facts.get('UNAME','')[:6] == 'CYGWIN':
+				distro       = 'cygwin'
+				install_type = 'apt-cyg'
+		# Without lsb_release, get the version as it would give it: the full
+		# release on redhat-likes (eg 7.9.2009), else the os-release VERSION_ID.
+		if distro_version == '' and install_type == 'yum' and facts.get('REDHAT_RELEASE'):
+			match = re.search(r'release\s+([0-9][0-9.]*)', facts['REDHAT_RELEASE'])
+			if match:
+				distro_version = match.group(1)
+		if distro_version == '':
+			distro_version = facts.get('OS_VERSION_ID','')
+		return install_type, distro, distro_version
+
+
+	def _get_distro_info_key(self):
+		"""Returns the key under which this environment's distro info is
+		persisted, if we can tell without asking the target, else None.
+		"""
+		shutit = self.shutit
+		# The docker target's first shell: we already know the container id.
+		if (shutit.build['delivery'] in ('docker','dockerfile') and
+		    self.pexpect_session_id == 'target_child' and
+		    self.login_stack.length() == 0 and
+		    shutit.target.get('container_id')):
+			return 'container_' + shutit.target['container_id']
+		return None
+
+
+	def _load_distro_info(self, key):
+		"""Returns (install_type, distro, distro_version) persisted for the given
+		key, or None if there is none.
+
+		The key is a container or machine id, and is stored with the info, so
+		info is only used for the machine it was got from.
+		"""
+		if not key:
+			return None
+		distro_info_cache = shutit_global.shutit_global_object.distro_info_cache
+		if key not in distro_info_cache:
+			filename = shutit_global.shutit_global_object.distro_info_dir + '/' + key
+			if not os.path.isfile(filename):
+				return None
+			with open(filename) as distro_info_file:
+				distro_info = distro_info_file.read().split('\n')
+			if len(distro_info) < 4 or distro_info[3] != key:
+				return None
+			distro_info_cache[key] = tuple(distro_info[:3])
+		self.shutit.log('Using stored distro info for: ' + key, level=logging.DEBUG)
+		return distro_info_cache[key]
+
+
+	def _save_distro_info(self, key, install_type, distro, distro_version):
+		"""Persists distro info for the given key, for _load_distro_info.
+		"""
+		if not key:
+			return
+		shutit_global.shutit_global_object.distro_info_cache[key] = (install_type, distro, distro_version)
+		distro_info_dir = shutit_global.shutit_global_object.distro_info_dir
+		try:
+			if not os.path.exists(distro_info_dir):
+				os.makedirs(distro_info_dir)
+			with open(distro_info_dir + '/' + key, 'w') as distro_info_file:
+				distro_info_file.write('\n'.join((install_type, distro, distro_version, key)))
+		except (IOError, OSError) as e:
+			self.shutit.log('Could not store distro info: ' + str(e), level=logging.DEBUG)
+
+
 
 	def multisend(self, sendspec):
 		"""Multisend. Same as send, except it takes multiple sends and expects in a dict that are
@@ -2292,6 +2771,7 @@ class ShutItPexpectSession(object):
 			regexps = [regexps]
 		if not isinstance(regexps, list):
 			shutit.fail('regexps should be list') # pragma: no cover
+		matcher = shutit.get_line_matcher(regexps, 'send_until')
 		while retries > 0:
 			retries -= 1
 			echo = shutit.get_echo_override(echo)
@@ -2304,21 +2784,11 @@ class ShutItPexpectSession(object):
 			                                  fail_on_empty_before=False)
 			shutit.log('Failed to match regexps -> ' + str(regexps) + ' <- retries left:' + str(retries), level=loglevel)
 			if not not_there:
-				for regexp in regexps:
-					if not shutit_util.check_regexp(regexp):
-						shutit.fail('Illegal regexp found in send_until call: ' + regexp) # pragma: no cover
-					if shutit.match_string(output, regexp):
-						return True
+				if matcher.match(output):
+					return True
 			else:
 				# Only return if _not_ seen in the output
-				missing = False
-				for regexp in regexps:
-					if not shutit_util.check_regexp(regexp):
-						shutit.fail('Illegal regexp found in send_until call: ' + regexp) # pragma: no cover
-					if not shutit.match_string(output, regexp):
-						missing = True
-						break
-				if missing:
+				if matcher.missing(output):
 					shutit.handle_note_after(note=note)
 					return True
 			if debug_command is not None:
@@ -2372,6 +2842,47 @@ class ShutItPexpectSession(object):
 		"""
 		shutit = self.shutit
 		shutit.handle_note(note)
+		if replace:
+			# If replace and no pattern FAIL
+			if not pattern:
+				shutit.fail('replace=True requires a pattern to be passed in') # pragma: no cover
+			# If replace and delete FAIL
+			if delete:
+				shutit.fail('cannot pass replace=True and delete=True to insert_text') # pragma: no cover
+		if pattern is not None and not delete and not shutit_util.check_regexp(pattern):
+			shutit.fail('Illegal regexp found in change_text call: ' + pattern) # pragma: no cover
+		edit_command = self._get_edit_command()
+		if edit_command is not None:
+			# Edit in place on the target, sending only the spec.
+			spec = json.dumps({'text':          text,
+			                   'pattern':       pattern,
+			                   'before':        before,
+			                   'force':         force,
+			                   'delete':        delete,
+			                   'replace':       replace,
+			                   'line_oriented': line_oriented,
+			                   'create':        create,
+			                   'encoding':      shutit_global.shutit_global_object.default_encoding})
+			spec = base64.b64encode(spec.encode('utf-8')).decode('ascii')
+			if len(spec) > shutit_global.shutit_global_object.line_limit:
+				# Too long for the command line, so send it as a file.
+				spec_path = shutit_global.shutit_global_object.shutit_state_dir + '/scripts/edit_spec_' + shutit_util.random_id()
+				self.send_file(spec_path, spec, loglevel=logging.DEBUG)
+				spec = '@' + spec_path
+			output = self.send_and_get_output(' ' + edit_command + ' ' + fname + ' ' + spec,
+			                                  echo=False,
+			                                  record_command=False,
+			                                  loglevel=loglevel)
+			if shutit_edit.RESULT_MISSING in output:
+				shutit.fail(fname + ' does not exist and create=False') # pragma: no cover
+			elif shutit_edit.RESULT_NOMATCH in output:
+				return None
+			elif shutit_edit.RESULT_OK not in output:
+				shutit.fail('Failed to change text in ' + fname + ', output was:\n' + output) # pragma: no cover
+			shutit.handle_note_after(note=note)
+			return True
+		# No python on the target, so bring the file back, edit it here, and
+		# send it back.
 		fexists = self.file_exists(fname)
 		if not fexists:
 			if create:
@@ -2382,13 +2893,6 @@ class ShutItPexpectSession(object):
 				                         ignore_background=True))
 			else:
 				shutit.fail(fname + ' does not exist and create=False') # pragma: no cover
-		if replace:
-			# If replace and no pattern FAIL
-			if not pattern:
-				shutit.fail('replace=True requires a pattern to be passed in') # pragma: no cover
-			# If replace and delete FAIL
-			if delete:
-				shutit.fail('cannot pass replace=True and delete=True to insert_text') # pragma: no cover
 		# ftext is the original file's text. If base64 is available, use it to
 		# encode the text
 		if self.command_available('base64'):
@@ -2415,146 +2919,20 @@ class ShutItPexpectSession(object):
 				                                 echo=False,
 				                                 loglevel=loglevel)
 				ftext = ftext.replace('\r\n','\n')
-		# Delete the text
-		if delete:
-			if shutit_global.shutit_global_object.ispy3:
-				loc = ftext.find(bytes(text,shutit_global.shutit_global_object.default_encoding))
-			else:
-				loc = ftext.find(text)
-			if loc == -1:
-				# No output - no match
-				return None
-			else:
-				new_text = ftext[:loc] + ftext[loc+len(text)+1:]
-		else:
-			if pattern != None:
-				if not line_oriented:
-					if not shutit_util.check_regexp(pattern):
-						shutit.fail('Illegal regexp found in change_text call: ' + pattern) # pragma: no cover
-					# cf: http://stackoverflow.com/questions/9411041/matching-ranges-of-lines-in-python-like-sed-ranges
-					if shutit_global.shutit_global_object.ispy3:
-						sre_match = re.search(bytes(pattern,shutit_global.shutit_global_object.default_encoding),ftext,re.DOTALL|re.MULTILINE)
-					else:
-						sre_match = re.search(pattern,ftext,re.DOTALL|re.MULTILINE)
-					if replace:
-						if sre_match is None:
-							cut_point = len(ftext)
-							newtext1 = ftext[:cut_point]
-							newtext2 = ftext[cut_point:]
-						else:
-							cut_point = sre_match.start()
-							cut_point_after = sre_match.end()
-							newtext1 = ftext[:cut_point]
-							newtext2 = ftext[cut_point_after:]
-					else:
-						if sre_match is None:
-							# No output - no match
-							return None
-						elif before:
-							cut_point = sre_match.start()
-							# If the text is already there and we're not forcing it, return None.
-							if shutit_global.shutit_global_object.ispy3:
-								if not force and ftext[cut_point-len(text):].find(bytes(text,shutit_global.shutit_global_object.default_encoding)) > 0:
-									return None
-							else:
-								if not force and ftext[cut_point-len(text):].find(text) > 0:
-									return None
-						else:
-							cut_point = sre_match.end()
-							# If the text is already there and we're not forcing it, return None.
-							if shutit_global.shutit_global_object.ispy3:
-								if not force and ftext[cut_point:].find(bytes(text,shutit_global.shutit_global_object.default_encoding)) > 0:
-									return None
-							else:
-								if not force and ftext[cut_point:].find(text) > 0:
-									return None
-						newtext1 = ftext[:cut_point]
-						newtext2 = ftext[cut_point:]
-				else:
-					if shutit_global.shutit_global_object.ispy3:
-						lines = ftext.split(bytes('\n',shutit_global.shutit_global_object.default_encoding))
-					else:
-						lines = ftext.split('\n')
-					cut_point   = 0
-					line_length = 0
-					matched     = False
-					if not shutit_util.check_regexp(pattern):
-						shutit.fail('Illegal regexp found in change_text call: ' + pattern) # pragma: no cover
-					for line in lines:
-						#Help the user out to make this properly line-oriented
-						pattern_before=''
-						pattern_after=''
-						if not pattern or pattern[0] != '^':
-							pattern_before = '^.*'
-						if not pattern or pattern[-1] != '$':
-							pattern_after = '.*$'
-						new_pattern = pattern_before+pattern+pattern_after
-						if shutit_global.shutit_global_object.ispy3:
-							match = re.search(bytes(new_pattern,shutit_global.shutit_global_object.default_encoding), line)
-						else:
-							match = re.search(new_pattern, line)
-						line_length = len(line)
-						if match != None:
-							matched=True
-							break
-						# Update cut point to next line, including newline in original text
-						cut_point += line_length+1
-					if not replace and not matched:
-						# No match, return none
-						return None
-					if replace and not matched:
-						cut_point = len(ftext)
-					elif not replace and not before:
-						cut_point += line_length
-					# newtext1 is everything up to the cutpoint
-					newtext1 = ftext[:cut_point]
-					# newtext2 is everything after the cutpoint
-					newtext2 = ftext[cut_point:]
-					# if replacing and we matched the output in a line, then set newtext2 to be everything from cutpoint's line end
-					if replace and matched:
-						newtext2 = ftext[cut_point+line_length:]
-					elif not force:
-						# If the text is already there and we're not forcing it, return None.
-						if shutit_global.shutit_global_object.ispy3:
-							if before and ftext[cut_point-len(text):].find(bytes(text,shutit_global.shutit_global_object.default_encoding)) > 0:
-								return None
-							if not before and ftext[cut_point:].find(bytes(text,shutit_global.shutit_global_object.default_encoding)) > 0:
-								return None
-						else:
-							if before and ftext[cut_point-len(text):].find(text) > 0:
-								return None
-							if not before and ftext[cut_point:].find(text) > 0:
-								return None
-					# Add a newline to newtext1 if it is not already there
-					if shutit_global.shutit_global_object.ispy3:
-						if newtext1 and bytes(newtext1.decode(shutit_global.shutit_global_object.default_encoding)[-1],shutit_global.shutit_global_object.default_encoding) != bytes('\n',shutit_global.shutit_global_object.default_encoding):
-							newtext1 += bytes('\n',shutit_global.shutit_global_object.default_encoding)
-					else:
-						if newtext1 and newtext1[-1] != '\n':
-							newtext1 += '\n'
-					# Add a newline to newtext2 if it is not already there
-					if shutit_global.shutit_global_object.ispy3:
-						if newtext2 and bytes(newtext2.decode(shutit_global.shutit_global_object.default_encoding)[0],shutit_global.shutit_global_object.default_encoding) != bytes('\n',shutit_global.shutit_global_object.default_encoding):
-							newtext2 = bytes('\n',shutit_global.shutit_global_object.default_encoding) + newtext2
-					else:
-						if newtext2 and newtext2[0] != '\n':
-							newtext2 = '\n' + newtext2
-			else:
-				# Append to file absent a pattern.
-				cut_point = len(ftext)
-				newtext1 = ftext[:cut_point]
-				newtext2 = ftext[cut_point:]
-			# If adding or replacing at the end of the file, then ensure we have a newline at the end
-			if shutit_global.shutit_global_object.ispy3:
-				if newtext2 == b'' and text and bytes(text[-1],shutit_global.shutit_global_object.default_encoding) != bytes('\n',shutit_global.shutit_global_object.default_encoding):
-					newtext2 = bytes('\n',shutit_global.shutit_global_object.default_encoding)
-			else:
-				if newtext2 == '' and text and text[-1] != '\n':
-					newtext2 = '\n'
-			if shutit_global.shutit_global_object.ispy3:
-				new_text = newtext1 + bytes(text,shutit_global.shutit_global_object.default_encoding) + newtext2
-			else:
-				new_text = newtext1 + text + newtext2
+		if shutit_global.shutit_global_object.ispy3:
+			text = bytes(text, shutit_global.shutit_global_object.default_encoding)
+			if pattern is not None:
+				pattern = bytes(pattern, shutit_global.shutit_global_object.default_encoding)
+		new_text = shutit_edit.change_text(ftext,
+		                                   text,
+		                                   pattern=pattern,
+		                                   before=before,
+		                                   force=force,
+		                                   delete=delete,
+		                                   replace=replace,
+		                                   line_oriented=line_oriented)
+		if new_text is None:
+			return None
 		self.send_file(fname,
 		               new_text,
 		               truncate=True,
@@ -2563,6 +2941,32 @@ class ShutItPexpectSession(object):
 		return True
 
 
+	def _get_edit_command(self):
+		"""Ships the edit program (see shutit_edit) to the target, once per
+		environment.
+
+		@return: the command to run it, or None if there is no python on the
+		         target to run it with.
+		"""
+		found, edit_command = self._get_fact(('edit_command',))
+		if found:
+			return edit_command
+		scripts_dir = shutit_global.shutit_global_object.shutit_state_dir + '/scripts'
+		edit_command = None
+		python = self.send_and_get_output(' command mkdir -p ' + scripts_dir + ' 2>/dev/null; for p in python3 python python2; do command -v $p && break; done',
+		                                  echo=False,
+		                                  record_command=False,
+		                                  ignore_background=True,
+		                                  loglevel=logging.DEBUG).strip()
+		if python[:1] == '/':
+			self.send_file(scripts_dir + '/shutit_edit.py',
+			               inspect.getsource(shutit_edit),
+			               loglevel=logging.DEBUG)
+			edit_command = python + ' ' + scripts_dir + '/shutit_edit.py'
+		self._set_fact(('edit_command',), edit_command)
+		return edit_command
+
+
 
 
 	def remove_line_from_file(self,
@@ -2791,21 +3195,9 @@ class ShutItPexpectSession(object):
 
 		while sendspec.retry > 0:
 			if sendspec.escape:
-				escaped_str = "eval $'"
-				_count = 7
-				for char in sendspec.send:
-					if char in string.ascii_letters:
-						escaped_str += char
-						_count += 1
-					else:
-						escaped_str += shutit_util.get_wide_hex(char)
-						_count += 4
-					if _count > shutit_global.shutit_global_object.line_limit:
-						# The newline here is deliberate!
-						escaped_str += r"""'\
-$'"""
-						_count = 0
-				escaped_str += "'"
+				# If this is over the line limit, it is sourced from a file as
+				# it is, so needs no line continuations.
+				escaped_str = shutit_util.get_escaped_command(sendspec.send, shutit_global.shutit_global_object.default_encoding)
 				if sendspec.secret:
 					shutit.log('The string was sent safely.', level=logging.DEBUG)
 				else:
@@ -2816,7 +3208,7 @@ $'"""
 			if string_to_send is not None:
 				if len(string_to_send) > shutit_global.shutit_global_object.line_limit:
 					fname = self._create_command_file(sendspec.expect,string_to_send)
-					res = self.send(ShutItSendSpec(self,
+					source_sendspec = ShutItSendSpec(self,
 					                               send=' command source ' + fname,
 					                               expect=sendspec.expect,
 					                               timeout=sendspec.timeout,
@@ -2833,24 +3225,20 @@ $'"""
 			                                       nonewline=sendspec.nonewline,
 			                                       run_in_background=sendspec.run_in_background,
 					                               ignore_background=True,
-			                                       block_other_commands=sendspec.block_other_commands))
-					if not self.sendline(ShutItSendSpec(self,
-					                                    send=' rm -f ' + fname,
-					                                    nonewline=sendspec.nonewline,
-			                                            run_in_background=sendspec.run_in_background,
-					                                    echo=False,
-					                                    ignore_background=True)):
-						self.expect(sendspec.expect,
-						            searchwindowsize=sendspec.searchwindowsize,
-						            maxread=sendspec.maxread)
-						# Before returning, determine whether we are now in a shell by comparing the expect we have with the originally-created 'shell_expect'.
-						self.in_shell = sendspec.expect == self.shell_expect
+			                                       block_other_commands=sendspec.block_other_commands,
+					                               capture_tail=sendspec.capture_tail)
+					# The file removes itself when sourced.
+					res = self.send(source_sendspec)
+					sendspec.capture = source_sendspec.capture
 					return res
 				else:
 					if sendspec.echo:
 						shutit.divert_output(sys.stdout)
 					if not self.sendline(sendspec):
-						expect_res = shutit.expect_allow_interrupt(self.pexpect_child, sendspec.expect, sendspec.timeout)
+						if sendspec.capture_tail is not None:
+							expect_res = self._expect_with_capture(sendspec)
+						else:
+							expect_res = shutit.expect_allow_interrupt(self.pexpect_child, sendspec.expect, sendspec.timeout)
 					else:
 						expect_res = -1
 					if sendspec.echo:
@@ -2952,6 +3340,109 @@ $'"""
 			self.expect(self.default_expect)
 
 
+	def send_batch(self,
+	               sends,
+	               check_exit=None,
+	               timeout=None,
+	               echo=None,
+	               note=None,
+	               retbool=False,
+	               loglevel=logging.INFO):
+		"""Sends a list of commands to the shell in one go and waits for a single
+		prompt. Each command is followed by a sentinel carrying its exit code,
+		and the output and exit code of every command are parsed from that one
+		match.
+
+		If check_exit is on for a command and its exit code is not in its
+		exit_values, the commands after it are not run, and the failure is
+		handled as it would be by send().
+
+		@param sends:      List of commands, as strings or ShutItSendSpec
+		                   objects. Only the send, check_exit, exit_values and
+		                   record_command of ShutItSendSpec objects are used.
+		@param check_exit: check_exit for commands that do not set it.
+		                   Defaults to the session's check_exit. See send()
+		@param timeout:    Timeout for the whole batch. See send()
+		@param echo:       See send()
+		@param note:       See send()
+		@param retbool:    If True, return on a failure rather than pausing or
+		                   failing.
+		@param loglevel:   See send()
+
+		@return: (exit code, output) for each command run, in order.
+		@rtype:  list of tuples
+		"""
+		shutit = self.shutit
+		shutit.handle_note(note)
+		if check_exit is None:
+			# If we are in video mode, ignore exit value, as send() does
+			if (shutit.build['video'] != -1 or shutit.build['video'] is True) or shutit.build['training'] or shutit.build['walkthrough'] or shutit.build['exam']:
+				check_exit = False
+			else:
+				check_exit = self.check_exit
+		sendspecs = []
+		for send in sends:
+			if isinstance(send, ShutItSendSpec):
+				sendspecs.append(send)
+			else:
+				sendspecs.append(ShutItSendSpec(self, send=send))
+		sentinel = 'SHUTIT_BATCH_' + shutit_util.random_id()
+		# The sentinel is split in the command so that the echoed command does not match.
+		sentinel_printf = ' printf "%s%s:%s:%s\\n" ' + sentinel[:2] + ' ' + sentinel[2:]
+		# The whole batch is in braces so that the shell reads all of it before
+		# running any of it, and we see only one prompt.
+		batch = ' { SHUTIT_BATCH_STOP=;' + sentinel_printf + ' B 0'
+		for n, sendspec in enumerate(sendspecs):
+			if sendspec.check_exit is not None:
+				sendspec.check_exit = sendspec.check_exit and check_exit
+			else:
+				sendspec.check_exit = check_exit
+			batch += '\nif [ -z "$SHUTIT_BATCH_STOP" ]; then { ' + shutit.get_send_command(sendspec.send) + '\n}; SHUTIT_BATCH_EC=$?; echo;' + sentinel_printf + ' ' + str(n) + ' $SHUTIT_BATCH_EC'
+			if sendspec.check_exit:
+				batch += '; case $SHUTIT_BATCH_EC in ' + '|'.join(str(exit_value) for exit_value in sendspec.exit_values) + ') ;; *) SHUTIT_BATCH_STOP=1;; esac'
+			batch += '; fi'
+			if sendspec.record_command and not sendspec.secret:
+				shutit.build['shutit_command_history'].append(sendspec.send)
+		batch += '\nunset SHUTIT_BATCH_STOP SHUTIT_BATCH_EC\n}'
+		if len(batch) > shutit_global.shutit_global_object.line_limit:
+			# Source long batches from a file, which removes itself, so that the
+			# batch output is what we match on.
+			fname = self._create_command_file(self.default_expect, batch)
+			batch = ' command source ' + fname
+		shutit.log('Sending batch of ' + str(len(sendspecs)) + ' commands', level=logging.DEBUG)
+		self.send(ShutItSendSpec(self,
+		                         send=batch,
+		                         timeout=timeout,
+		                         check_exit=False,
+		                         fail_on_empty_before=False,
+		                         record_command=False,
+		                         echo=echo,
+		                         assume_gnu=False,
+		                         loglevel=loglevel))
+		before = self.pexpect_child.before
+		results = []
+		pos = None
+		for match in re.finditer(r'\r?\n?' + sentinel + r':([B0-9]+):([0-9]+)\r?\n', before):
+			if match.group(1) == 'B':
+				pos = match.end()
+				continue
+			if pos is None:
+				break
+			output = before[pos:match.start()].replace('\r\n','\n').strip()
+			pos = match.end()
+			results.append((match.group(2), output))
+		shutit.log('Batch results: ' + str(results), level=logging.DEBUG)
+		for sendspec, (exit_code, _) in zip(sendspecs, results):
+			if sendspec.check_exit and exit_code not in [str(exit_value) for exit_value in sendspec.exit_values]:
+				# The commands after a failure were not run.
+				self._handle_exit_value_failure(sendspec.send, exit_code, retry=1, retbool=retbool)
+				return results
+		if len(results) != len(sendspecs) and not retbool:
+			shutit.fail('Batch send ended after ' + str(len(results)) + ' of ' + str(len(sendspecs)) + ' commands. Output was:\n' + before, throw_exception=False) # pragma: no cover
+		shutit.handle_note_after(note=note)
+		return results
+
+
 	def send_file(self,
 	              path,
 	              contents,
@@ -2961,32 +3452,42 @@ $'"""
 	              user=None,
 	              group=None,
 	              loglevel=logging.INFO,
-	              encoding=None):
+	              encoding=None,
+	              compression=None,
+	              sync=False,
+	              store=False):
 		"""Sends the passed-in string as a file to the passed-in path on the
 		target.
 
+		For delivery=docker, the file is sent into the container with docker
+		(see shutit_docker_transfer), and compression, sync and store do not
+		apply. Otherwise it is sent over the terminal (see shutit_transfer).
+
 		@param path:        Target location of file on target.
-		@param contents:    Contents of file as a string.
+		@param contents:    Contents of file as a string, or a file object
+		                    opened for reading bytes.
 		@param note:        See send()
 		@param user:        Set ownership to this user (defaults to whoami)
 		@param group:       Set group to this user (defaults to first group in groups)
+		@param compression: See shutit_transfer.ShutItFileTransfer
+		@param sync:        See shutit_transfer.ShutItFileTransfer
+		@param store:       See shutit_transfer.ShutItFileTransfer
 
 		@type path:         string
 		@type contents:     string
 		"""
 		shutit = self.shutit
 		shutit.handle_note(note, 'Sending contents to path: ' + path)
-		# make more efficient by only looking at first 10000 chars, stop when we get to 30 chars rather than reading whole file.
-		if shutit_global.shutit_global_object.ispy3:
-			split_contents = ''.join((str(contents[:10000]).split()))
+		if hasattr(contents, 'read'):
+			shutit.log('Sending file contents from: ' + str(getattr(contents, 'name', contents)) + ' to file: ' + path, level=loglevel)
 		else:
-			split_contents = ''.join((contents[:10000].split()))
-		strings_from_file = re.findall("[^\x00-\x1F\x7F-\xFF]", split_contents)
-		shutit.log('Sending file contents beginning: "' + ''.join(strings_from_file)[:30] + ' [...]" to file: ' + path, level=loglevel)
-		if user is None:
-			user = self.whoami()
-		if group is None:
-			group = self.whoarewe()
+			# make more efficient by only looking at first 10000 chars, stop when we get to 30 chars rather than reading whole file.
+			if shutit_global.shutit_global_object.ispy3:
+				split_contents = ''.join((str(contents[:10000]).split()))
+			else:
+				split_contents = ''.join((contents[:10000].split()))
+			strings_from_file = re.findall("[^\x00-\x1F\x7F-\xFF]", split_contents)
+			shutit.log('Sending file contents beginning: "' + ''.join(strings_from_file)[:30] + ' [...]" to file: ' + path, level=loglevel)
 		if self.current_environment.environment_id == 'ORIGIN_ENV' and False:
 			# If we're on the root env (ie the same one that python is running on, then use python.
 			if isinstance(contents, str):
@@ -3015,115 +3516,97 @@ $'"""
 			else:
 				shutit.fail('type: ' + str(type(contents)) + ' not handled in 1') # pragma: no cover
 			f.close()
-		elif shutit.build['delivery'] in ('bash','dockerfile'):
+		elif shutit.build['delivery'] == 'docker' and self.pexpect_session_id == 'target_child':
+			# Straight into the container with docker on the host, bypassing
+			# the target's terminal.
+			if isinstance(contents, bytes) or hasattr(contents, 'read'):
+				source = contents
+			else:
+				source = contents.encode(encoding or shutit_global.shutit_global_object.default_encoding)
+			# docker would otherwise make a new file as the container's user.
+			# An existing file keeps its owner, as over the terminal.
+			keep_owner = user is None and group is None
+			if keep_owner:
+				user  = self.whoami()
+				group = self.whoarewe()
+			docker_transfer = ShutItDockerTransfer(self, loglevel=loglevel)
+			docker_transfer.add(path, source, user=user, group=group, keep_owner=keep_owner)
+			docker_transfer.send()
+		else:
 			if truncate and self.file_exists(path):
 				self.send(ShutItSendSpec(self,
 				                         send=' command rm -f ' + path,
 				                         echo=False,
 				                         loglevel=loglevel,
 				                         ignore_background=True))
-			random_id = shutit_util.random_id()
-			# set the searchwindowsize to a low number to speed up processing of large output
-			if shutit_global.shutit_global_object.ispy3:
-				if encoding is not None:
-					b64contents = base64.b64encode(contents.encode(encoding)).decode(encoding)
-				else:
-					if isinstance(contents, str):
-						b64contents = base64.b64encode(contents.encode(shutit_global.shutit_global_object.default_encoding)).decode(shutit_global.shutit_global_object.default_encoding)
-					elif isinstance(contents, bytes):
-						b64contents = base64.b64encode(contents).decode(shutit_global.shutit_global_object.default_encoding)
-					else:
-						shutit.fail('type: ' + str(type(contents)) + ' not handled in 2') # pragma: no cover
+			if hasattr(contents, 'read'):
+				source = contents
+			elif isinstance(contents, bytes):
+				source = io.BytesIO(contents)
 			else:
-				if encoding is not None:
-					b64contents = base64.b64encode(contents.encode(encoding))
-				else:
-					b64contents = base64.b64encode(contents.encode(shutit_global.shutit_global_object.default_encoding))
-			# split the contents into chunks and append to avoid PC_MAX_CANON: see https://github.com/pexpect/pexpect/commit/f3ef67b6ba5508d0d118b59837d099f5144e576b
-			total_length = len(b64contents)
-			position = 0
-			leap=1000
-			while position < total_length:
+				source = io.BytesIO(contents.encode(encoding or shutit_global.shutit_global_object.default_encoding))
+			ShutItFileTransfer(self,
+			                   path,
+			                   source,
+			                   compression=compression,
+			                   sync=sync,
+			                   store=store,
+			                   loglevel=loglevel).send()
+			# The file is made as the current user, so only change the owner
+			# if asked to.
+			if user is not None or group is not None:
 				self.send(ShutItSendSpec(self,
-				                         send=' ' + shutit.get_command('head') + ' -c -1 >> ' + path + "." + random_id + " << 'END_" + random_id + """'\n""" + b64contents[position:position+leap] + '''\nEND_''' + random_id,
-				                         echo=echo,
+				                         send=' command chown ' + (user or '') + (':' + group if group is not None else '') + ' ' + path,
+				                         echo=False,
 				                         loglevel=loglevel,
-				                         timeout=shutit_global.shutit_global_object.default_timeout,
 				                         ignore_background=True))
-				position += leap
-			self.send(ShutItSendSpec(self,
-			                         send=' command cat ' + path + '.' + random_id + ' | base64 --decode > ' + path,
-			                         echo=echo,
-			                         loglevel=loglevel,
-			                         ignore_background=True))
-			# Remove the file
-			self.send(ShutItSendSpec(self,
-			                         send=' command rm -f ' + path + '.' + random_id,
-			                         loglevel=loglevel,
-			                         echo=False,
-			                         ignore_background=True))
-		else:
-			host_child = shutit.get_shutit_pexpect_session_from_id('host_child').pexpect_child
-			path = path.replace(' ', r'\ ')
-			# get host session
-			tmpfile = shutit_global.shutit_global_object.shutit_state_dir + 'tmp_' + shutit_util.random_id()
-			f = open(tmpfile,'wb')
-			f.truncate(0)
-			# TODO: try taking out trys
-			if isinstance(contents, bytes):
-				try:
-					if shutit_global.shutit_global_object.ispy3:
-						f.write(contents)
-					elif encoding is not None:
-						f.write(contents.encode(encoding))
-					else:
-						f.write(contents.encode(shutit_global.shutit_global_object.default_encoding))
-				except (UnicodeDecodeError, TypeError) as e:
-					f.write(contents)
-			else:
-				# We assume it's unicode, or str. Can't be explicit because python3 and 2 differ in how they handle...
-				try:
-					if encoding is not None:
-						f.write(contents.encode(encoding))
-					else:
-						f.write(contents.encode(shutit_global.shutit_global_object.default_encoding))
-				except (UnicodeDecodeError, TypeError) as e:
-					f.write(contents)
-			f.close()
-			# Create file so it has appropriate permissions
-			self.send(ShutItSendSpec(self,
-			                         send=' command touch ' + path,
-			                         loglevel=loglevel,
-			                         echo=echo,
-			                         ignore_background=True))
-			# If path is not absolute, add $HOME to it.
-			if path[0] != '/':
-				shutit.send(' command cat ' + tmpfile + ' | ' + shutit.host['docker_executable'] + ' exec -i ' + shutit.target['container_id'] + " bash -c 'cat > $HOME/" + path + "'",
-				            shutit_pexpect_child=host_child,
-				            expect=shutit.expect_prompts['ORIGIN_ENV'],
-				            loglevel=loglevel,
-				            echo=echo)
-			else:
-				shutit.send(' command cat ' + tmpfile + ' | ' + shutit.host['docker_executable'] + ' exec -i ' + shutit.target['container_id'] + " bash -c 'cat > " + path + "'",
-				            shutit_pexpect_child=host_child,
-				            expect=shutit.expect_prompts['ORIGIN_ENV'],
-				            loglevel=loglevel,
-				            echo=echo)
-			self.send(ShutItSendSpec(self,
-			                         send=' command chown ' + user + ' ' + path + ' && chgrp ' + group + ' ' + path,
-			                         echo=echo,
-			                         loglevel=loglevel,
-			                         ignore_background=True))
-			os.remove(tmpfile)
 		shutit.handle_note_after(note=note)
 		return True
 
 
+	def get_file(self,
+	             target_path,
+	             host_path,
+	             note=None,
+	             loglevel=logging.DEBUG,
+	             compression=None):
+		"""Copies a file from the target to the host.
+
+		For delivery=docker, the file is got from the container with docker
+		(see shutit_docker_transfer). Otherwise it is read over the terminal
+		(see shutit_transfer).
+
+		@param target_path: Path to file on the target.
+		@param host_path:   Path to copy it to on the host. If a directory, the
+		                    file is copied into it.
+		@param note:        See send()
+		@param compression: See shutit_transfer.ShutItFileTransfer
+
+		@return: the path of the file on the host, or False if it could not
+		         be got.
+		"""
+		shutit = self.shutit
+		shutit.handle_note(note, 'Getting file: ' + target_path + ' to host path: ' + host_path)
+		if os.path.isdir(host_path):
+			host_path = os.path.join(host_path, os.path.basename(target_path))
+		if shutit.build['delivery'] == 'docker' and self.pexpect_session_id == 'target_child':
+			got = ShutItDockerTransfer(self, loglevel=loglevel).get(target_path, host_path)
+		else:
+			got = ShutItFileTransfer(self,
+			                         target_path,
+			                         None,
+			                         compression=compression,
+			                         loglevel=loglevel).get(host_path)
+		shutit.handle_note_after(note=note)
+		return host_path if got else False
+
+
 	def run_script(self,
 	               script,
 	               in_shell=True,
 	               echo=None,
 	               note=None,
+	               store=False,
 	               loglevel=logging.DEBUG):
 		"""Run the passed-in string as a script on the target's command line.
 
@@ -3131,6 +3614,7 @@ $'"""
 						 and stripped before being run.
 		@param in_shell: Indicate whether we are in a shell or not. (Default: True)
 		@param note:     See send()
+		@param store:    See send_file()
 
 		@type script:    string
 		@type in_shell:  boolean
@@ -3155,7 +3639,8 @@ $'"""
 		self.send_file(shutit_global.shutit_global_object.shutit_state_dir + '/scripts/shutit_script.sh',
 		               script,
 		               echo=False,
-		               loglevel=loglevel)
+		               loglevel=loglevel,
+		               store=store)
 		self.quick_send('command chmod +x ' + shutit_global.shutit_global_object.shutit_state_dir + '/scripts/shutit_script.sh', echo=False)
 		shutit.build['shutit_command_history'].append('    ' + script.replace('\n', '\n    '))
 		if in_shell:
@@ -3303,10 +3788,8 @@ $'"""
 					if output == expect:
 						ok = True
 				elif expect_type == 'regexp':
-					for regexp in expect:
-						if shutit.match_string(output, regexp):
-							ok = True
-							break
+					if shutit.get_line_matcher(expect, 'challenge').match(output):
+						ok = True
 				if not ok and failed:
 					if shutit.build['exam_object']:
 						shutit.build['exam_object'].add_fail()
@@ -3412,10 +3895,8 @@ $'"""
 					if output == expect:
 						ok = True
 				elif expect_type == 'regexp':
-					for regexp in expect:
-						if shutit.match_string(output,regexp):
-							ok = True
-							break
+					if shutit.get_line_matcher(expect, 'challenge').match(output):
+						ok = True
 				if not ok and failed:
 					shutit.log('\r\n\n' + shutit_util.colorise('31','Failed! CTRL-g to reset state, CTRL-h for a hint, CTRL-] to submit for checking') + '\n',transient=True, level=logging.CRITICAL)
 					# No second chances if exam!
@@ -3495,6 +3976,11 @@ $'"""
 	# Determines whether we have sudo available, and whether we already have sudo rights cached.
 	def check_sudo(self):
 		shutit = self.shutit
+		found, ret = self._get_fact(('check_sudo',))
+		if found:
+			shutit.log('check_sudo returning cached ' + str(ret), level=logging.DEBUG)
+			return ret
+		ret = False
 		if self.command_available('sudo'):
 			self.send(ShutItSendSpec(self,
 			                         send=' sudo -n echo',
@@ -3503,10 +3989,14 @@ $'"""
 			                         check_sudo=False,
 			                         ignore_background=True))
 			if self.send_and_get_output(' echo $?', echo=False) == '0':
-				shutit.log('check_sudo returning True', level=logging.DEBUG)
-				return True
-		shutit.log('check_sudo returning False', level=logging.DEBUG)
-		return False
+				ret = True
+		# Only a need for a password is kept, as sudo's timestamp can expire
+		# at any time. If it is stale, the send still copes with there being
+		# no password prompt.
+		if not ret:
+			self._set_fact(('check_sudo',), ret)
+		shutit.log('check_sudo returning ' + str(ret), level=logging.DEBUG)
+		return ret
 
 
 	def get_os(self):
@@ -3536,29 +4026,15 @@ $'"""
 	def _create_command_file(self, expect, send):
 		"""Internal function. Do not use.
 
-		Takes a long command, and puts it in an executable file ready to run. Returns the filename.
+		Takes a long command, and puts it in a file ready to source, in one
+		write to the terminal. The file's first line removes it, so sourcing
+		it also cleans it up. Returns the filename.
 		"""
-		shutit = self.shutit
-		random_id = shutit_util.random_id()
-		fname = shutit_global.shutit_global_object.shutit_state_dir + '/tmp_' + random_id
-		working_str = send
-		# truncate -s must be used as --size is not supported everywhere (eg busybox)
-		assert not self.sendline(ShutItSendSpec(self,
-		                                        send=' truncate -s 0 '+ fname,
-		                                        ignore_background=True)), shutit_util.print_debug()
-		self.expect(expect)
-		size = shutit_global.shutit_global_object.line_limit
-		while working_str:
-			curr_str = working_str[:size]
-			working_str = working_str[size:]
-			assert not self.sendline(ShutItSendSpec(self,
-			                                        send=' ' + shutit.get_command('head') + ''' -c -1 >> ''' + fname + """ << 'END_""" + random_id + """'\n""" + curr_str + """\nEND_""" + random_id,
-		                                            ignore_background=True)), shutit_util.print_debug()
-			self.expect(expect)
-		assert not self.sendline(ShutItSendSpec(self,
-		                                        send=' chmod +x ' + fname,
-		                                        ignore_background=True)), shutit_util.print_debug()
-		self.expect(expect)
+		fname = shutit_global.shutit_global_object.shutit_state_dir + '/tmp_' + shutit_util.random_id()
+		contents = ' command rm -f ' + fname + '\n' + send
+		if not isinstance(contents, bytes):
+			contents = contents.encode(shutit_global.shutit_global_object.default_encoding)
+		ShutItFileTransfer(self, fname, io.BytesIO(contents)).send_heredoc(expect)
 		return fname
 
 
@@ -27,6 +27,11 @@ class ShutItPexpectSessionEnvironment(object):
 		self.build['apt_update_done']     = False
 		self.build['emerge_update_done']  = False
 		self.build['apk_update_done']     = False
+		# Results of probes (whoami, command_available etc) on this environment.
+		# Keyed by tuple, starting with the pexpect session id.
+		self.facts                        = {}
+		self.facts_hits                   = 0
+		self.facts_misses                 = 0
 
 	def __str__(self):
 		string = '\n======= SHUTIT PEXPECT SESSION ENVIRONMENT BEGIN ========'
@@ -41,5 +46,48 @@ class ShutItPexpectSessionEnvironment(object):
 		string += '| distro_version = ' + str(self.distro_version)
 		string += '| users = ' + str(self.users)
 		string += '| self.build = ' + str(self.build)
+		string += '| facts = ' + str(self.facts)
 		string += '\n======= SHUTIT PEXPECT SESSION ENVIRONMENT END ========'
 		return string
+
+
+	def get_fact(self, key, generation=None):
+		"""Looks up a cached fact about this environment.
+
+		@param key:        Tuple identifying the fact.
+		@param generation: Current generation of the asking session. Facts
+		                   recorded against a different generation are stale.
+
+		@return: tuple of (found, value)
+		"""
+		if key in self.facts:
+			value, fact_generation = self.facts[key]
+			if fact_generation is None or fact_generation == generation:
+				self.facts_hits += 1
+				return True, value
+			del self.facts[key]
+		self.facts_misses += 1
+		return False, None
+
+
+	def set_fact(self, key, value, generation=None):
+		"""Caches a fact about this environment.
+
+		@param key:        Tuple identifying the fact.
+		@param value:      Value to cache.
+		@param generation: If set, the fact is only valid while the session's
+		                   generation is unchanged (ie no commands have been sent).
+		"""
+		self.facts[key] = (value, generation)
+
+
+	def invalidate_facts(self, pexpect_session_id=None):
+		"""Forgets cached facts, either all of them or just those recorded by
+		the given pexpect session.
+		"""
+		if pexpect_session_id is None:
+			self.facts = {}
+		else:
+			for key in list(self.facts.keys()):
+				if key[0] == pexpect_session_id:
+					del self.facts[key]
@@ -37,6 +37,9 @@ class ShutItSendSpec(object):
 	             run_in_background=False,
 	             block_other_commands=True,
 	             wait_cadence=2,
+	             capture_tail=None,
+	             background_id=None,
+	             depends_on=None,
 	             loglevel=logging.INFO):
 		"""Specification for arguments to send to shutit functions.
 
@@ -98,6 +101,17 @@ class ShutItSendSpec(object):
 			                             Default is True.
 			@param wait_cadence:         If blocked and waiting on a background tasks, wait this
 			                             number of seconds before re-checking. Default is 2.
+			@param capture_tail:         If set, the output is written to a file in shutit_state_dir
+			                             as it arrives, and only the last capture_tail characters
+			                             are kept in memory (eg in pexpect_child.before). The
+			                             file is available afterwards as a ShutItCapture object
+			                             in the capture attribute. Default is None (no capture).
+			@param background_id:        Name of a background command, for other background
+			                             commands to depend on. Default is None.
+			@param depends_on:           List of background_ids of background commands that
+			                             must succeed before this background command is started.
+			                             If any fails or times out, this one fails without
+			                             being run. Default is None.
 			@param loglevel:             Log level at which to operate.
 
 Background Commands
@@ -196,6 +210,10 @@ Args:         run_in_background=True, ignore_background=True, block_other_comman
 		self.run_in_background       = run_in_background
 		self.block_other_commands    = block_other_commands
 		self.wait_cadence            = wait_cadence
+		self.capture_tail            = capture_tail
+		self.capture                 = None
+		self.background_id           = background_id
+		self.depends_on              = depends_on or []
 
 		# BEGIN Setup/checking
 		self.started                 = False
@@ -226,10 +244,13 @@ Args:         run_in_background=True, ignore_background=True, block_other_comman
 	def __str__(self):
 		string = '\n---- Sendspec object BEGIN ----'
 		string += '| assume_gnu = ' + str(self.assume_gnu)
+		string += '| background_id = ' + str(self.background_id)
 		string += '| block_other_commands = ' + str(self.block_other_commands)
+		string += '| capture_tail = ' + str(self.capture_tail)
 		string += '| check_exit = ' + str(self.check_exit)
 		string += '| check_sudo = ' + str(self.check_sudo)
 		string += '| delaybeforesend = ' + str(self.delaybeforesend)
+		string += '| depends_on = ' + str(self.depends_on)
 		string += '| echo = ' + str(self.echo)
 		string += '| escape = ' + str(self.escape)
 		string += '| exit_values = ' + str(self.exit_values)
@@ -38,11 +38,15 @@ def gather_module_paths():
 def managing_thread_main():
 	import shutit_global
 	from shutit_global import SessionPaneLine
+	shutit_global.shutit_global_object.draw_pending = True
 	shutit_global.shutit_global_object.global_thread_lock.acquire()
 	shutit_module_paths = gather_module_paths()
+	shutit_global.shutit_global_object.draw_pending = False
+	shutit_global.shutit_global_object.draw_done.set()
 	shutit_global.shutit_global_object.global_thread_lock.release()
 	shutit_global.shutit_global_object.stacktrace_lines_arr = [SessionPaneLine('',time.time(),'log'),]
 	last_code = []
+	last_output_state = None
 	draw_type = 'default'
 	zoom_state = None
 	while True:
@@ -85,16 +89,6 @@ def managing_thread_main():
 				shutit_global.shutit_global_object.pane_manager.draw_screen(draw_type=draw_type)
 				os.system('reset')
 				os._exit(1)
-		# Acquire lock to write screen. Prevents nasty race conditions.
-		# Different depending PY2/3
-		if shutit_global.shutit_global_object.ispy3:
-			if not shutit_global.shutit_global_object.global_thread_lock.acquire(blocking=False):
-				time.sleep(0.01)
-				continue
-		else:
-			if not shutit_global.shutit_global_object.global_thread_lock.acquire(False):
-				time.sleep(0.01)
-				continue
 		code      = []
 		for thread_id, stack in sys._current_frames().items():
 			# ignore own thread:
@@ -126,11 +120,32 @@ def managing_thread_main():
 									else:
 										code.append('===' + str(lineno_count) + '> ' + line.rstrip())
 							code.append('_' * 80)
+		# Only ask to draw if something has changed, as the main thread waits
+		# for the frame to be drawn when asked.
+		output_state = (shutit_global.shutit_global_object.logstream.tell(), sum(len(shutit_pexpect_session.session_output_lines) for shutit_pexpect_session in shutit_global.get_shutit_pexpect_sessions()))
+		if input_char is None and code == last_code and output_state == last_output_state and not shutit_global.shutit_global_object.draw_pending:
+			time.sleep(0.01)
+			continue
+		# Acquire lock to write screen. Prevents nasty race conditions.
+		# Flag that we want to draw, so the main thread hands over the lock
+		# next time it calls yield_to_draw.
+		shutit_global.shutit_global_object.draw_pending = True
+		# Different depending PY2/3
+		if shutit_global.shutit_global_object.ispy3:
+			if not shutit_global.shutit_global_object.global_thread_lock.acquire(blocking=True, timeout=0.01):
+				continue
+		else:
+			if not shutit_global.shutit_global_object.global_thread_lock.acquire(False):
+				time.sleep(0.01)
+				continue
 		if code != last_code:
 			for line in code:
 				shutit_global.shutit_global_object.stacktrace_lines_arr.append(SessionPaneLine(line,time.time(),'log'))
 			last_code = code
+		last_output_state = output_state
 		shutit_global.shutit_global_object.pane_manager.draw_screen(draw_type=draw_type)
+		shutit_global.shutit_global_object.draw_pending = False
+		shutit_global.shutit_global_object.draw_done.set()
 		shutit_global.shutit_global_object.global_thread_lock.release()
 
 
@@ -0,0 +1,800 @@
+r"""Represents a ShutIt file transfer over a pexpect session's terminal.
+
+The file is compressed (if worthwhile, see get_compression) and base64-encoded
+as it is read, and streamed to the target in large parts, each read by a
+head -c of its exact size, without waiting for a prompt between lines.
+The terminal's echo is turned off while streaming, and lines are kept
+within the terminal's canonical input limit (MAX_CANON), so nothing is lost.
+A single command at the end checks the size and checksum, and copies the
+file into place.
+
+In sync mode, the file on the target is checksummed first, and the
+transfer skipped if it is the same. Large files are compared block by
+block, and only the changed blocks are sent.
+
+In store mode, sent files are also kept on the target in a store keyed by
+their md5 (see shutit_global's file_store_dir), so sending the same contents
+again, in this or a later build, is a local copy on the target. The store
+is only used if it is private to the user, and a file is only copied from it
+if its md5 is still right.
+
+Directories are sent as a tar made as it is read (see open_tar_stream).
+"""
+
+from __future__ import print_function
+import base64
+import errno
+import fcntl
+import fnmatch
+import hashlib
+import logging
+import os
+import re
+import select
+import tarfile
+import threading
+import time
+import zlib
+try:
+	import lzma
+except ImportError: # pragma: no cover
+	lzma = None
+try:
+	import zstandard
+except ImportError: # pragma: no cover
+	zstandard = None
+import shutit_global
+import shutit_util
+from shutit_sendspec import ShutItSendSpec
+
+
+# Canonical input line limits by kernel, as getconf does not report Linux's.
+# See the docstring of pexpect.spawn.send.
+MAX_CANON = {'Linux':   4096,
+             'Darwin':  1024,
+             'FreeBSD': 1920,
+             'SunOS':   256}
+
+# Command to decompress on the target, by compression type.
+DECOMPRESS_COMMANDS = {'zstd': 'zstd -dc',
+                       'gzip': 'gzip -dc',
+                       'xz':   'xz -dc'}
+# Command to compress on the target, when getting a file.
+COMPRESS_COMMANDS   = {'zstd': 'zstd -qc',
+                       'gzip': 'gzip -c',
+                       'xz':   'xz -3c'}
+
+# Files at least this big are synced block by block (see _get_sync_chunks).
+BLOCK_SYNC_MIN_SIZE       = 1048576
+BLOCK_SYNC_MIN_BLOCK_SIZE = 65536
+BLOCK_SYNC_MAX_BLOCKS     = 1024
+
+# Seconds between progress messages while streaming.
+PROGRESS_INTERVAL = 5
+
+# Most bytes of base64 sent to the target for each prompt while streaming.
+STREAM_PART_SIZE = 4194304
+
+
+def match_path_filters(relpath, include=None, exclude=None, directory=False):
+	"""Returns True if a path passes the include and exclude filters.
+
+	Patterns are shell globs (see fnmatch), matched against both the path
+	relative to the directory being sent, and its basename.
+
+	@param relpath:   Path relative to the directory being sent.
+	@param include:   List of patterns. If given, only files matching one of
+	                  them pass. Directories are always searched.
+	@param exclude:   List of patterns. Anything matching one of them does
+	                  not pass, and directories matching are not searched.
+	@param directory: Whether the path is a directory.
+	"""
+	def matches(patterns):
+		return any(fnmatch.fnmatch(relpath, pattern) or fnmatch.fnmatch(os.path.basename(relpath), pattern) for pattern in patterns)
+	if exclude and matches(exclude):
+		return False
+	if include and not directory and not matches(include):
+		return False
+	return True
+
+
+def walk_host_dir(hostfilepath, include=None, exclude=None):
+	"""Yields the paths under a host directory that pass the filters, relative
+	to it, parents first.
+
+	@param hostfilepath: Directory to walk.
+	@param include:      See match_path_filters
+	@param exclude:      See match_path_filters
+
+	@return: generator of (relative path, whether it is a directory)
+	"""
+	for root, subfolders, filenames in os.walk(hostfilepath):
+		relroot = os.path.relpath(root, hostfilepath)
+		relroot = '' if relroot == '.' else relroot + '/'
+		subfolders[:] = sorted(subfolder for subfolder in subfolders if match_path_filters(relroot + subfolder, include, exclude, directory=True))
+		for subfolder in subfolders:
+			yield relroot + subfolder, True
+		for filename in sorted(filenames):
+			if match_path_filters(relroot + filename, include, exclude):
+				yield relroot + filename, False
+
+
+def open_tar_stream(hostfilepath, include=None, exclude=None):
+	"""Opens a tar of a host directory for reading. The tar is made in a
+	thread as it is read, so only a pipe's worth of it is held in memory.
+
+	Ownership is not kept, so files are owned by whoever extracts them.
+
+	@param hostfilepath: Directory to tar. It is the top directory in the tar.
+	@param include:      See match_path_filters
+	@param exclude:      See match_path_filters
+
+	@return: file object to read the tar from, and a list any exception
+	         raised making the tar is added to once it has been read.
+	"""
+	read_fd, write_fd = os.pipe()
+	tar_stream        = os.fdopen(read_fd, 'rb')
+	tar_pipe          = os.fdopen(write_fd, 'wb')
+	errors            = []
+	def tar_filter(tarinfo):
+		relpath = tarinfo.name.split('/', 1)[1] if '/' in tarinfo.name else ''
+		if relpath and not match_path_filters(relpath, include, exclude, tarinfo.isdir()):
+			return None
+		tarinfo.uid   = tarinfo.gid   = 0
+		tarinfo.uname = tarinfo.gname = ''
+		return tarinfo
+	def make_tar():
+		try:
+			with tarfile.open(fileobj=tar_pipe, mode='w|') as tar:
+				tar.add(hostfilepath, arcname=os.path.basename(os.path.normpath(hostfilepath)), filter=tar_filter)
+		except Exception as e:
+			errors.append(e)
+		finally:
+			try:
+				tar_pipe.close()
+			except (IOError, OSError):
+				# The reader has gone.
+				pass
+	thread = threading.Thread(target=make_tar)
+	thread.daemon = True
+	thread.start()
+	return tar_stream, errors
+
+
+class ShutItFileTransfer(object):
+	"""Sends a file-like object to a path on the target through the terminal
+	of a ShutItPexpectSession.
+	"""
+	def __init__(self,
+	             shutit_pexpect_session,
+	             path,
+	             source,
+	             compression=None,
+	             sync=False,
+	             store=False,
+	             timeout=shutit_global.shutit_global_object.default_timeout,
+	             loglevel=logging.DEBUG):
+		"""
+		@param shutit_pexpect_session: Session to transfer the file through.
+		@param path:                   Target location of file on target.
+		@param source:                 File-like object opened for reading bytes,
+		                               or None if getting the file (see get()).
+		@param compression:            One of DECOMPRESS_COMMANDS' keys to force
+		                               that compression, False for none, or
+		                               None (default) to pick the first of
+		                               shutit_global's transfer_compression
+		                               available at both ends.
+		@param sync:                   If True, compare with any file already at
+		                               path first, and send nothing if it is
+		                               the same, or only the changed blocks
+		                               if it is large.
+		@param store:                  If True, copy the file from the target's
+		                               file store if it is there, and add it
+		                               to the store if not.
+		@param timeout:                Timeout for the decoder to finish.
+		"""
+		self.shutit_pexpect_session = shutit_pexpect_session
+		self.shutit                 = shutit_pexpect_session.shutit
+		self.path                   = path
+		self.source                 = source
+		self.timeout                = timeout
+		self.loglevel               = loglevel
+		self.id                     = shutit_util.random_id()
+		self.tmp_path               = path + '.' + self.id
+		# Where the bytes streamed are kept until all have arrived.
+		self.stream_path            = path + '.' + self.id + '.stream'
+		self.compression            = compression
+		self.sync                   = sync
+		self.sync_block_size        = None
+		self.block_md5s             = []
+		self.skipped                = False
+		self.store                  = store
+		self.from_store             = False
+		self.size                   = 0
+		self.sent_size              = 0
+		self.md5                    = hashlib.md5()
+		self.elapsed                = None
+		# Bytes read from the source at a time.
+		self.block_size             = 65536
+
+
+	def __str__(self):
+		string = '\n---- File transfer object BEGIN ----'
+		string += '| path: ' + str(self.path)
+		string += '| tmp_path: ' + str(self.tmp_path)
+		string += '| compression: ' + str(self.compression)
+		string += '| size: ' + str(self.size)
+		string += '| sent_size: ' + str(self.sent_size)
+		string += '| skipped: ' + str(self.skipped)
+		string += '| from_store: ' + str(self.from_store)
+		string += '| elapsed: ' + str(self.elapsed)
+		string += '|---- File transfer object END ----'
+		return string
+
+
+	def get_line_length(self):
+		"""Returns the number of base64 characters to send per line, based on
+		the target terminal's canonical input limit. Cached per environment.
+		"""
+		shutit_pexpect_session = self.shutit_pexpect_session
+		found, max_canon = shutit_pexpect_session._get_fact(('max_canon',))
+		if not found:
+			output = shutit_pexpect_session.send_and_get_output(""" command uname -s; command getconf MAX_CANON / 2>/dev/null || echo 255""",
+			                                                    echo=False,
+			                                                    record_command=False,
+			                                                    ignore_background=True,
+			                                                    loglevel=logging.DEBUG).split()
+			max_canon = 255
+			if output and output[0] in MAX_CANON:
+				max_canon = MAX_CANON[output[0]]
+			elif len(output) > 1 and output[1].isdigit():
+				max_canon = max(int(output[1]), max_canon)
+			shutit_pexpect_session._set_fact(('max_canon',), max_canon)
+		# Leave room for the newline, and keep to whole base64 quanta.
+		return (max_canon - 2) // 4 * 4
+
+
+	def get_compression(self, sample):
+		"""Decides which compression to use, given the start of the file.
+
+		Compression is skipped for small or incompressible files. Which
+		decompressors the target has is probed once, and cached.
+
+		@param sample: First block of the file.
+
+		@return: a key of DECOMPRESS_COMMANDS, or None
+		"""
+		if self.compression is not None:
+			return self.compression or None
+		if len(sample) < 1024:
+			return None
+		available = self._get_target_compressions()
+		for compression in shutit_global.shutit_global_object.transfer_compression:
+			compressor = self._get_compressor(compression)
+			if compression in available and compressor is not None:
+				# Not worth it if the start of the file does not compress well.
+				if len(compressor.compress(sample) + compressor.flush()) < len(sample) * 0.9:
+					return compression
+				return None
+		return None
+
+
+	def _get_target_compressions(self):
+		"""Returns which of DECOMPRESS_COMMANDS' keys the target has the
+		command for. Probed once, and cached.
+		"""
+		shutit_pexpect_session = self.shutit_pexpect_session
+		found, available = shutit_pexpect_session._get_fact(('compressions',))
+		if not found:
+			available = shutit_pexpect_session.send_and_get_output(""" for c in """ + ' '.join(sorted(DECOMPRESS_COMMANDS)) + """; do command -v $c >/dev/null 2>&1 && echo $c; done""",
+			                                                       echo=False,
+			                                                       record_command=False,
+			                                                       ignore_background=True,
+			                                                       loglevel=logging.DEBUG).split()
+			shutit_pexpect_session._set_fact(('compressions',), available)
+		return available
+
+
+	def _get_decompressor(self, compression):
+		"""Returns a streaming decompressor object with a decompress() method,
+		or None if it is not available here.
+		"""
+		if compression == 'gzip':
+			return zlib.decompressobj(31)
+		elif compression == 'xz' and lzma is not None:
+			return lzma.LZMADecompressor()
+		elif compression == 'zstd' and zstandard is not None:
+			return zstandard.ZstdDecompressor().decompressobj()
+		return None
+
+
+	def _get_compressor(self, compression):
+		"""Returns a streaming compressor object with compress() and flush()
+		methods, or None if it is not available here.
+		"""
+		if compression == 'gzip':
+			# wbits of 31 gives a gzip header and trailer.
+			return zlib.compressobj(6, zlib.DEFLATED, 31)
+		elif compression == 'xz' and lzma is not None:
+			return lzma.LZMACompressor(preset=3)
+		elif compression == 'zstd' and zstandard is not None:
+			return zstandard.ZstdCompressor(level=3).compressobj()
+		return None
+
+
+	def send(self):
+		"""Streams the source to the target and verifies it arrived intact.
+		"""
+		shutit_pexpect_session = self.shutit_pexpect_session
+		shutit                 = self.shutit
+		start_time             = time.time()
+		chunks                 = None
+		hashed                 = (self.sync or self.store) and self._hash_source()
+		if self.sync and hashed:
+			chunks = self._get_sync_chunks()
+			if self.skipped:
+				self.elapsed = time.time() - start_time
+				shutit.log('File ' + self.path + ' already up to date, not sent', level=self.loglevel)
+				return True
+		if self.store and hashed and self._copy_from_store():
+			self.elapsed = time.time() - start_time
+			shutit.log('File ' + self.path + ' copied from file store on target, not sent', level=self.loglevel)
+			return True
+		if chunks is None:
+			# Sending the whole file, so start counting again.
+			self.size = 0
+			self.md5  = hashlib.md5()
+			chunks    = self._read_source()
+			prepare = ''
+			writer  = '> ' + self.tmp_path
+		else:
+			# Copy the existing file, and overwrite the changed blocks. Each block
+			# comes as its index on a line, followed by the block.
+			prepare = ' command cp ' + self.path + ' ' + self.tmp_path + ';'
+			writer  = ('| { while read -r i; do command dd of=' + self.tmp_path + ' bs=' + str(self.sync_block_size) + ' seek=$i count=1 conv=notrunc iflag=fullblock 2>/dev/null; done; ' +
+			           'command dd if=/dev/null of=' + self.tmp_path + ' bs=1 seek=' + str(self.size) + ' 2>/dev/null; }')
+		self._stream(chunks, prepare, writer)
+		# Check and move into place in one go. cat rather than mv keeps the
+		# permissions of any existing file.
+		check = '[ "$(command wc -c < ' + self.tmp_path + ' | tr -d " ")" = ' + str(self.size) + ' ]'
+		if shutit_pexpect_session.command_available('md5sum'):
+			check += ' && [ "$(command md5sum < ' + self.tmp_path + ' | cut -c1-32)" = ' + self.md5.hexdigest() + ' ]'
+		check += ' && command cat ' + self.tmp_path + ' > ' + self.path
+		store_command = self.store and self._get_store_command()
+		if store_command:
+			# Failing to store the file does not fail the transfer.
+			check += ' && { ' + store_command + '; true; }'
+		output = shutit_pexpect_session.send_and_get_output(' ' + check + ' && echo SHUTIT_TRANSFER""_OK; command rm -f ' + self.tmp_path,
+		                                                    echo=False,
+		                                                    record_command=False,
+		                                                    ignore_background=True,
+		                                                    loglevel=self.loglevel)
+		if output.strip() != 'SHUTIT_TRANSFER_OK':
+			shutit.fail('File transfer to ' + self.path + ' failed verification (expected size ' + str(self.size) + ', md5 ' + self.md5.hexdigest() + '). Output was:\n' + output) # pragma: no cover
+		self.elapsed = time.time() - start_time
+		shutit.log('Sent ' + str(self.size) + ' bytes (' + str(self.sent_size) + ' ' + str(self.compression or 'uncompressed') + ') to ' + self.path + ' in ' + '%.2f' % self.elapsed + 's (' + '%.2f' % (self.size / 1048576.0 / max(self.elapsed, 0.001)) + ' MB/s)', level=self.loglevel)
+		return True
+
+
+	def send_heredoc(self, expect):
+		"""Writes the source to the path with a single base64-encoded here
+		document, written to the terminal in one go, waiting only for the
+		prompt at the end. Nothing is checked, so this is for small files that
+		are used at once, such as long commands.
+
+		@param expect: What to expect once it is written.
+		"""
+		line_length = self.get_line_length()
+		data        = self.source.read()
+		encoded     = base64.b64encode(data)
+		delimiter   = 'SHUTIT_HEREDOC_' + self.id
+		self.size = self.sent_size = len(data)
+		# The prompt only follows the last write, so draining the echoes
+		# before it cannot lose it.
+		self._write((' command base64 --decode > ' + self.path + " << '" + delimiter + "'\n").encode('ascii') + b''.join(encoded[i:i+line_length] + b'\n' for i in range(0, len(encoded), line_length)) + delimiter.encode('ascii') + b'\n')
+		self.shutit_pexpect_session.expect(expect, timeout=self.timeout)
+
+
+	def get(self, host_path):
+		"""Streams the file from the target to host_path, and verifies it
+		arrived intact.
+
+		The file is (optionally) compressed and base64-encoded on the target,
+		and read straight from the terminal, decoded and written as it
+		arrives, so it is never all held in memory.
+
+		@param host_path: Path on the host to write the file to. It is only
+		                  replaced once the file is verified.
+
+		@return: False if the file is not there to read, else True.
+		"""
+		shutit_pexpect_session = self.shutit_pexpect_session
+		shutit                 = self.shutit
+		start_time             = time.time()
+		compression            = self.compression
+		if compression is None:
+			compression = next((c for c in shutit_global.shutit_global_object.transfer_compression if c in self._get_target_compressions() and self._get_decompressor(c) is not None), None)
+		decompressor = None
+		encode       = ' command base64 < ' + self.path
+		if compression:
+			decompressor = self._get_decompressor(compression)
+			encode = ' command ' + COMPRESS_COMMANDS[compression] + ' < ' + self.path + ' | command base64'
+		self.compression = compression or None
+		check = ' command wc -c < ' + self.path + ' | tr -d " ";'
+		if shutit_pexpect_session.command_available('md5sum'):
+			check += ' command md5sum < ' + self.path + ' | cut -c1-32;'
+		# The quotes stop the echoed command matching the markers.
+		start   = 'SHUTIT_GET_START_' + self.id
+		end     = 'SHUTIT_GET_END_' + self.id
+		done    = 'SHUTIT_GET_DONE_' + self.id
+		missing = 'SHUTIT_GET_MISSING_' + self.id
+		assert not shutit_pexpect_session.sendline(ShutItSendSpec(shutit_pexpect_session,
+		                                                          send=' if [ -r ' + self.path + ' ]; then echo ' + start[:9] + '""' + start[9:] + ';' + encode + '; echo ' + end[:9] + '""' + end[9:] + ';' + check + ' echo ' + done[:9] + '""' + done[9:] + '; else echo ' + missing[:9] + '""' + missing[9:] + '; fi',
+		                                                          ignore_background=True,
+		                                                          loglevel=self.loglevel)), shutit_util.print_debug()
+		# The start pattern takes in everything read so far, so pexpect is
+		# left holding nothing while the file is read from the terminal.
+		res = shutit_pexpect_session.expect(['(?s)' + start + '.*', missing], timeout=self.timeout)
+		if res == 1:
+			shutit_pexpect_session.expect(shutit_pexpect_session.default_expect, timeout=self.timeout)
+			shutit.log('File ' + self.path + ' not found on target', level=self.loglevel)
+			return False
+		elif res != 0:
+			shutit.fail('Timed out waiting to get ' + self.path + ' from target') # pragma: no cover
+		pexpect_child = shutit_pexpect_session.pexpect_child
+		encoding      = pexpect_child.encoding
+		# Whatever pexpect has read past the start marker is the first data.
+		pending = pexpect_child.after[len(start):]
+		if encoding is not None:
+			pending = pending.encode(encoding)
+		end_bytes  = end.encode('ascii')
+		done_bytes = done.encode('ascii')
+		tmp_host_path = host_path + '.' + self.id
+		encoded       = b''
+		last_progress = start_time
+		with open(tmp_host_path, 'wb') as host_file:
+			while True:
+				index = pending.find(end_bytes)
+				if index >= 0:
+					data, rest = pending[:index], pending[index + len(end_bytes):]
+				else:
+					# Hold back what might be the start of the end marker.
+					data, pending = pending[:-len(end_bytes)], pending[-len(end_bytes):]
+				encoded += re.sub(b'[^A-Za-z0-9+/=]', b'', data)
+				whole = len(encoded) // 4 * 4
+				if whole:
+					data = base64.b64decode(encoded[:whole])
+					encoded = encoded[whole:]
+					self.sent_size += len(data)
+					if decompressor:
+						data = decompressor.decompress(data)
+					self.size += len(data)
+					self.md5.update(data)
+					host_file.write(data)
+				if index >= 0:
+					break
+				if time.time() - last_progress > PROGRESS_INTERVAL:
+					last_progress = time.time()
+					shutit.log('Got ' + '%.1f' % (self.size / 1048576.0) + ' MB of ' + self.path + ' (' + '%.2f' % (self.size / 1048576.0 / (last_progress - start_time)) + ' MB/s)', level=self.loglevel)
+				pending += self._read()
+		# Read the checks, then give what follows back to pexpect to find the
+		# prompt in.
+		while done_bytes not in rest:
+			rest += self._read()
+		checks, rest = rest.split(done_bytes, 1)
+		pexpect_child.buffer = rest.decode(encoding) if encoding is not None else rest
+		shutit_pexpect_session.expect(shutit_pexpect_session.default_expect, timeout=self.timeout)
+		checks = checks.decode(shutit_global.shutit_global_object.default_encoding).split()
+		if not checks or checks[0] != str(self.size) or (len(checks) > 1 and checks[1] != self.md5.hexdigest()):
+			os.remove(tmp_host_path)
+			shutit.fail('File transfer from ' + self.path + ' failed verification (got size ' + str(self.size) + ', md5 ' + self.md5.hexdigest() + '). Target reported: ' + str(checks)) # pragma: no cover
+		os.rename(tmp_host_path, host_path)
+		self.elapsed = time.time() - start_time
+		shutit.log('Got ' + str(self.size) + ' bytes (' + str(self.sent_size) + ' ' + str(self.compression or 'uncompressed') + ') from ' + self.path + ' in ' + '%.2f' % self.elapsed + 's (' + '%.2f' % (self.size / 1048576.0 / max(self.elapsed, 0.001)) + ' MB/s)', level=self.loglevel)
+		return True
+
+
+	def _read(self):
+		"""Reads what the terminal has sent, waiting up to the timeout.
+		"""
+		child_fd = self.shutit_pexpect_session.pexpect_child.child_fd
+		if not select.select([child_fd], [], [], self.timeout)[0]:
+			self.shutit.fail('Timed out getting ' + self.path + ' from target') # pragma: no cover
+		try:
+			data = os.read(child_fd, 65536)
+		except OSError:
+			data = b''
+		if not data:
+			self.shutit.fail('Terminal closed while getting ' + self.path + ' from target') # pragma: no cover
+		return data
+
+
+	def _read_source(self):
+		"""Yields the source a block at a time, noting its size and md5.
+		"""
+		while True:
+			data = self.source.read(self.block_size)
+			if not data:
+				return
+			self.size += len(data)
+			self.md5.update(data)
+			yield data
+
+
+	def _hash_source(self):
+		"""Reads the source through once to get its size and md5, and in sync
+		mode the md5 of each block, then rewinds it.
+
+		@return: False if the source cannot be rewound.
+		"""
+		try:
+			self.source.seek(0, os.SEEK_END)
+			size = self.source.tell()
+			self.source.seek(0)
+		except (AttributeError, IOError, OSError):
+			# Not seekable, so we cannot read it twice.
+			return False
+		self.sync_block_size = max(BLOCK_SYNC_MIN_BLOCK_SIZE, (size // BLOCK_SYNC_MAX_BLOCKS) // BLOCK_SYNC_MIN_BLOCK_SIZE * BLOCK_SYNC_MIN_BLOCK_SIZE)
+		while True:
+			data = self.source.read(self.sync_block_size)
+			if not data:
+				break
+			self.size += len(data)
+			self.md5.update(data)
+			if self.sync and size >= BLOCK_SYNC_MIN_SIZE:
+				self.block_md5s.append(hashlib.md5(data).hexdigest())
+		self.source.seek(0)
+		return True
+
+
+	def _get_sync_chunks(self):
+		"""Compares the source with the file already on the target.
+
+		Sets self.skipped if they are the same. Otherwise, for large files
+		where few blocks differ, returns a generator of the changed blocks,
+		each preceded by its index on a line.
+
+		@return: generator of bytes, or None to send the whole file.
+		"""
+		shutit_pexpect_session = self.shutit_pexpect_session
+		block_md5s             = self.block_md5s
+		if not shutit_pexpect_session.command_available('md5sum'):
+			return None
+		remote = shutit_pexpect_session.send_and_get_output(' if [ -f ' + self.path + ' ]; then command wc -c < ' + self.path + ' | tr -d " "; command md5sum < ' + self.path + ' | cut -c1-32; fi',
+		                                                    echo=False,
+		                                                    record_command=False,
+		                                                    ignore_background=True,
+		                                                    loglevel=logging.DEBUG).split()
+		if len(remote) != 2 or not remote[0].isdigit():
+			# No file there, or it could not be read.
+			return None
+		remote_size = int(remote[0])
+		if remote_size == self.size and remote[1] == self.md5.hexdigest():
+			self.skipped = True
+			return None
+		if self.size < BLOCK_SYNC_MIN_SIZE or remote_size < BLOCK_SYNC_MIN_SIZE:
+			return None
+		# GNU split can hash each block without temporary files.
+		remote_md5s = shutit_pexpect_session.send_and_get_output(' command split -b ' + str(self.sync_block_size) + " --filter='md5sum' < " + self.path + ' | cut -c1-32',
+		                                                         echo=False,
+		                                                         record_command=False,
+		                                                         ignore_background=True,
+		                                                         loglevel=logging.DEBUG).split()
+		if len(remote_md5s) != (remote_size + self.sync_block_size - 1) // self.sync_block_size or not all(re.match('^[0-9a-f]{32}$', remote_md5) for remote_md5 in remote_md5s):
+			shutit_pexpect_session.shutit.log('Could not get block checksums of ' + self.path + ', sending whole file', level=logging.DEBUG)
+			return None
+		changed = [i for i, block_md5 in enumerate(block_md5s) if i >= len(remote_md5s) or remote_md5s[i] != block_md5]
+		if len(changed) > len(block_md5s) // 2:
+			return None
+		shutit_pexpect_session.shutit.log('Sending ' + str(len(changed)) + ' of ' + str(len(block_md5s)) + ' blocks of ' + self.path, level=logging.DEBUG)
+		return self._read_blocks(changed)
+
+
+	def _setup_store(self):
+		"""Creates the file store on the target, and evicts old files from it.
+		Done once per environment.
+
+		The store is only used if it, and the directory it is in, belong to
+		the user and cannot be written to by others, as files copied from it
+		may be run.
+
+		@return: True if the store can be used.
+		"""
+		shutit_pexpect_session = self.shutit_pexpect_session
+		found, usable = shutit_pexpect_session._get_fact(('file_store',))
+		if found:
+			return usable
+		store_dir  = shutit_global.shutit_global_object.file_store_dir
+		parent_dir = os.path.dirname(store_dir)
+		max_builds = shutit_global.shutit_global_object.file_store_max_builds
+		# Hits are checked against their md5, so there is no store without md5sum.
+		if not shutit_pexpect_session.command_available('md5sum'):
+			shutit_pexpect_session._set_fact(('file_store',), False)
+			return False
+		# Each build leaves a marker, and each use of a file touches it, so
+		# files not newer than the oldest build to keep have not been used since.
+		# Then remove the least recently used files beyond the maximum size.
+		output = shutit_pexpect_session.send_and_get_output(' ( umask 077; command mkdir -p ' + store_dir + '/objects ' + store_dir + '/builds; command chmod go-w ' + parent_dir + '; command chmod 700 ' + store_dir + ' ' + store_dir + '/objects ' + store_dir + '/builds ) 2>/dev/null; ' +
+		                                                    'if [ -O ' + parent_dir + ' ] && [ -O ' + store_dir + ' ] && [ -O ' + store_dir + '/objects ] && [ -O ' + store_dir + '/builds ]; then echo SHUTIT_STORE""_OK; ' +
+		                                                    '( cd ' + store_dir + '/builds && command touch ' + shutit_global.shutit_global_object.build_id + ' && ' +
+		                                                    'b=$(command ls -t | command sed -n ' + str(max_builds + 1) + 'p) && if [ -n "$b" ]; then command find ../objects -type f ! -newer "$b" -exec rm -f {} +; command ls -t | command sed 1,' + str(max_builds) + 'd | command xargs rm -f; fi; ' +
+		                                                    'cd ../objects && t=0 && for f in $(command ls -t); do t=$((t + $(command wc -c < $f))); [ $t -gt ' + str(shutit_global.shutit_global_object.file_store_max_size) + ' ] && command rm -f $f; done ) 2>/dev/null; fi',
+		                                                    echo=False,
+		                                                    record_command=False,
+		                                                    ignore_background=True,
+		                                                    loglevel=logging.DEBUG)
+		usable = output.strip() == 'SHUTIT_STORE_OK'
+		if not usable:
+			shutit_pexpect_session.shutit.log('File store ' + store_dir + ' on target is not owned by the user, or could not be made private, so not using it', level=logging.WARNING)
+		shutit_pexpect_session._set_fact(('file_store',), usable)
+		return usable
+
+
+	def _copy_from_store(self):
+		"""Copies the file into place from the file store on the target, if
+		it is there and its md5 is right.
+
+		@return: True if the file was copied from the store.
+		"""
+		if not self._setup_store():
+			return False
+		md5        = self.md5.hexdigest()
+		store_path = shutit_global.shutit_global_object.file_store_dir + '/objects/' + md5
+		# A stored file that does not match its md5 is removed, and the file sent.
+		output = self.shutit_pexpect_session.send_and_get_output(' if [ -f ' + store_path + ' ]; then if [ "$(command md5sum < ' + store_path + ' | cut -c1-32)" = ' + md5 + ' ]; then command cp ' + store_path + ' ' + self.path + ' && command touch ' + store_path + ' && echo SHUTIT_STORE""_HIT; else command rm -f ' + store_path + '; fi; fi',
+		                                                         echo=False,
+		                                                         record_command=False,
+		                                                         ignore_background=True,
+		                                                         loglevel=logging.DEBUG)
+		self.from_store = output.strip() == 'SHUTIT_STORE_HIT'
+		return self.from_store
+
+
+	def _get_store_command(self):
+		"""Returns a command that adds the sent file to the file store, once
+		it has been verified, or None if the store cannot be used.
+		"""
+		if not self._setup_store():
+			return None
+		store_path = shutit_global.shutit_global_object.file_store_dir + '/objects/' + self.md5.hexdigest()
+		# Copy then rename, so a partial file is never seen in the store.
+		return 'command cp ' + self.tmp_path + ' ' + store_path + '.' + self.id + ' 2>/dev/null && command mv ' + store_path + '.' + self.id + ' ' + store_path
+
+
+	def _read_blocks(self, blocks):
+		"""Yields the given blocks of the source, each preceded by its index.
+		"""
+		for i in blocks:
+			self.source.seek(i * self.sync_block_size)
+			yield str(i).encode('ascii') + b'\n' + self.source.read(self.sync_block_size)
+
+
+	def _stream(self, chunks, prepare, writer):
+		"""Streams the chunks of bytes to the target, where they are decoded
+		and passed to the writer.
+
+		The encoded bytes are sent in parts of up to STREAM_PART_SIZE, each
+		read by a head -c of exactly its size, so none of it can reach the
+		shell, even if the decoded bytes cannot be written. They are kept in
+		a file until all have arrived, then passed to the writer.
+
+		@param chunks:  Iterable of bytes to send.
+		@param prepare: Command to run before decoding starts.
+		@param writer:  Redirect or pipe the decoded bytes go to.
+		"""
+		shutit_pexpect_session = self.shutit_pexpect_session
+		line_length            = self.get_line_length()
+		raw_line_length        = line_length // 4 * 3
+		chunks                 = iter(chunks)
+		data                   = next(chunks, b'')
+		self.compression       = self.get_compression(data)
+		compressor             = None
+		decode                 = ' command cat < ' + self.stream_path + ' '
+		if self.compression:
+			compressor = self._get_compressor(self.compression)
+			decode = ' command ' + DECOMPRESS_COMMANDS[self.compression] + ' < ' + self.stream_path + ' '
+		self._send_part(b'', prepare + ' command rm -f ' + self.stream_path + ';')
+		# Bytes (compressed, if compressing) not yet sent, as they do not
+		# make up a whole line, and lines not yet sent, as they do not make up
+		# a whole part.
+		pending       = b''
+		part          = []
+		part_size     = 0
+		streamed      = 0
+		start_time    = time.time()
+		last_progress = start_time
+		while data:
+			streamed += len(data)
+			if time.time() - last_progress > PROGRESS_INTERVAL:
+				last_progress = time.time()
+				self.shutit.log('Sent ' + '%.1f' % (streamed / 1048576.0) + ' MB to ' + self.path + ' (' + '%.2f' % (streamed / 1048576.0 / (last_progress - start_time)) + ' MB/s)', level=self.loglevel)
+			if compressor:
+				data = compressor.compress(data)
+			pending += data
+			whole_lines = len(pending) // raw_line_length * raw_line_length
+			if whole_lines:
+				part.append(self._encode_lines(pending[:whole_lines], line_length))
+				part_size += len(part[-1])
+				pending = pending[whole_lines:]
+				if part_size >= STREAM_PART_SIZE:
+					self._send_part(b''.join(part))
+					part      = []
+					part_size = 0
+			data = next(chunks, b'')
+		if compressor:
+			pending += compressor.flush()
+		if pending:
+			part.append(self._encode_lines(pending, line_length))
+		if part:
+			self._send_part(b''.join(part))
+		shutit_pexpect_session.send(ShutItSendSpec(shutit_pexpect_session,
+		                                           send=decode + writer + '; command rm -f ' + self.stream_path,
+		                                           check_exit=False,
+		                                           echo=False,
+		                                           record_command=False,
+		                                           ignore_background=True,
+		                                           timeout=self.timeout,
+		                                           loglevel=self.loglevel))
+
+
+	def _send_part(self, encoded, prepare=''):
+		"""Sends lines of base64 to the target, where they are decoded and
+		added to the file at stream_path.
+
+		@param encoded: Lines of base64, as bytes.
+		@param prepare: Command to run first.
+		"""
+		shutit_pexpect_session = self.shutit_pexpect_session
+		ready = 'SHUTIT_TRANSFER_READY_' + self.id
+		expect = shutit_pexpect_session.default_expect
+		if isinstance(expect, str):
+			expect = [expect]
+		# Say it is ready for the bytes only if the file can be written to.
+		# head then reads exactly the bytes sent, whether or not they can be
+		# decoded and written, as the last cat takes any base64 leaves. The
+		# echo is turned off so the bytes do not come back.
+		assert not shutit_pexpect_session.sendline(ShutItSendSpec(shutit_pexpect_session,
+		                                                          send=prepare + ' command stty -echo; if { : >> ' + self.stream_path + '; } 2>/dev/null; then echo ' + ready[:9] + '""' + ready[9:] + '; command head -c ' + str(len(encoded)) + ' | { command base64 --decode >> ' + self.stream_path + '; command cat > /dev/null; }; fi; command stty echo',
+		                                                          ignore_background=True,
+		                                                          loglevel=logging.DEBUG)), shutit_util.print_debug()
+		if shutit_pexpect_session.expect([ready] + expect, timeout=self.timeout) != 0:
+			self.shutit.fail('Could not write to ' + self.stream_path + ' to send ' + self.path) # pragma: no cover
+		# The prompt only follows the last write, so draining the echoes
+		# before it cannot lose it.
+		self._write(encoded)
+		shutit_pexpect_session.expect(expect, timeout=self.timeout)
+
+
+	def _encode_lines(self, data, line_length):
+		"""Returns the bytes base64-encoded, as lines of line_length.
+		"""
+		self.sent_size += len(data)
+		encoded = base64.b64encode(data)
+		return b''.join(encoded[i:i+line_length] + b'\n' for i in range(0, len(encoded), line_length))
+
+
+	def _write(self, data, drain=True):
+		"""Writes bytes straight to the terminal. Anything the terminal sends
+		back (eg echoes, if stty is missing) before the last of the bytes is
+		written is discarded, so it cannot fill up and stall us.
+		"""
+		child_fd = self.shutit_pexpect_session.pexpect_child.child_fd
+		# Write without blocking, as the terminal may itself be blocked
+		# echoing back to us.
+		flags = fcntl.fcntl(child_fd, fcntl.F_GETFL)
+		fcntl.fcntl(child_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+		try:
+			while data:
+				readable, writable, _ = select.select([child_fd] if drain else [], [child_fd], [])
+				if readable:
+					os.read(child_fd, 65536)
+				if writable:
+					try:
+						written = os.write(child_fd, data)
+					except OSError as e:
+						if e.errno != errno.EAGAIN:
+							raise
+						written = 0
+					data = data[written:]
+		finally:
+			fcntl.fcntl(child_fd, fcntl.F_SETFL, flags)
@@ -120,6 +120,26 @@ def get_wide_hex(char):
 		return r'\x' + hex(ord(char))[2:]
 	return r'\u' + hex(0x10000 + (ord(char[0]) - 0xD800) * 0x400 + (ord(char[1]) - 0xDC00))[2:]
 
+
+# Table for get_escaped_command, by byte: letters stay as they are, anything
+# else becomes a \xHH escape.
+ESCAPE_TABLE = dict((i, chr(i) if chr(i) in string.ascii_letters else '\\x%02x' % i) for i in range(256))
+
+
+def get_escaped_command(command, encoding='utf-8'):
+	r"""Returns a command which evals the given one from an ANSI-C quoted
+	string, so that no character in it is interpreted by the terminal, eg:
+
+		echo "a b"  ->  eval $'echo\x20\x22a\x20b\x22'
+
+	The result is all ascii, made in one translate over the encoded command.
+	"""
+	if not isinstance(command, bytes):
+		command = command.encode(encoding)
+	# Decoding as latin-1 maps each byte to the character of the same number.
+	return "eval $'" + command.decode('latin-1').translate(ESCAPE_TABLE) + "'"
+
+
 # CTRL-\ HANDLING CODE STARTS
 def ctrl_quit_signal_handler(_, frame):
 	shutit_global.shutit_global_object.shutit_print(r'CRTL-\ caught, hard-exiting ShutIt')